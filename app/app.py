@@ -1,29 +1,241 @@
 import os
-import shutil
-import zipfile
-from flask import Flask, render_template, request, redirect, url_for, send_file, flash, session
+import io
+import re
+import csv
+import json
+import functools
+import sqlite3
+import hashlib
+import secrets
+import mimetypes
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+import click
+from flask import (Blueprint, Flask, Response, abort, current_app, g, has_app_context, render_template, request,
+                   redirect, url_for, send_file, flash, session, stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.schema import CreateTable
+from werkzeug.local import LocalProxy
 from werkzeug.utils import secure_filename
-from datetime import datetime
+from datetime import datetime, timedelta
+from blobstore import BlobStore, is_blob_key
+from dxf_geometry import analyze_file, file_sha256
+from jobs import ArtifactStore, JobWorkers
+from metrics import QUERY_COUNT_BUCKETS, Metrics
+from pagecache import PageCache
+from mrp import PlanningData, Scenario, largest_orders, net_requirements, plan
+from thumbnails import THUMBNAIL_SIZES, ThumbnailCache
+from zipstream import ExportCache, stream_zip
 
 ALLOWED_EXTENSIONS = {'pdf', 'dxf'}
 ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 
-app = Flask(__name__)
-# Używamy absolutnej ścieżki dla bazy danych w katalogu /data (poza /app)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:////data/blachy.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-# Folder uploads – wewnątrz katalogu /app
-upload_folder = os.path.join(app.root_path, 'uploads')
-app.config['UPLOAD_FOLDER'] = upload_folder
-if not os.path.exists(app.config['UPLOAD_FOLDER']):
-    os.makedirs(app.config['UPLOAD_FOLDER'])
-
-# Ustawienie tajnego klucza
-app.secret_key = 'your_secret_key'
-
-db = SQLAlchemy(app)
+mimetypes.add_type('image/vnd.dxf', '.dxf')
+
+# Domyślna konfiguracja. Każdą wartość można nadpisać zmienną środowiskową z prefiksem BLACHY_,
+# np. BLACHY_SQLALCHEMY_DATABASE_URI, BLACHY_SECRET_KEY, BLACHY_UPLOAD_FOLDER, BLACHY_INDEX_PAGE_SIZE=200
+# (wartości są parsowane jako JSON; pola słowników przez "__", np. BLACHY_SQLITE_PRAGMAS__busy_timeout).
+DEFAULT_CONFIG = {
+    # Używamy absolutnej ścieżki dla bazy danych w katalogu /data (poza /app)
+    'SQLALCHEMY_DATABASE_URI': 'sqlite:////data/blachy.db',
+    'SQLALCHEMY_TRACK_MODIFICATIONS': False,
+
+    # Ustawienia SQLite dla każdego połączenia: WAL pozwala czytać w trakcie zapisu,
+    # busy_timeout czeka na blokadę zamiast od razu zgłaszać "database is locked"
+    'SQLITE_PRAGMAS': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'temp_store': 'MEMORY',
+        'cache_size': -20000,
+        'mmap_size': 256 * 1024 * 1024,
+    },
+
+    # Folder uploads – domyślnie wewnątrz katalogu aplikacji (/app/uploads)
+    'UPLOAD_FOLDER': None,
+
+    # Liczba blach na jednej stronie listy głównej
+    'INDEX_PAGE_SIZE': 500,
+
+    # Liczba zamówień na jednej stronie historii zamówień
+    'ORDERS_PAGE_SIZE': 50,
+
+    # Czas życia nieużywanego szkicu zamówienia (w sekundach)
+    'DRAFT_ORDER_MAX_AGE': 7 * 24 * 3600,
+
+    # Plik z magazynu zapisany lub ponownie użyty w ciągu tylu sekund nie jest usuwany od razu po
+    # zwolnieniu ostatniego odwołania (jego nowe odwołanie może czekać na zatwierdzenie transakcji)
+    'BLOB_DELETE_GRACE_SECONDS': 600,
+
+    # Planowanie zamówień: zapas minimalny (szt.), wielkość partii i minimalna ilość zamówienia.
+    # Obowiązują przy domyślnych ilościach w ofercie i jako punkt wyjścia scenariuszy na /planowanie.
+    'MRP_SAFETY_STOCK': 0,
+    'MRP_LOT_SIZE': 1,
+    'MRP_MIN_ORDER': 0,
+    # Liczba pozycji z największym zamówieniem pokazywanych dla każdego scenariusza
+    'MRP_TOP_ITEMS': 50,
+
+    # Migawka stanów magazynu tworzona co tyle ruchów; ogranicza liczbę ruchów
+    # odtwarzanych przy pytaniu o stan na wybrany dzień
+    'STOCK_SNAPSHOT_EVERY': 5000,
+
+    # Wyrenderowane strony list (blachy, projekty, zamówienia, materiały) trzymane w pamięci każdego
+    # procesu do następnej zmiany danych; limit w bajtach, 0 wyłącza (ETag/304 działają nadal)
+    'PAGE_CACHE_MAX_BYTES': 32 * 1024 * 1024,
+
+    # Limit rozmiaru pamięci podręcznej eksportów ZIP (w bajtach)
+    'EXPORT_CACHE_MAX_BYTES': 512 * 1024 * 1024,
+
+    # Limit rozmiaru katalogu miniatur oraz liczba wątków, które je generują
+    'THUMBNAIL_CACHE_MAX_BYTES': 256 * 1024 * 1024,
+    'THUMBNAIL_WORKERS': 2,
+
+    # Liczba wierszy zapisywanych w jednej transakcji przy imporcie i pobieranych naraz przy eksporcie
+    'IMPORT_CHUNK_SIZE': 1000,
+
+    # API JSON: domyślna i maksymalna liczba wierszy na stronie oraz maksymalna liczba pozycji w żądaniu zbiorczym
+    'API_PAGE_SIZE': 100,
+    'API_PAGE_SIZE_MAX': 1000,
+    'API_BATCH_MAX': 1000,
+
+    # Liczba procesów analizujących geometrię plików DXF
+    'DXF_WORKERS': 2,
+
+    # Zadania w tle (oferty TXT, eksport zamówień): liczba wątków w każdym procesie aplikacji
+    # (0 – zadania wykonuje tylko "flask jobs-worker"), odstęp sprawdzania kolejki (s),
+    # liczba prób z odstępem rosnącym od JOB_RETRY_SECONDS, czas, po którym zadanie "w toku"
+    # uznaje się za porzucone (np. po zabiciu procesu), czas oczekiwania na bieżące zadania przy
+    # zamykaniu procesu (potem wracają do kolejki) i czas przechowywania wyników
+    'JOB_WORKERS': 2,
+    'JOB_POLL_SECONDS': 5,
+    'JOB_MAX_ATTEMPTS': 3,
+    'JOB_RETRY_SECONDS': 10,
+    'JOB_TIMEOUT_SECONDS': 30 * 60,
+    'JOB_STOP_SECONDS': 20,
+    'JOB_RETENTION_SECONDS': 24 * 3600,
+
+    # Serwowanie plików: pliki z magazynu nie zmieniają się, więc przeglądarka może je trzymać rok.
+    # USE_X_SENDFILE (Apache/lighttpd) lub X_ACCEL_REDIRECT_PREFIX (nginx, np. '/_uploads')
+    # przekazują wysyłkę pliku serwerowi przed aplikacją.
+    'FILES_MAX_AGE': 365 * 24 * 3600,
+    'USE_X_SENDFILE': False,
+    'X_ACCEL_REDIRECT_PREFIX': None,
+
+    # Kompilacja wszystkich szablonów przy starcie (przed fork() w trybie produkcyjnym)
+    'PRELOAD_TEMPLATES': True,
+
+    # Metryki Prometheusa pod /metrics. Przy kilku procesach METRICS_DIR wskazuje katalog,
+    # przez który workery składają wspólny wynik (ustawiany w gunicorn.conf.py).
+    'METRICS_ENABLED': True,
+    'METRICS_DIR': None,
+    'METRICS_FLUSH_SECONDS': 5,
+    # Zapytania SQL dłuższe niż próg (w sekundach) trafiają do logu razem z treścią
+    'SLOW_QUERY_SECONDS': 0.25,
+    # Nagłówki X-Query-Count i X-Query-Time z liczbą i czasem zapytań SQL żądania
+    'QUERY_COUNT_HEADER': True,
+
+    # Ustawienie tajnego klucza – w produkcji koniecznie nadpisać (BLACHY_SECRET_KEY)
+    'SECRET_KEY': 'your_secret_key',
+}
+
+db = SQLAlchemy()
+
+# Wszystkie widoki i komendy CLI aplikacji; komendy rejestrowane bez grupy (flask migrate, ...)
+bp = Blueprint('main', __name__, cli_group=None)
+
+# Pliki blach przechowywane są w magazynie adresowanym treścią (podkatalogi wg skrótu).
+# Obiekty tworzone są w create_app(), tu dostęp do instancji bieżącej aplikacji.
+blob_store = LocalProxy(lambda: current_app.extensions['blob_store'])
+thumbnail_cache = LocalProxy(lambda: current_app.extensions['thumbnail_cache'])
+export_cache = LocalProxy(lambda: current_app.extensions['export_cache'])
+job_artifacts = LocalProxy(lambda: current_app.extensions['job_artifacts'])
+
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_mapping(DEFAULT_CONFIG)
+    app.config['UPLOAD_FOLDER'] = os.path.join(app.root_path, 'uploads')
+    app.config.from_prefixed_env('BLACHY')
+    if config:
+        app.config.from_mapping(config)
+
+    upload_folder = app.config['UPLOAD_FOLDER']
+    os.makedirs(upload_folder, exist_ok=True)
+
+    db.init_app(app)
+    metryki = app.extensions['metrics'] = _utworz_metryki(app)
+    with app.app_context():
+        db.event.listen(db.engine, 'connect', _pragmy_sqlite(app.config['SQLITE_PRAGMAS']))
+        db.event.listen(db.engine, 'after_execute', _oznacz_zmiane_danych)
+        db.event.listen(db.engine, 'commit', _zatwierdz_zmiane_danych)
+        db.event.listen(db.engine, 'rollback', _porzuc_zmiane_danych)
+        if app.config['METRICS_ENABLED']:
+            _licz_zapytania(db.engine, metryki, app.logger, app.config['SLOW_QUERY_SECONDS'])
+
+    app.extensions['blob_store'] = BlobStore(upload_folder)
+    app.extensions['thumbnail_cache'] = ThumbnailCache(os.path.join(upload_folder, "thumbnails"),
+                                                       app.config['THUMBNAIL_CACHE_MAX_BYTES'],
+                                                       workers=app.config['THUMBNAIL_WORKERS'])
+    app.extensions['export_cache'] = ExportCache(os.path.join(upload_folder, "exports"),
+                                                 app.config['EXPORT_CACHE_MAX_BYTES'])
+    app.extensions['slowniki'] = SlownikiCache()
+    app.extensions['page_cache'] = PageCache(app.config['PAGE_CACHE_MAX_BYTES'])
+    app.extensions['job_artifacts'] = ArtifactStore(os.path.join(upload_folder, "jobs"))
+    app.extensions['job_workers'] = JobWorkers(lambda: wykonaj_nastepne_zadanie(app),
+                                               workers=app.config['JOB_WORKERS'],
+                                               poll_interval=app.config['JOB_POLL_SECONDS'])
+
+    app.register_blueprint(bp)
+
+    if app.config['PRELOAD_TEMPLATES']:
+        # Skompilowane szablony trafiają do pamięci podręcznej Jinja i są dziedziczone przez workery
+        for name in app.jinja_env.list_templates():
+            app.jinja_env.get_template(name)
+    return app
+
+def _utworz_metryki(app):
+    metryki = Metrics(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_SECONDS'])
+    metryki.histogram('blachy_http_request_duration_seconds', 'Czas obsługi żądania (z wysłaniem treści).')
+    metryki.histogram('blachy_http_request_sql_queries', 'Liczba zapytań SQL na żądanie.', QUERY_COUNT_BUCKETS)
+    metryki.histogram('blachy_http_request_sql_seconds', 'Łączny czas zapytań SQL na żądanie.')
+    metryki.counter('blachy_sql_statements_total', 'Wykonane zapytania SQL.')
+    metryki.counter('blachy_sql_slow_statements_total', 'Zapytania SQL dłuższe niż SLOW_QUERY_SECONDS.')
+    metryki.counter('blachy_file_bytes_total', 'Bajty plików przyjęte lub wysłane przez aplikację.')
+    metryki.counter('blachy_file_operations_total', 'Liczba operacji na plikach.')
+    metryki.counter('blachy_jobs_total', 'Zakończone próby zadań w tle wg rodzaju i wyniku.')
+    metryki.histogram('blachy_job_duration_seconds', 'Czas wykonania zadania w tle.')
+    return metryki
+
+# Czas i liczba zapytań SQL ze zdarzeń silnika; sumy dla bieżącego żądania w g
+def _licz_zapytania(engine, metryki, logger, prog):
+    def przed(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metryki_start', []).append(time.perf_counter())
+
+    def po(conn, cursor, statement, parameters, context, executemany):
+        czas = time.perf_counter() - conn.info['metryki_start'].pop()
+        metryki.inc('blachy_sql_statements_total')
+        if has_app_context() and 'sql_liczba' in g:
+            g.sql_liczba += 1
+            g.sql_czas += czas
+        if czas >= prog:
+            metryki.inc('blachy_sql_slow_statements_total')
+            logger.warning("Wolne zapytanie SQL (%.3f s): %s | parametry: %.500r", czas, statement,
+                           parameters)
+
+    db.event.listen(engine, 'before_cursor_execute', przed)
+    db.event.listen(engine, 'after_cursor_execute', po)
+
+def _pragmy_sqlite(pragmas):
+    def ustaw(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+        cursor.close()
+    return ustaw
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -55,31 +267,42 @@ class Blacha(db.Model):
     pdf_filename = db.Column(db.String(200), nullable=True)
     dxf_filename = db.Column(db.String(200), nullable=True)
     image_filename = db.Column(db.String(200), nullable=True)
+    # Suma niezrealizowanych pozycji projektów, utrzymywana przez zdarzenia ProjectItem
+    zapotrzebowanie = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     project_items = db.relationship("ProjectItem", back_populates="blacha", lazy=True)
+    geometria = db.relationship("DxfGeometria", uselist=False, viewonly=True,
+                                primaryjoin="foreign(Blacha.dxf_filename) == DxfGeometria.plik")
+
+    __table_args__ = (
+        # Indeks pokrywający dla wyszukiwania braków (stan_obecny < zapotrzebowanie)
+        db.Index('ix_blacha_zapotrzebowanie_stan', 'zapotrzebowanie', 'stan_obecny'),
+        # Id usuniętej blachy nie jest nadawany ponownie – jej ruchy zostają w księdze
+        {'sqlite_autoincrement': True},
+    )
 
     @property
     def material(self):
         if self.material_id:
-            m = db.session.get(MaterialOption, self.material_id)
-            return m.nazwa if m else None
+            return slowniki().materialy.get(self.material_id)
         return None
 
     @property
     def grubosc(self):
         if self.thickness_id:
-            t = ThicknessOption.query.get(self.thickness_id)
-            return t.wartosc if t else None
+            return slowniki().grubosci.get(self.thickness_id)
         return None
 
     @property
     def stan_potrzebny(self):
-        return sum(item.ilosc for item in self.project_items if not item.fulfilled)
+        return self.zapotrzebowanie or 0
 
 class Project(db.Model):
     __tablename__ = 'project'
     __table_args__ = {'extend_existing': True}
     id = db.Column(db.Integer, primary_key=True)
     nazwa = db.Column(db.String(100), nullable=False)
+    # Pozycje projektów zarchiwizowanych leżą w project_item_archive (archiwizuj_projekty)
+    archived = db.Column(db.Boolean, nullable=False, default=False, server_default='0', index=True)
     items = db.relationship("ProjectItem", backref="project", lazy=True)
 
 class ProjectItem(db.Model):
@@ -91,10 +314,205 @@ class ProjectItem(db.Model):
     fulfilled = db.Column(db.Boolean, default=False)
     blacha = db.relationship("Blacha", back_populates="project_items")
 
+    __table_args__ = (
+        # Indeks pokrywający dla sum zapotrzebowania po blasze
+        db.Index('ix_project_item_blacha_fulfilled', 'blacha_id', 'fulfilled', 'ilosc'),
+        db.Index('ix_project_item_project_id', 'project_id'),
+    )
+
+# Pozycje zarchiwizowanych projektów – poza project_item, więc zapytania o zapotrzebowanie
+# i planowanie nie przechodzą przez lata zakończonych projektów. fulfilled to stan sprzed
+# archiwizacji, przywracany razem z pozycją.
+class ProjectItemArchive(db.Model):
+    __tablename__ = 'project_item_archive'
+    id = db.Column(db.Integer, primary_key=True)
+    project_id = db.Column(db.Integer, db.ForeignKey("project.id"), nullable=False, index=True)
+    blacha_id = db.Column(db.Integer, db.ForeignKey("blacha.id"), nullable=False, index=True)
+    ilosc = db.Column(db.Integer, nullable=False)
+    fulfilled = db.Column(db.Boolean, default=False)
+    zarchiwizowano = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    blacha = db.relationship("Blacha", viewonly=True)
+
+# Licznik zapotrzebowania – każda zmiana ProjectItem koryguje Blacha.zapotrzebowanie
+# o różnicę, w tej samej transakcji co zapis pozycji.
+def _wklad_pozycji(ilosc, fulfilled):
+    return 0 if fulfilled or not ilosc else ilosc
+
+def _zmien_zapotrzebowanie(connection, blacha_id, delta):
+    if blacha_id is None or not delta:
+        return
+    t = Blacha.__table__
+    connection.execute(
+        t.update().where(t.c.id == blacha_id).values(zapotrzebowanie=t.c.zapotrzebowanie + delta)
+    )
+
+def _poprzednia_wartosc(target, attr):
+    history = db.inspect(target).attrs[attr].history
+    return history.deleted[0] if history.deleted else getattr(target, attr)
+
+@db.event.listens_for(ProjectItem, 'after_insert')
+def _project_item_inserted(mapper, connection, target):
+    _zmien_zapotrzebowanie(connection, target.blacha_id, _wklad_pozycji(target.ilosc, target.fulfilled))
+
+@db.event.listens_for(ProjectItem, 'after_delete')
+def _project_item_deleted(mapper, connection, target):
+    _zmien_zapotrzebowanie(connection, target.blacha_id, -_wklad_pozycji(target.ilosc, target.fulfilled))
+
+@db.event.listens_for(ProjectItem, 'after_update')
+def _project_item_updated(mapper, connection, target):
+    old_blacha_id = _poprzednia_wartosc(target, 'blacha_id')
+    old_wklad = _wklad_pozycji(_poprzednia_wartosc(target, 'ilosc'), _poprzednia_wartosc(target, 'fulfilled'))
+    new_wklad = _wklad_pozycji(target.ilosc, target.fulfilled)
+    if old_blacha_id == target.blacha_id:
+        _zmien_zapotrzebowanie(connection, target.blacha_id, new_wklad - old_wklad)
+    else:
+        # Pozycja przepięta na inną blachę
+        _zmien_zapotrzebowanie(connection, old_blacha_id, -old_wklad)
+        _zmien_zapotrzebowanie(connection, target.blacha_id, new_wklad)
+
+# Wartości pomocnicze aplikacji (klucz -> liczba), np. wersja słowników
+class AppMeta(db.Model):
+    __tablename__ = 'app_meta'
+    klucz = db.Column(db.String(50), primary_key=True)
+    wartosc = db.Column(db.Integer, nullable=False, default=0)
+
+# Wszystkie wersje z app_meta jednym zapytaniem, raz na żądanie
+def wersje():
+    if 'wersje' not in g:
+        g.wersje = dict(db.session.execute(db.select(AppMeta.klucz, AppMeta.wartosc)).all())
+    return g.wersje
+
+def podbij_wersje(connection, klucz):
+    t = AppMeta.__table__
+    stmt = sqlite_insert(t).values(klucz=klucz, wartosc=1)
+    connection.execute(stmt.on_conflict_do_update(index_elements=['klucz'],
+                                                  set_={'wartosc': t.c.wartosc + 1}))
+    # Ponowne sprawdzenie wersji jeszcze w tym samym żądaniu
+    if has_app_context():
+        g.pop('wersje', None)
+
+# SŁOWNIKI MATERIAŁÓW I GRUBOŚCI
+
+# Materiały i grubości trzymane są w pamięci workera (id -> nazwa). Każdy zapis do tych tabel
+# podnosi wersję w app_meta; raz na żądanie porównujemy ją z wersją w pamięci i w razie
+# różnicy wczytujemy słowniki ponownie – także gdy zapisu dokonał inny proces.
+WERSJA_SLOWNIKOW = 'slowniki'
+
+class SlownikiCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wersja = None
+        self.materialy = {}
+        self.grubosci = {}
+
+def slowniki():
+    cache = current_app.extensions['slowniki']
+    wersja = wersje().get(WERSJA_SLOWNIKOW, 0)
+    with cache.lock:
+        if wersja != cache.wersja:
+            cache.materialy = dict(db.session.execute(db.select(MaterialOption.id, MaterialOption.nazwa)).all())
+            cache.grubosci = dict(db.session.execute(db.select(ThicknessOption.id, ThicknessOption.wartosc)).all())
+            cache.wersja = wersja
+    return cache
+
+@db.event.listens_for(MaterialOption, 'after_insert')
+@db.event.listens_for(MaterialOption, 'after_update')
+@db.event.listens_for(MaterialOption, 'after_delete')
+@db.event.listens_for(ThicknessOption, 'after_insert')
+@db.event.listens_for(ThicknessOption, 'after_update')
+@db.event.listens_for(ThicknessOption, 'after_delete')
+def _slownik_zmieniony(mapper, connection, target):
+    podbij_wersje(connection, WERSJA_SLOWNIKOW)
+
+# WERSJA DANYCH
+
+# Licznik w app_meta podnoszony raz przy zatwierdzeniu każdej transakcji, która zmieniła blachy,
+# projekty, zamówienia lub słowniki – niezależnie od ścieżki zapisu (ORM, zapytania zbiorcze przez
+# sesję lub połączenie, zdarzenia mapperów), bo zmiany wyłapują zdarzenia silnika. Strony list
+# (strona_wersjonowana) używają go jako ETagu i klucza pamięci wyrenderowanych stron.
+WERSJA_DANYCH = 'dane'
+TABELE_WERSJI_DANYCH = frozenset({'blacha', 'project', 'project_item', 'order', 'order_item',
+                                  'material_option', 'thickness_option'})
+
+def _oznacz_zmiane_danych(conn, clauseelement, multiparams, params, execution_options, result):
+    if getattr(clauseelement, 'is_dml', False) and clauseelement.table.name in TABELE_WERSJI_DANYCH:
+        conn.info['dane_zmienione'] = True
+
+# Tuż przed COMMIT, w tej samej transakcji – wersja i zmiany stają się widoczne razem
+def _zatwierdz_zmiane_danych(conn):
+    if conn.info.pop('dane_zmienione', False):
+        podbij_wersje(conn, WERSJA_DANYCH)
+
+def _porzuc_zmiane_danych(conn):
+    conn.info.pop('dane_zmienione', None)
+
+def wersja_danych():
+    return wersje().get(WERSJA_DANYCH, 0)
+
+page_cache = LocalProxy(lambda: current_app.extensions['page_cache'])
+
+# Strona listy z ETagiem z wersji danych: dopóki dane się nie zmienią, przeglądarka dostaje 304,
+# a nowy klient treść z pamięci procesu – w obu przypadkach jedynym zapytaniem jest odczyt wersji.
+# Odpowiedź wyświetlająca komunikaty (flash) nie jest zapamiętywana – szablony tych stron
+# je pokazują i zdejmują z sesji, więc kolejne wejście znów korzysta z pamięci podręcznej.
+def strona_wersjonowana(widok):
+    @functools.wraps(widok)
+    def opakowanie(*args, **kwargs):
+        if '_flashes' in session:
+            return widok(*args, **kwargs)
+        wersja = wersja_danych()
+        klucz = request.full_path
+        etag = hashlib.sha1(f"{page_cache.token}:{wersja}:{klucz}".encode()).hexdigest()[:24]
+        if etag in request.if_none_match:
+            response = current_app.response_class(status=304)
+        else:
+            body = page_cache.get(klucz, wersja)
+            if body is None:
+                response = current_app.make_response(widok(*args, **kwargs))
+                if response.status_code != 200 or session.modified:
+                    return response
+                page_cache.put(klucz, wersja, response.get_data())
+            else:
+                response = current_app.response_class(body, mimetype='text/html')
+        response.set_etag(etag)
+        # Przeglądarka sprawdza stronę przy każdym wyświetleniu, zamiast pokazywać starą kopię
+        response.cache_control.no_cache = True
+        return response
+    return opakowanie
+
+class Blob(db.Model):
+    __tablename__ = 'blob'
+    key = db.Column(db.String(80), primary_key=True)
+    rozmiar = db.Column(db.Integer, nullable=False)
+    # Liczba kolumn blach wskazujących na ten plik
+    liczba_odwolan = db.Column(db.Integer, nullable=False, default=0)
+    nazwa_oryginalna = db.Column(db.String(200), nullable=True)
+
+# Geometria pliku DXF; plik to wartość Blacha.dxf_filename (dla magazynu – skrót treści)
+class DxfGeometria(db.Model):
+    __tablename__ = 'dxf_geometria'
+    plik = db.Column(db.String(200), primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False)
+    szerokosc = db.Column(db.Float, nullable=True)
+    wysokosc = db.Column(db.Float, nullable=True)
+    dlugosc_ciecia = db.Column(db.Float, nullable=True, index=True)
+    pole_netto = db.Column(db.Float, nullable=True, index=True)
+    liczba_otworow = db.Column(db.Integer, nullable=True, index=True)
+    liczba_konturow = db.Column(db.Integer, nullable=True)
+    liczba_elementow = db.Column(db.Integer, nullable=True)
+    # Liczba encji wg typu, JSON np. {"LINE": 4, "CIRCLE": 1}
+    elementy = db.Column(db.Text, nullable=True)
+    blad = db.Column(db.Text, nullable=True)
+    przetworzono = db.Column(db.DateTime, default=datetime.utcnow)
+
 class Order(db.Model):
     __tablename__ = 'order'
     id = db.Column(db.Integer, primary_key=True)
-    order_date = db.Column(db.DateTime, default=datetime.utcnow)
+    order_date = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    # Podsumowanie pozycji utrzymywane przy zapisie (przelicz_podsumowanie_zamowien)
+    liczba_pozycji = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    suma_sztuk = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    liczba_materialow = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     items = db.relationship("OrderItem", backref="order", lazy=True)
 
 class OrderItem(db.Model):
@@ -105,40 +523,1506 @@ class OrderItem(db.Model):
     quantity = db.Column(db.Integer, nullable=False)
     blacha = db.relationship("Blacha")
 
+    __table_args__ = (
+        db.Index('ix_order_item_order_id', 'order_id', 'blacha_id', 'quantity'),
+    )
+
+# Szkic zamówienia (oferta -> zamówienie) przechowywany w bazie; w sesji tylko token
+class DraftOrder(db.Model):
+    __tablename__ = 'draft_order'
+    id = db.Column(db.Integer, primary_key=True)
+    token = db.Column(db.String(32), unique=True, nullable=False)
+    zmieniono = db.Column(db.DateTime, default=datetime.utcnow, nullable=False, index=True)
+
+class DraftOrderLine(db.Model):
+    __tablename__ = 'draft_order_line'
+    id = db.Column(db.Integer, primary_key=True)
+    draft_id = db.Column(db.Integer, db.ForeignKey("draft_order.id"), nullable=False)
+    blacha_id = db.Column(db.Integer, db.ForeignKey("blacha.id"), nullable=False)
+    ilosc = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_draft_order_line_draft_id', 'draft_id', 'blacha_id'),
+    )
+
+# Księga ruchów magazynowych: każda zmiana stan_obecny zapisywana jest jako ruch (tylko dopisywanie).
+# stan_obecny pozostaje szybką kopią sumy ruchów blachy.
+class StockMovement(db.Model):
+    __tablename__ = 'stock_movement'
+    id = db.Column(db.Integer, primary_key=True)
+    blacha_id = db.Column(db.Integer, db.ForeignKey("blacha.id"), nullable=False)
+    czas = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    delta = db.Column(db.Integer, nullable=False)
+    # utworzenie, korekta, zamowienie, zuzycie, import, bilans_otwarcia, wyrownanie, usuniecie
+    rodzaj = db.Column(db.String(20), nullable=False)
+    order_id = db.Column(db.Integer, nullable=True)
+    opis = db.Column(db.String(200), nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_stock_movement_blacha_id', 'blacha_id', 'id'),
+    )
+
+# Migawka stanów: stan każdej blachy po ruchu ostatni_ruch_id (blachy ze stanem 0 pomijane).
+# Stan na dowolną chwilę to najbliższa wcześniejsza migawka plus ruchy do następnej.
+class StockSnapshot(db.Model):
+    __tablename__ = 'stock_snapshot'
+    id = db.Column(db.Integer, primary_key=True)
+    czas = db.Column(db.DateTime, nullable=False, index=True)
+    ostatni_ruch_id = db.Column(db.Integer, nullable=False)
+
+class StockSnapshotLine(db.Model):
+    __tablename__ = 'stock_snapshot_line'
+    snapshot_id = db.Column(db.Integer, db.ForeignKey("stock_snapshot.id"), primary_key=True)
+    blacha_id = db.Column(db.Integer, primary_key=True)
+    stan = db.Column(db.Integer, nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_stock_snapshot_line_blacha_id', 'blacha_id'),
+    )
+
+# Zadanie w tle (oferta TXT, eksport zamówienia); wynik w UPLOAD_FOLDER/jobs/<id>/<plik>
+class Job(db.Model):
+    __tablename__ = 'job'
+    id = db.Column(db.Integer, primary_key=True)
+    rodzaj = db.Column(db.String(30), nullable=False)
+    # Parametry jako JSON (klucze posortowane – identyczne zlecenia mają identyczny tekst)
+    parametry = db.Column(db.Text, nullable=False)
+    # oczekuje, w_toku, gotowe, blad
+    stan = db.Column(db.String(12), nullable=False, default='oczekuje')
+    proby = db.Column(db.Integer, nullable=False, default=0)
+    utworzono = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    nastepna_proba = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    rozpoczeto = db.Column(db.DateTime, nullable=True)
+    zakonczono = db.Column(db.DateTime, nullable=True, index=True)
+    blad = db.Column(db.Text, nullable=True)
+    plik = db.Column(db.String(200), nullable=True)
+    rozmiar = db.Column(db.Integer, nullable=True)
+
+    __table_args__ = (
+        db.Index('ix_job_stan_nastepna_proba', 'stan', 'nastepna_proba'),
+    )
+
+# WYSZUKIWANIE BLACH
+
+# Indeks pełnotekstowy FTS5 nad kolumnami blachy (tabela zewnętrzna, treść w tabeli blacha).
+# Wyzwalacze utrzymują go przy każdym INSERT/UPDATE/DELETE, także przy zapisie zbiorczym.
+FTS_KOLUMNY = ('kod', 'nazwa', 'nazwa_prosta', 'rodzaj_obrobki')
+# Wagi kolumn w rankingu bm25 – trafienie w kodzie liczy się najbardziej
+FTS_WAGI = (10.0, 3.0, 2.0, 1.0)
+
+# unicode61 usuwa znaki diakrytyczne (ą, ó, ż...), ale "ł" to osobna litera – zamieniamy ją
+# na "l" w indeksie i w zapytaniu, żeby "oslona" znajdowało "Osłona"
+def _fts_wartosci(wiersz):
+    return ', '.join(f"replace(replace({wiersz}.{k}, 'ł', 'l'), 'Ł', 'L')" for k in FTS_KOLUMNY)
+
+def _fts_ddl():
+    kolumny = ', '.join(FTS_KOLUMNY)
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS blacha_fts USING fts5({kolumny}, content='blacha', "
+        f"content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+        f"CREATE TRIGGER IF NOT EXISTS blacha_fts_ai AFTER INSERT ON blacha BEGIN "
+        f"INSERT INTO blacha_fts(rowid, {kolumny}) VALUES (new.id, {_fts_wartosci('new')}); END",
+        f"CREATE TRIGGER IF NOT EXISTS blacha_fts_ad AFTER DELETE ON blacha BEGIN "
+        f"INSERT INTO blacha_fts(blacha_fts, rowid, {kolumny}) VALUES ('delete', old.id, {_fts_wartosci('old')}); END",
+        f"CREATE TRIGGER IF NOT EXISTS blacha_fts_au AFTER UPDATE OF {kolumny} ON blacha BEGIN "
+        f"INSERT INTO blacha_fts(blacha_fts, rowid, {kolumny}) VALUES ('delete', old.id, {_fts_wartosci('old')}); "
+        f"INSERT INTO blacha_fts(rowid, {kolumny}) VALUES (new.id, {_fts_wartosci('new')}); END",
+    ]
+
+# Pełne odbudowanie indeksu z tabeli blacha (z tą samą zamianą "ł" co w wyzwalaczach)
+def _fts_odbuduj(conn):
+    conn.exec_driver_sql("INSERT INTO blacha_fts(blacha_fts) VALUES ('delete-all')")
+    conn.exec_driver_sql(f"INSERT INTO blacha_fts(rowid, {', '.join(FTS_KOLUMNY)}) "
+                         f"SELECT blacha.id, {_fts_wartosci('blacha')} FROM blacha")
+
+for _ddl in _fts_ddl():
+    db.event.listen(Blacha.__table__, 'after_create', db.DDL(_ddl).execute_if(dialect='sqlite'))
+db.event.listen(Blacha.__table__, 'before_drop', db.DDL("DROP TABLE IF EXISTS blacha_fts").execute_if(dialect='sqlite'))
+
+# Wyrażenie MATCH dla wyszukiwania od początku słów: "sta 3" -> "sta"* AND "3"*.
+# unicode61 dzieli tekst na znakach innych niż litery i cyfry, więc kod "A-001" leży w indeksie
+# jako tokeny "a" i "001" – wpisany kod dzielimy tak samo, na frazę kolejnych tokenów:
+# "B.0" -> "B 0"* (ostatni token jako przedrostek)
+def _zapytanie_fts(tekst):
+    tekst = tekst.replace('ł', 'l').replace('Ł', 'L')
+    frazy = [' '.join(re.findall(r'[^\W_]+', slowo)) for slowo in tekst.split()]
+    return ' AND '.join(f'"{fraza}"*' for fraza in frazy if fraza)
+
+def szukaj_blach(tekst, limit):
+    wyrazenie = _zapytanie_fts(tekst)
+    if not wyrazenie:
+        return []
+    fts = db.table('blacha_fts', db.column('rowid'))
+    ranking = db.func.bm25(db.literal_column('blacha_fts'), *FTS_WAGI)
+    stmt = (
+        db.select(Blacha.id, Blacha.kod, Blacha.nazwa, Blacha.nazwa_prosta, Blacha.material_id,
+                  Blacha.thickness_id, Blacha.stan_obecny)
+        .join(fts, fts.c.rowid == Blacha.id)
+        .where(db.literal_column('blacha_fts').op('MATCH')(wyrazenie))
+        .order_by(ranking, Blacha.kod)
+        .limit(limit)
+    )
+    return db.session.execute(stmt).all()
+
+# METRYKI
+
+metryki = LocalProxy(lambda: current_app.extensions['metrics'])
+
+@bp.before_app_request
+def _start_pomiaru():
+    g.start_zadania = time.perf_counter()
+    g.sql_liczba = 0
+    g.sql_czas = 0.0
+
+@bp.after_app_request
+def _koniec_pomiaru(response):
+    if 'start_zadania' not in g or not current_app.config['METRICS_ENABLED']:
+        return response
+    endpoint = request.endpoint or 'brak'
+    if current_app.config['QUERY_COUNT_HEADER']:
+        response.headers['X-Query-Count'] = str(g.sql_liczba)
+        response.headers['X-Query-Time'] = f"{g.sql_czas * 1000:.1f}ms"
+    current_app.logger.debug("%s %s: %d zapytań SQL, %.1f ms", request.method, request.path,
+                             g.sql_liczba, g.sql_czas * 1000)
+    m = current_app.extensions['metrics']
+    m.observe('blachy_http_request_sql_queries', g.sql_liczba, endpoint=endpoint)
+    m.observe('blachy_http_request_sql_seconds', g.sql_czas, endpoint=endpoint)
+    start, metoda, status = g.start_zadania, request.method, response.status_code
+
+    # Czas liczony do zamknięcia odpowiedzi, więc obejmuje też wysyłanie strumieni (ZIP, eksport)
+    def zakoncz():
+        m.observe('blachy_http_request_duration_seconds', time.perf_counter() - start,
+                  endpoint=endpoint, method=metoda, status=status)
+        m.flush()
+
+    response.call_on_close(zakoncz)
+    return response
+
+def dodaj_bajty(operacja, liczba):
+    metryki.inc('blachy_file_bytes_total', liczba, operacja=operacja)
+    metryki.inc('blachy_file_operations_total', operacja=operacja)
+
+# Przekazuje fragmenty dalej, licząc wysłane bajty (generator działa już po zakończeniu żądania,
+# dlatego obiekt metryk pobieramy wcześniej)
+def licz_bajty(operacja, chunks):
+    m = metryki._get_current_object()
+
+    def generator():
+        wyslane = 0
+        try:
+            for chunk in chunks:
+                wyslane += len(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+                yield chunk
+        finally:
+            m.inc('blachy_file_bytes_total', wyslane, operacja=operacja)
+            m.inc('blachy_file_operations_total', operacja=operacja)
+    return generator()
+
+@bp.route('/metrics')
+def metrics():
+    if not current_app.config['METRICS_ENABLED']:
+        abort(404)
+    return Response(metryki.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+# MAGAZYN PLIKÓW
+
+BLOB_COLUMNS = ('pdf_filename', 'dxf_filename', 'image_filename')
+
+# Zapisuje przesłany plik w magazynie i zwiększa licznik odwołań do niego
+def zapisz_blob(file_storage):
+    nazwa = secure_filename(file_storage.filename)
+    ext = nazwa.rsplit('.', 1)[1].lower() if '.' in nazwa else 'bin'
+    key, size = blob_store.put(file_storage.stream, ext)
+    dodaj_bajty('upload', size)
+    return dodaj_odwolanie(key, size, nazwa)
+
+# Licznik zmieniany w SQL (upsert), nie w obiekcie ORM – dwa równoległe pierwsze zapisy
+# tego samego pliku nie kończą się IntegrityError ani nie gubią odwołania
+def dodaj_odwolanie(key, size, nazwa):
+    t = Blob.__table__
+    stmt = sqlite_insert(t).values(key=key, rozmiar=size, liczba_odwolan=1, nazwa_oryginalna=nazwa)
+    db.session.execute(stmt.on_conflict_do_update(index_elements=['key'],
+                                                  set_={'liczba_odwolan': t.c.liczba_odwolan + 1}))
+    return key
+
+# Zmniejsza licznik odwołań; plik bez odwołań zostanie usunięty po zatwierdzeniu transakcji
+def zwolnij_blob(key):
+    if not is_blob_key(key):
+        return
+    t = Blob.__table__
+    pozostalo = db.session.execute(
+        t.update().where(t.c.key == key).values(liczba_odwolan=t.c.liczba_odwolan - 1)
+        .returning(t.c.liczba_odwolan)
+    ).scalar()
+    if pozostalo is not None and pozostalo <= 0:
+        db.session.execute(t.delete().where(t.c.key == key, t.c.liczba_odwolan <= 0))
+        db.session.info.setdefault('blobs_to_delete', set()).add(key)
+
+# Podpina nowy plik pod kolumnę blachy i zwalnia poprzedni
+def podmien_plik(blacha, column, file_storage):
+    old_key = getattr(blacha, column)
+    setattr(blacha, column, zapisz_blob(file_storage))
+    zwolnij_blob(old_key)
+
+@db.event.listens_for(db.session, 'after_commit')
+def _usun_osierocone_bloby(session):
+    keys = session.info.pop('blobs_to_delete', None)
+    if not keys:
+        return
+    _usun_pliki_bez_odwolan(keys)
+
+# Plik mógł zostać w międzyczasie dodany ponownie: sprawdzamy wiersze tabeli blob pod blokadą zapisu
+# (nikt nie zatwierdzi nowego odwołania do końca transakcji), a pliki ponownie użyte przez
+# blob_store.put() w ciągu BLOB_DELETE_GRACE_SECONDS zostają – ich odwołanie może być jeszcze
+# niezatwierdzone. Pominięte usuwa później "flask purge-blobs". Zwraca liczbę usuniętych plików.
+def _usun_pliki_bez_odwolan(keys):
+    grace = current_app.config['BLOB_DELETE_GRACE_SECONDS']
+    usuniete = 0
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+        try:
+            still_used = set(conn.execute(db.select(Blob.key).where(Blob.key.in_(keys))).scalars())
+            for key in set(keys) - still_used:
+                usuniete += blob_store.delete(key, min_age=grace)
+        finally:
+            conn.exec_driver_sql("COMMIT")
+    return usuniete
+
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def _porzuc_usuwanie_blobow(session, previous_transaction):
+    session.info.pop('blobs_to_delete', None)
+
+@bp.cli.command('purge-blobs')
+def purge_blobs_command():
+    """Usuwa z magazynu pliki, do których nie odwołuje się żadna blacha."""
+    keys = list(blob_store.keys())
+    usuniete = 0
+    for i in range(0, len(keys), 500):
+        usuniete += _usun_pliki_bez_odwolan(keys[i:i + 500])
+    click.echo(f"Usunięte pliki: {usuniete}")
+
+# Przenosi pliki zapisane pod starymi nazwami do magazynu adresowanego treścią
+@bp.cli.command('migrate-uploads')
+def migrate_uploads_command():
+    """Przenosi stare pliki z UPLOAD_FOLDER do magazynu plików."""
+    migrated = set()
+    for blacha in Blacha.query.all():
+        for column in BLOB_COLUMNS:
+            name = getattr(blacha, column)
+            if not name or is_blob_key(name):
+                continue
+            path = blob_store.path(name)
+            if not os.path.exists(path):
+                click.echo(f"{blacha.kod}: brak pliku {name}")
+                continue
+            ext = name.rsplit('.', 1)[1].lower() if '.' in name else 'bin'
+            key, size = blob_store.put_file(path, ext)
+            setattr(blacha, column, dodaj_odwolanie(key, size, name))
+            migrated.add(name)
+    db.session.commit()
+    for name in migrated:
+        os.remove(blob_store.path(name))
+    click.echo(f"Przeniesiono {len(migrated)} plików.")
+
+# GEOMETRIA DXF
+
+_dxf_lock = threading.Lock()
+_dxf_executor = None
+_dxf_executor_pid = None
+
+# Pula procesów tworzona leniwie w każdym procesie aplikacji; 'spawn' nie kopiuje stanu serwera
+def _dxf_pool():
+    global _dxf_executor, _dxf_executor_pid
+    with _dxf_lock:
+        if _dxf_executor is None or _dxf_executor_pid != os.getpid():
+            _dxf_executor = ProcessPoolExecutor(max_workers=current_app.config['DXF_WORKERS'],
+                                                mp_context=multiprocessing.get_context('spawn'))
+            _dxf_executor_pid = os.getpid()
+        return _dxf_executor
+
+def zapisz_geometrie(plik, sha, geometria, blad):
+    row = db.session.get(DxfGeometria, plik)
+    if row is None:
+        row = DxfGeometria(plik=plik)
+        db.session.add(row)
+    row.sha256 = sha
+    row.blad = blad
+    row.przetworzono = datetime.utcnow()
+    geometria = geometria or {}
+    for column in ('szerokosc', 'wysokosc', 'dlugosc_ciecia', 'pole_netto',
+                   'liczba_otworow', 'liczba_konturow', 'liczba_elementow'):
+        setattr(row, column, geometria.get(column))
+    row.elementy = json.dumps(geometria['elementy']) if geometria else None
+
+# Analiza DXF poza wątkiem żądania; wynik zapisywany jest po zakończeniu w osobnym kontekście
+def analizuj_dxf_w_tle(plik):
+    if is_blob_key(plik) and db.session.get(DxfGeometria, plik) is not None:
+        # Ten sam rysunek był już analizowany
+        return
+    future = _dxf_pool().submit(analyze_file, blob_store.path(plik))
+    app = current_app._get_current_object()
+
+    def zapisz(f):
+        try:
+            sha, geometria, blad = f.result()
+        except Exception:
+            app.logger.exception("Analiza DXF %s nie powiodła się", plik)
+            return
+        with app.app_context():
+            zapisz_geometrie(plik, sha, geometria, blad)
+            db.session.commit()
+
+    future.add_done_callback(zapisz)
+    return future
+
+@bp.cli.command('backfill-dxf')
+@click.option('--workers', type=int, default=None, help='Liczba procesów (domyślnie liczba rdzeni).')
+def backfill_dxf_command(workers):
+    """Analizuje geometrię wszystkich plików DXF, pomijając pliki bez zmian."""
+    pliki = db.session.execute(
+        db.select(Blacha.dxf_filename).where(Blacha.dxf_filename.is_not(None)).distinct()
+    ).scalars().all()
+    znane = dict(db.session.execute(db.select(DxfGeometria.plik, DxfGeometria.sha256)).all())
+    do_analizy = []
+    for plik in pliki:
+        path = blob_store.path(plik)
+        if not os.path.exists(path):
+            continue
+        sha = plik.split('.', 1)[0] if is_blob_key(plik) else file_sha256(path)
+        if znane.get(plik) != sha:
+            do_analizy.append(plik)
+    click.echo(f"Plików do analizy: {len(do_analizy)} (bez zmian: {len(pliki) - len(do_analizy)})")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        paths = [blob_store.path(plik) for plik in do_analizy]
+        for i, (plik, wynik) in enumerate(zip(do_analizy, pool.map(analyze_file, paths, chunksize=8)), start=1):
+            sha, geometria, blad = wynik
+            zapisz_geometrie(plik, sha, geometria, blad)
+            if blad:
+                click.echo(f"{plik}: {blad}")
+            if i % 100 == 0:
+                db.session.commit()
+    db.session.commit()
+
+# Pole blach (m²) i długość cięcia (m) wg materiału i grubości dla listy (blacha, ilość)
+def podsumowanie_geometrii(pozycje):
+    grupy = {}
+    for sheet, qty in pozycje:
+        g = grupy.setdefault((sheet.material or '-', sheet.grubosc or '-'),
+                             {'sztuk': 0, 'pole_m2': 0.0, 'ciecie_m': 0.0, 'bez_rysunku': 0})
+        g['sztuk'] += qty
+        geo = sheet.geometria
+        if geo is None or geo.pole_netto is None:
+            g['bez_rysunku'] += qty
+            continue
+        g['pole_m2'] += geo.pole_netto * qty / 1e6
+        g['ciecie_m'] += geo.dlugosc_ciecia * qty / 1e3
+    return [dict(material=k[0], grubosc=k[1], **v) for k, v in sorted(grupy.items())]
+
+# ZAPYTANIA ZBIORCZE
+
+# Stan magazynu jednym zapytaniem: kod, materiał, grubość, stan obecny oraz
+# zapotrzebowanie z niezrealizowanych pozycji projektów (licznik Blacha.zapotrzebowanie).
+# Stronicowanie po kluczu (after_id), więc koszt strony nie rośnie z katalogiem.
+def inventory_snapshot(after_id=None, limit=None, only_shortages=False):
+    stmt = (
+        db.select(
+            Blacha.id,
+            Blacha.kod,
+            Blacha.nazwa,
+            Blacha.nazwa_prosta,
+            Blacha.rodzaj_obrobki,
+            Blacha.stan_obecny,
+            Blacha.pdf_filename,
+            Blacha.dxf_filename,
+            Blacha.image_filename,
+            MaterialOption.nazwa.label('material'),
+            ThicknessOption.wartosc.label('grubosc'),
+            Blacha.zapotrzebowanie.label('stan_potrzebny'),
+        )
+        .outerjoin(MaterialOption, MaterialOption.id == Blacha.material_id)
+        .outerjoin(ThicknessOption, ThicknessOption.id == Blacha.thickness_id)
+        .order_by(Blacha.id)
+    )
+    if after_id is not None:
+        stmt = stmt.where(Blacha.id > after_id)
+    if only_shortages:
+        stmt = stmt.where(warunek_brakow())
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return db.session.execute(stmt).all()
+
+# Pełne przeliczenie licznika zapotrzebowania z pozycji projektów (opcjonalnie tylko wybrane blachy)
+def przelicz_zapotrzebowanie(blacha_ids=None):
+    db.session.execute(_zapytanie_przeliczenia(blacha_ids))
+
+def _zapytanie_przeliczenia(blacha_ids=None):
+    t = Blacha.__table__
+    suma = (
+        db.select(db.func.coalesce(db.func.sum(ProjectItem.ilosc), 0))
+        .where(ProjectItem.blacha_id == t.c.id, ProjectItem.fulfilled.is_not(True))
+        .scalar_subquery()
+    )
+    stmt = t.update().values(zapotrzebowanie=suma)
+    if blacha_ids is not None:
+        stmt = stmt.where(t.c.id.in_(list(blacha_ids)))
+    return stmt
+
+# Podsumowanie zamówień (liczba pozycji, suma sztuk, liczba różnych materiałów) liczone w bazie
+# jednym zapytaniem; wywoływane po każdej zmianie pozycji zamówienia
+def przelicz_podsumowanie_zamowien(order_ids=None):
+    db.session.execute(_zapytanie_podsumowania_zamowien(order_ids))
+
+def _zapytanie_podsumowania_zamowien(order_ids=None):
+    t = Order.__table__
+    pozycje = OrderItem.__table__
+    liczba = db.select(db.func.count(pozycje.c.id)).where(pozycje.c.order_id == t.c.id).scalar_subquery()
+    suma = (
+        db.select(db.func.coalesce(db.func.sum(pozycje.c.quantity), 0))
+        .where(pozycje.c.order_id == t.c.id)
+        .scalar_subquery()
+    )
+    materialy = (
+        db.select(db.func.count(db.distinct(Blacha.material_id)))
+        .select_from(pozycje.join(Blacha.__table__, Blacha.id == pozycje.c.blacha_id))
+        .where(pozycje.c.order_id == t.c.id)
+        .scalar_subquery()
+    )
+    stmt = t.update().values(liczba_pozycji=liczba, suma_sztuk=suma, liczba_materialow=materialy)
+    if order_ids is not None:
+        stmt = stmt.where(t.c.id.in_(list(order_ids)))
+    return stmt
+
+# Blachy, dla których zapisany licznik różni się od sumy pozycji projektów
+def rozbieznosci_zapotrzebowania():
+    demand = (
+        db.select(ProjectItem.blacha_id, db.func.sum(ProjectItem.ilosc).label('suma'))
+        .where(ProjectItem.fulfilled.is_not(True))
+        .group_by(ProjectItem.blacha_id)
+        .subquery()
+    )
+    faktyczne = db.func.coalesce(demand.c.suma, 0)
+    stmt = (
+        db.select(Blacha.id, Blacha.kod, Blacha.zapotrzebowanie, faktyczne.label('faktyczne'))
+        .outerjoin(demand, demand.c.blacha_id == Blacha.id)
+        .where(Blacha.zapotrzebowanie != faktyczne)
+        .order_by(Blacha.id)
+    )
+    return db.session.execute(stmt).all()
+
+@bp.cli.command('rebuild-demand')
+@click.option('--verify', is_flag=True, help='Tylko sprawdź licznik, bez zapisu.')
+def rebuild_demand_command(verify):
+    """Przelicza (lub sprawdza) zapotrzebowanie wszystkich blach."""
+    rozbieznosci = rozbieznosci_zapotrzebowania()
+    for r in rozbieznosci:
+        click.echo(f"{r.kod}: zapisane {r.zapotrzebowanie}, faktyczne {r.faktyczne}")
+    if verify:
+        click.echo(f"Rozbieżności: {len(rozbieznosci)}")
+        if rozbieznosci:
+            raise SystemExit(1)
+        return
+    przelicz_zapotrzebowanie()
+    db.session.commit()
+    click.echo(f"Przeliczono zapotrzebowanie, poprawiono {len(rozbieznosci)} blach.")
+
+# ARCHIWUM PROJEKTÓW
+
+# Archiwizacja i przywracanie projektów zapytaniami zbiorczymi: pozycje przenoszone są między
+# project_item i project_item_archive, a licznik zapotrzebowania korygowany jednym UPDATE
+# (zdarzenia ProjectItem nie są wywoływane). Zatwierdzenie transakcji po stronie wywołującego.
+def _korekta_zapotrzebowania(pozycje, project_ids, znak):
+    # Blacha.zapotrzebowanie += znak * suma niezrealizowanych pozycji wskazanych projektów
+    t = Blacha.__table__
+    niezrealizowane = db.and_(pozycje.c.project_id.in_(project_ids), pozycje.c.fulfilled.is_not(True))
+    suma = (
+        db.select(db.func.coalesce(db.func.sum(pozycje.c.ilosc), 0))
+        .where(pozycje.c.blacha_id == t.c.id, niezrealizowane)
+        .scalar_subquery()
+    )
+    return t.update().where(t.c.id.in_(db.select(pozycje.c.blacha_id).where(niezrealizowane))) \
+        .values(zapotrzebowanie=t.c.zapotrzebowanie + znak * suma)
+
+def _przenies_pozycje(conn, z, do, project_ids, kolumny):
+    wybrane = z.c.project_id.in_(project_ids)
+    conn.execute(do.insert().from_select(kolumny, db.select(*(z.c[k] for k in kolumny)).where(wybrane).order_by(z.c.id)))
+    return conn.execute(z.delete().where(wybrane)).rowcount
+
+# Zwraca liczbę przeniesionych pozycji; projekty już zarchiwizowane są pomijane
+def archiwizuj_projekty(project_ids):
+    conn = db.session.connection()
+    p = Project.__table__
+    ids = conn.execute(
+        db.select(p.c.id).where(p.c.id.in_(list(project_ids)), p.c.archived.is_(False))
+    ).scalars().all()
+    if not ids:
+        return 0
+    conn.execute(_korekta_zapotrzebowania(ProjectItem.__table__, ids, -1))
+    przeniesione = _przenies_pozycje(conn, ProjectItem.__table__, ProjectItemArchive.__table__, ids,
+                                     ('project_id', 'blacha_id', 'ilosc', 'fulfilled'))
+    conn.execute(p.update().where(p.c.id.in_(ids)).values(archived=True))
+    return przeniesione
+
+def przywroc_projekty(project_ids):
+    conn = db.session.connection()
+    p = Project.__table__
+    ids = conn.execute(
+        db.select(p.c.id).where(p.c.id.in_(list(project_ids)), p.c.archived.is_(True))
+    ).scalars().all()
+    if not ids:
+        return 0
+    conn.execute(_korekta_zapotrzebowania(ProjectItemArchive.__table__, ids, 1))
+    przeniesione = _przenies_pozycje(conn, ProjectItemArchive.__table__, ProjectItem.__table__, ids,
+                                     ('project_id', 'blacha_id', 'ilosc', 'fulfilled'))
+    conn.execute(p.update().where(p.c.id.in_(ids)).values(archived=False))
+    return przeniesione
+
+# RUCHY MAGAZYNOWE
+
+# Ruchy zapisywane są w tej samej transakcji co zmiana stan_obecny: ścieżki ORM (dodanie, edycja
+# blachy) przez zdarzenia mapera, zapisy zbiorcze (zamówienia, korekty API, import) jawnie.
+# Ruchy od ostatniej migawki są liczone po id, a po STOCK_SNAPSHOT_EVERY z nich powstaje kolejna.
+
+# ruchy: lista {'blacha_id', 'delta', 'rodzaj'[, 'order_id', 'opis']}; ruchy zerowe są pomijane
+def zapisz_ruchy(connection, ruchy, czas=None):
+    czas = czas or datetime.utcnow()
+    ruchy = [dict({'order_id': None, 'opis': None}, czas=czas, **r) for r in ruchy if r['delta']]
+    if not ruchy:
+        return
+    connection.execute(StockMovement.__table__.insert(), ruchy)
+    co_ile = current_app.config['STOCK_SNAPSHOT_EVERY']
+    if co_ile and _ruchy_od_migawki(connection) >= co_ile:
+        utworz_migawke(connection)
+
+def _ruchy_od_migawki(connection):
+    m, s = StockMovement.__table__, StockSnapshot.__table__
+    return connection.execute(db.select(
+        db.func.coalesce(db.select(db.func.max(m.c.id)).scalar_subquery(), 0)
+        - db.func.coalesce(db.select(db.func.max(s.c.ostatni_ruch_id)).scalar_subquery(), 0)
+    )).scalar()
+
+# Stan blach (blacha_id, stan): wiersze migawki plus ruchy spełniające warunki, zsumowane po blasze
+def _stany_z_ruchow(snapshot_id, *warunki):
+    m, l = StockMovement.__table__, StockSnapshotLine.__table__
+    czesci = [db.select(m.c.blacha_id, m.c.delta.label('stan')).where(*warunki)]
+    if snapshot_id is not None:
+        czesci.append(db.select(l.c.blacha_id, l.c.stan).where(l.c.snapshot_id == snapshot_id))
+    u = db.union_all(*czesci).subquery()
+    return db.select(u.c.blacha_id, db.func.sum(u.c.stan).label('stan')).group_by(u.c.blacha_id).subquery()
+
+# Nowa migawka z poprzedniej i ruchów po niej (do ruchu do_ruchu włącznie, domyślnie do ostatniego).
+# Czas migawki to czas jej ostatniego ruchu. Zwraca id migawki albo None, gdy nie było nowych ruchów.
+def utworz_migawke(connection, do_ruchu=None):
+    m, s, l = StockMovement.__table__, StockSnapshot.__table__, StockSnapshotLine.__table__
+    poprzednia = connection.execute(
+        db.select(s.c.id, s.c.ostatni_ruch_id).order_by(s.c.ostatni_ruch_id.desc()).limit(1)
+    ).first()
+    od = poprzednia.ostatni_ruch_id if poprzednia else 0
+    zakres = [m.c.id > od] + ([m.c.id <= do_ruchu] if do_ruchu is not None else [])
+    do, czas = connection.execute(db.select(db.func.max(m.c.id), db.func.max(m.c.czas)).where(*zakres)).one()
+    if do is None:
+        return None
+    snapshot_id = connection.execute(s.insert().values(czas=czas, ostatni_ruch_id=do)).inserted_primary_key[0]
+    stany = _stany_z_ruchow(poprzednia.id if poprzednia else None, m.c.id > od, m.c.id <= do)
+    connection.execute(l.insert().from_select(
+        ['snapshot_id', 'blacha_id', 'stan'],
+        db.select(db.literal(snapshot_id), stany.c.blacha_id, stany.c.stan).where(stany.c.stan != 0),
+    ))
+    return snapshot_id
+
+# Stany wszystkich blach na chwilę (bez ruchów o czasie >= chwila): najbliższa wcześniejsza
+# migawka i ruchy najwyżej do następnej migawki, zamiast całej historii
+def stany_na_chwile(chwila):
+    m, s = StockMovement.__table__, StockSnapshot.__table__
+    poprzednia = db.session.execute(
+        db.select(s.c.id, s.c.ostatni_ruch_id).where(s.c.czas < chwila)
+        .order_by(s.c.czas.desc(), s.c.id.desc()).limit(1)
+    ).first()
+    nastepna = db.session.execute(
+        db.select(s.c.ostatni_ruch_id).where(s.c.czas >= chwila).order_by(s.c.czas, s.c.id).limit(1)
+    ).scalar()
+    warunki = [m.c.czas < chwila]
+    if poprzednia is not None:
+        warunki.append(m.c.id > poprzednia.ostatni_ruch_id)
+    if nastepna is not None:
+        warunki.append(m.c.id <= nastepna)
+    return _stany_z_ruchow(poprzednia.id if poprzednia else None, *warunki)
+
+def zapytanie_stanow_na_chwile(chwila, after_id=None, limit=None, tylko_zmiany=False):
+    stany = stany_na_chwile(chwila)
+    stan_na_chwile = db.func.coalesce(stany.c.stan, 0)
+    stmt = (
+        db.select(Blacha.id, Blacha.kod, Blacha.nazwa, Blacha.stan_obecny, stan_na_chwile.label('stan_na_dzien'))
+        .outerjoin(stany, stany.c.blacha_id == Blacha.id)
+        .order_by(Blacha.id)
+    )
+    if after_id is not None:
+        stmt = stmt.where(Blacha.id > after_id)
+    if tylko_zmiany:
+        stmt = stmt.where(stan_na_chwile != Blacha.stan_obecny)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
+
+# Blachy, których stan_obecny różni się od sumy ruchów (blacha_id, kod, stan_obecny, suma_ruchow)
+def _zapytanie_rozbieznosci_stanow():
+    m = StockMovement.__table__
+    suma = (
+        db.select(db.func.coalesce(db.func.sum(m.c.delta), 0))
+        .where(m.c.blacha_id == Blacha.id)
+        .scalar_subquery()
+    )
+    return (
+        db.select(Blacha.id, Blacha.kod, Blacha.stan_obecny, suma.label('suma_ruchow'))
+        .where(Blacha.stan_obecny != suma)
+        .order_by(Blacha.id)
+    )
+
+# Bilans otwarcia dla blach bez historii (istniejące bazy, dane wstawione z pominięciem aplikacji)
+def _zapytanie_bilansu_otwarcia(czas):
+    m, b = StockMovement.__table__, Blacha.__table__
+    return m.insert().from_select(
+        ['blacha_id', 'czas', 'delta', 'rodzaj'],
+        db.select(b.c.id, db.literal(czas, db.DateTime), b.c.stan_obecny, db.literal('bilans_otwarcia'))
+        .where(b.c.stan_obecny != 0, ~db.exists().where(m.c.blacha_id == b.c.id))
+        .order_by(b.c.id),
+    )
+
+@db.event.listens_for(Blacha, 'after_insert')
+def _blacha_inserted(mapper, connection, target):
+    zapisz_ruchy(connection, [{'blacha_id': target.id, 'delta': target.stan_obecny or 0, 'rodzaj': 'utworzenie'}])
+
+@db.event.listens_for(Blacha, 'after_update')
+def _blacha_updated(mapper, connection, target):
+    delta = (target.stan_obecny or 0) - (_poprzednia_wartosc(target, 'stan_obecny') or 0)
+    zapisz_ruchy(connection, [{'blacha_id': target.id, 'delta': delta, 'rodzaj': 'korekta'}])
+
+@db.event.listens_for(Blacha, 'after_delete')
+def _blacha_deleted(mapper, connection, target):
+    # Księga zostaje nienaruszona; usunięcie zamyka ją ruchem do zera (id blach się nie powtarzają)
+    zapisz_ruchy(connection, [{'blacha_id': target.id, 'delta': -(target.stan_obecny or 0), 'rodzaj': 'usuniecie'}])
+
+@bp.cli.command('stock-snapshot')
+def stock_snapshot_command():
+    """Tworzy migawkę stanów magazynu z ruchów od poprzedniej migawki."""
+    snapshot_id = utworz_migawke(db.session.connection())
+    db.session.commit()
+    click.echo(f"Utworzono migawkę {snapshot_id}." if snapshot_id else "Brak nowych ruchów od ostatniej migawki.")
+
+@bp.cli.command('stock-verify')
+@click.option('--napraw', is_flag=True, help='Dopisz ruchy wyrównujące księgę do stan_obecny.')
+def stock_verify_command(napraw):
+    """Porównuje stan_obecny z sumą ruchów magazynowych każdej blachy."""
+    rozbieznosci = db.session.execute(_zapytanie_rozbieznosci_stanow()).all()
+    for r in rozbieznosci:
+        click.echo(f"{r.kod}: stan {r.stan_obecny}, suma ruchów {r.suma_ruchow}")
+    if napraw and rozbieznosci:
+        zapisz_ruchy(db.session.connection(), [
+            {'blacha_id': r.id, 'delta': r.stan_obecny - r.suma_ruchow, 'rodzaj': 'wyrownanie'} for r in rozbieznosci
+        ])
+        db.session.commit()
+        click.echo(f"Dopisano {len(rozbieznosci)} ruchów wyrównujących.")
+    elif not rozbieznosci:
+        click.echo("Stany zgodne z księgą ruchów.")
+
+# PLANOWANIE ZAMÓWIEŃ
+
+# Rachunek braków jest w mrp.py (numpy); tu tylko dane z bazy i parametry z konfiguracji.
+# Scenariusze liczone są w pamięci – planowanie niczego nie zapisuje.
+
+def parametry_planowania():
+    c = current_app.config
+    return {'safety_stock': c['MRP_SAFETY_STOCK'], 'lot_size': c['MRP_LOT_SIZE'], 'min_order': c['MRP_MIN_ORDER']}
+
+# Blachy, których stan nie pokrywa zapotrzebowania (z zapasem minimalnym, jeśli ustawiony)
+def warunek_brakow():
+    zapas = current_app.config['MRP_SAFETY_STOCK']
+    if zapas:
+        return Blacha.stan_obecny < Blacha.zapotrzebowanie + zapas
+    return Blacha.stan_obecny < Blacha.zapotrzebowanie
+
+# Domyślne ilości do zamówienia dla wczytanych blach: {blacha_id: ilość}
+def ilosci_do_zamowienia(blachy):
+    _, ilosci = net_requirements([b.stan_obecny for b in blachy], [b.stan_potrzebny for b in blachy],
+                                 **parametry_planowania())
+    return {b.id: int(q) for b, q in zip(blachy, ilosci)}
+
+# Cały katalog w kolumnach: dwa zapytania (blachy oraz niezrealizowane pozycje projektów).
+# Zapytania idą przez połączenie, z pominięciem warstwy ORM – przy dziesiątkach tysięcy
+# wierszy to kilkukrotnie szybciej.
+def dane_planowania():
+    conn = db.session.connection()
+    blachy = conn.execute(
+        db.select(Blacha.id, Blacha.kod, Blacha.stan_obecny).order_by(Blacha.id)
+    ).all()
+    pozycje = conn.execute(
+        db.select(ProjectItem.project_id, ProjectItem.blacha_id, ProjectItem.ilosc)
+        .where(ProjectItem.fulfilled.is_not(True))
+    ).all()
+    return PlanningData.from_rows(blachy, pozycje)
+
+# MIGRACJE SCHEMATU
+
+# Wersja schematu zapisywana jest w PRAGMA user_version. db.create_all() tworzy brakujące tabele,
+# a migracje zmieniają istniejące (kolumny, indeksy, dane). Każda migracja musi dać się
+# bezpiecznie uruchomić również na świeżej bazie, w której create_all() utworzył już wszystko.
+def _kolumny(conn, tabela):
+    return {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{tabela}")')}
+
+def _migracja_licznik_zapotrzebowania(conn):
+    if 'zapotrzebowanie' not in _kolumny(conn, 'blacha'):
+        conn.exec_driver_sql("ALTER TABLE blacha ADD COLUMN zapotrzebowanie INTEGER NOT NULL DEFAULT 0")
+        conn.execute(_zapytanie_przeliczenia())
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_blacha_zapotrzebowanie_stan ON blacha (zapotrzebowanie, stan_obecny)")
+
+def _migracja_indeksy(conn):
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_project_item_blacha_fulfilled ON project_item (blacha_id, fulfilled, ilosc)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_project_item_project_id ON project_item (project_id)")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_order_item_order_id ON order_item (order_id, blacha_id, quantity)")
+    conn.exec_driver_sql('CREATE INDEX IF NOT EXISTS ix_order_order_date ON "order" (order_date)')
+
+def _migracja_podsumowanie_zamowien(conn):
+    kolumny = _kolumny(conn, 'order')
+    for kolumna in ('liczba_pozycji', 'suma_sztuk', 'liczba_materialow'):
+        if kolumna not in kolumny:
+            conn.exec_driver_sql(f'ALTER TABLE "order" ADD COLUMN {kolumna} INTEGER NOT NULL DEFAULT 0')
+    conn.execute(_zapytanie_podsumowania_zamowien())
+
+def _migracja_wyszukiwanie(conn):
+    for ddl in _fts_ddl():
+        conn.exec_driver_sql(ddl)
+    _fts_odbuduj(conn)
+
+# Tabele księgi tworzy create_all(); istniejące stany trafiają do niej jako bilans otwarcia
+def _migracja_ruchy_magazynowe(conn):
+    conn.execute(_zapytanie_bilansu_otwarcia(datetime.utcnow()))
+    utworz_migawke(conn)
+
+# Tabelę archiwum tworzy create_all(). Projekty zarchiwizowane starym sposobem (wszystkie pozycje
+# oznaczone jako zrealizowane) dostają flagę, a ich pozycje trafiają do archiwum – zapotrzebowanie
+# się nie zmienia, bo zrealizowane pozycje nie były do niego liczone.
+def _migracja_archiwum_projektow(conn):
+    if 'archived' not in _kolumny(conn, 'project'):
+        conn.exec_driver_sql("ALTER TABLE project ADD COLUMN archived BOOLEAN NOT NULL DEFAULT 0")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_project_archived ON project (archived)")
+    p, pozycje = Project.__table__, ProjectItem.__table__
+    ma_pozycje = db.select(pozycje.c.id).where(pozycje.c.project_id == p.c.id).exists()
+    otwarte = db.select(pozycje.c.id).where(pozycje.c.project_id == p.c.id, pozycje.c.fulfilled.is_not(True)).exists()
+    ids = conn.execute(
+        db.select(p.c.id).where(p.c.archived.is_(False), ma_pozycje, ~otwarte)
+    ).scalars().all()
+    for i in range(0, len(ids), 500):
+        paczka = ids[i:i + 500]
+        _przenies_pozycje(conn, pozycje, ProjectItemArchive.__table__, paczka,
+                          ('project_id', 'blacha_id', 'ilosc', 'fulfilled'))
+        conn.execute(p.update().where(p.c.id.in_(paczka)).values(archived=True))
+
+# Tabela blacha bez AUTOINCREMENT może ponownie nadać id usuniętej blachy, a wraz z nim jej ruchy
+# w księdze. SQLite nie zmienia klucza głównego w miejscu – tabelę przebudowujemy według modelu
+# (z indeksami i wyzwalaczami FTS), a licznik id zaczyna się za największym id znanym z historii.
+def _migracja_id_blach_bez_powtorzen(conn):
+    ddl = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'blacha'").scalar()
+    if 'AUTOINCREMENT' in ddl.upper():
+        return
+    t = Blacha.__table__
+    kolumny = ', '.join(c.name for c in t.columns if c.name in _kolumny(conn, 'blacha'))
+    # Nowa tabela dostaje nazwę docelową dopiero po usunięciu starej – zmiana nazwy starej
+    # przepisałaby klucze obce w project_item i innych tabelach na nazwę tymczasową
+    ddl = str(CreateTable(t).compile(dialect=conn.dialect)).replace('CREATE TABLE blacha ', 'CREATE TABLE blacha_nowa ', 1)
+    conn.exec_driver_sql(ddl)
+    conn.exec_driver_sql(f"INSERT INTO blacha_nowa ({kolumny}) SELECT {kolumny} FROM blacha")
+    conn.exec_driver_sql("DROP TABLE blacha")
+    conn.exec_driver_sql("ALTER TABLE blacha_nowa RENAME TO blacha")
+    for indeks in t.indexes:
+        indeks.create(conn)
+    for ddl in _fts_ddl():
+        conn.exec_driver_sql(ddl)
+    conn.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = 'blacha'")
+    conn.exec_driver_sql(
+        "INSERT INTO sqlite_sequence (name, seq) SELECT 'blacha', max(coalesce(max(id), 0), "
+        "(SELECT coalesce(max(blacha_id), 0) FROM stock_movement)) FROM blacha")
+
+# Kolejność ma znaczenie: migracja n podnosi bazę do wersji n
+MIGRACJE = [
+    _migracja_licznik_zapotrzebowania,
+    _migracja_indeksy,
+    _migracja_podsumowanie_zamowien,
+    _migracja_wyszukiwanie,
+    _migracja_ruchy_magazynowe,
+    _migracja_archiwum_projektow,
+    _migracja_id_blach_bez_powtorzen,
+]
+
+def wersja_schematu(conn):
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+def uruchom_migracje():
+    wykonane = []
+    with db.engine.connect() as conn:
+        wersja = wersja_schematu(conn)
+    for numer, migracja in enumerate(MIGRACJE, start=1):
+        if numer <= wersja:
+            continue
+        # Każda migracja w osobnej transakcji razem z podniesieniem numeru wersji
+        with db.engine.begin() as conn:
+            migracja(conn)
+            conn.exec_driver_sql(f"PRAGMA user_version = {numer}")
+        wykonane.append(numer)
+    if wykonane:
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql("PRAGMA optimize")
+    return wykonane
+
+def init_db():
+    db.create_all()
+    return uruchom_migracje()
+
+@bp.cli.command('migrate')
+@click.option('--status', is_flag=True, help='Tylko pokaż wersję schematu.')
+def migrate_command(status):
+    """Tworzy brakujące tabele i wykonuje oczekujące migracje schematu."""
+    if status:
+        with db.engine.connect() as conn:
+            click.echo(f"Wersja schematu: {wersja_schematu(conn)} z {len(MIGRACJE)}")
+        return
+    wykonane = init_db()
+    click.echo(f"Wykonane migracje: {', '.join(map(str, wykonane)) or 'brak'}")
+
+# IMPORT / EKSPORT DANYCH
+
+# Kolumny plików CSV/JSONL dla każdego rodzaju danych (import i eksport używają tych samych)
+KOLUMNY_DANYCH = {
+    'blachy': ['kod', 'nazwa', 'nazwa_prosta', 'material', 'grubosc', 'rodzaj_obrobki', 'stan_obecny'],
+    'projekty': ['projekt', 'kod', 'ilosc', 'zrealizowane'],
+    'materialy': ['nazwa'],
+    'grubosci': ['wartosc'],
+}
+FORMATY_DANYCH = ('csv', 'jsonl')
+
+def _tekst(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+def _liczba(value, pole, bledy):
+    try:
+        return int(str(value).strip())
+    except (TypeError, ValueError):
+        bledy.append(f"{pole}: niepoprawna liczba '{value}'")
+        return None
+
+def _logiczna(value):
+    return str(value).strip().lower() in ('1', 'true', 'tak', 't', 'yes', 'x')
+
+# Odczyt wierszy z pliku CSV (separator wykrywany: , ; tab) lub JSONL; zwraca (nr, wiersz, błąd)
+def czytaj_wiersze(stream, fmt):
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'jsonl':
+        for nr, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield nr, None, f"niepoprawny JSON: {e}"
+                continue
+            if not isinstance(row, dict):
+                yield nr, None, "wiersz nie jest obiektem JSON"
+                continue
+            yield nr, row, None
+        return
+    # Separator wybieramy na podstawie wiersza nagłówka
+    header = text.readline()
+    text.seek(0)
+    delimiter = max(',;\t', key=header.count)
+    for nr, row in enumerate(csv.DictReader(text, delimiter=delimiter), start=1):
+        yield nr, {k.strip(): v for k, v in row.items() if k}, None
+
+# Słowniki nazwa -> id dla materiałów, grubości i projektów; brakujące wpisy są tworzone
+class _Slowniki:
+    def __init__(self):
+        self.materialy = dict(db.session.execute(db.select(MaterialOption.nazwa, MaterialOption.id)).all())
+        self.grubosci = dict(db.session.execute(db.select(ThicknessOption.wartosc, ThicknessOption.id)).all())
+        self.projekty = None
+        self.zarchiwizowane = set()
+        self.utworzone = 0
+
+    def _id(self, slownik, model, pole, nazwa):
+        if nazwa is None:
+            return None
+        if nazwa not in slownik:
+            obj = model(**{pole: nazwa})
+            db.session.add(obj)
+            db.session.flush()
+            slownik[nazwa] = obj.id
+            self.utworzone += 1
+        return slownik[nazwa]
+
+    def material_id(self, nazwa):
+        return self._id(self.materialy, MaterialOption, 'nazwa', nazwa)
+
+    def thickness_id(self, wartosc):
+        return self._id(self.grubosci, ThicknessOption, 'wartosc', wartosc)
+
+    def project_id(self, nazwa):
+        if self.projekty is None:
+            self.projekty = {}
+            # Przy powtórzonej nazwie wygrywa projekt aktywny
+            for pid, pnazwa, archived in db.session.execute(
+                db.select(Project.id, Project.nazwa, Project.archived).order_by(Project.archived.desc(), Project.id.desc())
+            ):
+                self.projekty[pnazwa] = pid
+                if archived:
+                    self.zarchiwizowane.add(pid)
+        return self._id(self.projekty, Project, 'nazwa', nazwa)
+
+def _importuj_blachy(chunk, slowniki, raport):
+    kody = {_tekst(row.get('kod')) for _, row in chunk}
+    # Stany sprzed importu – różnice trafiają do księgi ruchów
+    istniejace = dict(db.session.execute(
+        db.select(Blacha.kod, Blacha.stan_obecny).where(Blacha.kod.in_(kody))
+    ).all())
+    grupy = {}
+    for nr, row in chunk:
+        bledy = []
+        kod = _tekst(row.get('kod'))
+        if kod is None:
+            bledy.append("kod: wymagany")
+        wiersz = {'kod': kod}
+        for pole in ('nazwa', 'nazwa_prosta', 'rodzaj_obrobki'):
+            if pole in row:
+                wiersz[pole] = _tekst(row[pole])
+        if _tekst(row.get('stan_obecny')) is not None:
+            wiersz['stan_obecny'] = _liczba(row['stan_obecny'], 'stan_obecny', bledy)
+        if 'nazwa' in wiersz and wiersz['nazwa'] is None:
+            bledy.append("nazwa: wymagana")
+        if kod not in istniejace:
+            # Nowa blacha – nazwa jest wymagana, stan domyślnie 0
+            if 'nazwa' not in wiersz:
+                bledy.append("nazwa: wymagana dla nowej blachy")
+            wiersz.setdefault('stan_obecny', 0)
+        if bledy:
+            raport['bledy'].append({'wiersz': nr, 'kod': kod, 'bledy': bledy})
+            continue
+        # Słowniki uzupełniamy dopiero dla wiersza przyjętego – odrzucony nie zostawia nowych opcji
+        if 'material' in row:
+            wiersz['material_id'] = slowniki.material_id(_tekst(row['material']))
+        if 'grubosc' in row:
+            wiersz['thickness_id'] = slowniki.thickness_id(_tekst(row['grubosc']))
+        grupy.setdefault((kod not in istniejace, tuple(sorted(wiersz))), []).append(wiersz)
+    t = Blacha.__table__
+    for (nowe, kolumny), wiersze in grupy.items():
+        if nowe:
+            # Nowe blachy mają komplet wymaganych pól; konflikt możliwy tylko przy równoległym imporcie
+            stmt = sqlite_insert(t)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['kod'], set_={c: stmt.excluded[c] for c in kolumny if c != 'kod'})
+            db.session.execute(stmt, wiersze)
+        elif len(kolumny) > 1:
+            # Istniejące blachy – aktualizujemy tylko kolumny obecne w pliku
+            db.session.execute(
+                t.update().where(t.c.kod == db.bindparam('b_kod'))
+                .values({c: db.bindparam(c) for c in kolumny if c != 'kod'}),
+                [dict(w, b_kod=w['kod']) for w in wiersze],
+            )
+        raport['zapisane'] += len(wiersze)
+    ze_stanem = {w['kod'] for (_, kolumny), wiersze in grupy.items() if 'stan_obecny' in kolumny for w in wiersze}
+    if ze_stanem:
+        zapisz_ruchy(db.session.connection(), [
+            {'blacha_id': r.id, 'delta': r.stan_obecny - istniejace.get(r.kod, 0), 'rodzaj': 'import'}
+            for r in db.session.execute(
+                db.select(Blacha.id, Blacha.kod, Blacha.stan_obecny).where(Blacha.kod.in_(ze_stanem))
+            )
+        ])
+
+def _importuj_pozycje_projektow(chunk, slowniki, raport):
+    kody = {_tekst(row.get('kod')) for _, row in chunk}
+    blachy = dict(db.session.execute(db.select(Blacha.kod, Blacha.id).where(Blacha.kod.in_(kody))).all())
+    poprawne = []
+    for nr, row in chunk:
+        bledy = []
+        projekt = _tekst(row.get('projekt'))
+        kod = _tekst(row.get('kod'))
+        if projekt is None:
+            bledy.append("projekt: wymagany")
+        if kod not in blachy:
+            bledy.append(f"kod: nieznana blacha '{kod}'")
+        ilosc = _liczba(row.get('ilosc'), 'ilosc', bledy)
+        if not bledy:
+            project_id = slowniki.project_id(projekt)
+            if project_id in slowniki.zarchiwizowane:
+                bledy.append(f"projekt: '{projekt}' jest zarchiwizowany")
+        if bledy:
+            raport['bledy'].append({'wiersz': nr, 'kod': kod, 'bledy': bledy})
+            continue
+        poprawne.append({
+            'project_id': project_id,
+            'blacha_id': blachy[kod],
+            'ilosc': ilosc,
+            'fulfilled': _logiczna(row.get('zrealizowane', '')),
+        })
+    if not poprawne:
+        return
+    # Istniejąca pozycja (projekt, blacha) jest aktualizowana, pozostałe dopisywane
+    istniejace = {}
+    for item_id, project_id, blacha_id in db.session.execute(
+        db.select(ProjectItem.id, ProjectItem.project_id, ProjectItem.blacha_id)
+        .where(ProjectItem.project_id.in_({w['project_id'] for w in poprawne}),
+               ProjectItem.blacha_id.in_({w['blacha_id'] for w in poprawne}))
+        .order_by(ProjectItem.id.desc())
+    ):
+        istniejace[(project_id, blacha_id)] = item_id
+    t = ProjectItem.__table__
+    do_zmiany = [dict(w, b_id=istniejace[(w['project_id'], w['blacha_id'])]) for w in poprawne
+                 if (w['project_id'], w['blacha_id']) in istniejace]
+    nowe = [w for w in poprawne if (w['project_id'], w['blacha_id']) not in istniejace]
+    if do_zmiany:
+        db.session.execute(
+            t.update().where(t.c.id == db.bindparam('b_id'))
+            .values(ilosc=db.bindparam('ilosc'), fulfilled=db.bindparam('fulfilled')),
+            [{'b_id': w['b_id'], 'ilosc': w['ilosc'], 'fulfilled': w['fulfilled']} for w in do_zmiany],
+        )
+    if nowe:
+        db.session.execute(t.insert(), nowe)
+    # Zapis zbiorczy omija zdarzenia ORM, więc licznik zapotrzebowania przeliczamy dla tych blach
+    przelicz_zapotrzebowanie({w['blacha_id'] for w in poprawne})
+    raport['zapisane'] += len(poprawne)
+
+def _importuj_opcje(model, pole):
+    def importuj(chunk, slowniki, raport):
+        wartosci = []
+        for nr, row in chunk:
+            wartosc = _tekst(row.get(pole))
+            if wartosc is None:
+                raport['bledy'].append({'wiersz': nr, 'kod': None, 'bledy': [f"{pole}: wymagane"]})
+                continue
+            wartosci.append({pole: wartosc})
+        if wartosci:
+            db.session.execute(sqlite_insert(model.__table__).on_conflict_do_nothing(index_elements=[pole]), wartosci)
+            # Zapis zbiorczy omija zdarzenia ORM – wersję słowników podnosimy ręcznie
+            podbij_wersje(db.session.connection(), WERSJA_SLOWNIKOW)
+            raport['zapisane'] += len(wartosci)
+    return importuj
+
+IMPORTERY = {
+    'blachy': _importuj_blachy,
+    'projekty': _importuj_pozycje_projektow,
+    'materialy': _importuj_opcje(MaterialOption, 'nazwa'),
+    'grubosci': _importuj_opcje(ThicknessOption, 'wartosc'),
+}
+
+# Import strumieniowy: wiersze walidowane i zapisywane paczkami, każda paczka w osobnej transakcji.
+# Zwraca raport z liczbą wierszy i listą błędów (numer wiersza, kod, opis).
+def importuj_dane(rodzaj, stream, fmt):
+    importer = IMPORTERY[rodzaj]
+    raport = {'przetworzone': 0, 'zapisane': 0, 'utworzone_slowniki': 0, 'bledy': []}
+    slowniki = _Slowniki()
+    chunk_size = current_app.config['IMPORT_CHUNK_SIZE']
+    chunk = []
+
+    def zapisz(chunk):
+        try:
+            importer(chunk, slowniki, raport)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    for nr, row, blad in czytaj_wiersze(stream, fmt):
+        raport['przetworzone'] += 1
+        if blad:
+            raport['bledy'].append({'wiersz': nr, 'kod': None, 'bledy': [blad]})
+            continue
+        chunk.append((nr, row))
+        if len(chunk) >= chunk_size:
+            zapisz(chunk)
+            chunk = []
+    if chunk:
+        zapisz(chunk)
+    raport['utworzone_slowniki'] = slowniki.utworzone
+    raport['bledy'].sort(key=lambda b: b['wiersz'])
+    return raport
+
+def _zapytanie_eksportu(rodzaj):
+    if rodzaj == 'blachy':
+        return (
+            db.select(Blacha.kod, Blacha.nazwa, Blacha.nazwa_prosta,
+                      MaterialOption.nazwa.label('material'), ThicknessOption.wartosc.label('grubosc'),
+                      Blacha.rodzaj_obrobki, Blacha.stan_obecny)
+            .outerjoin(MaterialOption, MaterialOption.id == Blacha.material_id)
+            .outerjoin(ThicknessOption, ThicknessOption.id == Blacha.thickness_id)
+            .order_by(Blacha.id)
+        )
+    if rodzaj == 'projekty':
+        return (
+            db.select(Project.nazwa.label('projekt'), Blacha.kod, ProjectItem.ilosc,
+                      db.func.coalesce(ProjectItem.fulfilled, False).label('zrealizowane'))
+            .join(Project, Project.id == ProjectItem.project_id)
+            .join(Blacha, Blacha.id == ProjectItem.blacha_id)
+            .order_by(ProjectItem.id)
+        )
+    if rodzaj == 'materialy':
+        return db.select(MaterialOption.nazwa).order_by(MaterialOption.id)
+    return db.select(ThicknessOption.wartosc).order_by(ThicknessOption.id)
+
+# Eksport strumieniowy – wiersze pobierane z bazy paczkami i od razu zamieniane na tekst
+def eksportuj_dane(rodzaj, fmt):
+    kolumny = KOLUMNY_DANYCH[rodzaj]
+    stmt = _zapytanie_eksportu(rodzaj).execution_options(yield_per=current_app.config['IMPORT_CHUNK_SIZE'])
+    result = db.session.execute(stmt)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if fmt == 'csv':
+        writer.writerow(kolumny)
+    for partition in result.partitions():
+        for row in partition:
+            values = list(row)
+            if rodzaj == 'projekty':
+                values[3] = int(bool(values[3]))
+            if fmt == 'csv':
+                writer.writerow(values)
+            else:
+                buf.write(json.dumps(dict(zip(kolumny, values)), ensure_ascii=False) + '\n')
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+@bp.cli.command('import-data')
+@click.argument('rodzaj', type=click.Choice(list(KOLUMNY_DANYCH)))
+@click.argument('plik', type=click.Path(exists=True, dir_okay=False))
+def import_data_command(rodzaj, plik):
+    """Importuje blachy, pozycje projektów, materiały lub grubości z pliku CSV/JSONL."""
+    fmt = 'jsonl' if plik.lower().endswith(('.jsonl', '.json')) else 'csv'
+    with open(plik, 'rb') as f:
+        raport = importuj_dane(rodzaj, f, fmt)
+    for blad in raport['bledy']:
+        click.echo(f"wiersz {blad['wiersz']}: {'; '.join(blad['bledy'])}", err=True)
+    click.echo(f"Przetworzono {raport['przetworzone']}, zapisano {raport['zapisane']}, "
+               f"błędów {len(raport['bledy'])}.")
+
+@bp.cli.command('export-data')
+@click.argument('rodzaj', type=click.Choice(list(KOLUMNY_DANYCH)))
+@click.option('--format', 'fmt', type=click.Choice(FORMATY_DANYCH), default='csv')
+@click.option('--output', '-o', type=click.File('w', encoding='utf-8'), default='-')
+def export_data_command(rodzaj, fmt, output):
+    """Eksportuje dane do CSV/JSONL (domyślnie na standardowe wyjście)."""
+    for chunk in eksportuj_dane(rodzaj, fmt):
+        output.write(chunk)
+
+# SZKICE ZAMÓWIEŃ
+
+# Pozycje przygotowywanego zamówienia leżą w tabelach draft_order(_line), a ciasteczko sesji
+# niesie tylko token szkicu. Szkice nieużywane dłużej niż DRAFT_ORDER_MAX_AGE są pomijane, a usuwa je
+# usun_przeterminowane_szkice() – przy zakładaniu nowego szkicu i w "flask purge-drafts".
+def szkic_zamowienia(utworz=False):
+    token = session.get('draft_order')
+    draft = None
+    if token:
+        draft = DraftOrder.query.filter_by(token=token).first()
+        if draft and draft.zmieniono < datetime.utcnow() - timedelta(seconds=current_app.config['DRAFT_ORDER_MAX_AGE']):
+            draft = None
+        if draft is None:
+            session.pop('draft_order', None)
+    if draft is None and utworz:
+        usun_przeterminowane_szkice()
+        draft = DraftOrder(token=secrets.token_hex(16))
+        db.session.add(draft)
+        db.session.flush()
+        session['draft_order'] = draft.token
+    return draft
+
+# Zastępuje pozycje szkicu listą (blacha_id, ilość); pozycje z ilością <= 0 są pomijane.
+# Zatwierdzenie transakcji po stronie wywołującego – po wyrenderowaniu strony, bo commit
+# unieważnia wczytane blachy i szablon odpytywałby bazę o każdą z osobna.
+def zapisz_pozycje_szkicu(pozycje):
+    draft = szkic_zamowienia(utworz=True)
+    t = DraftOrderLine.__table__
+    db.session.execute(t.delete().where(t.c.draft_id == draft.id))
+    wiersze = [{'draft_id': draft.id, 'blacha_id': sid, 'ilosc': qty} for sid, qty in pozycje if qty > 0]
+    if wiersze:
+        db.session.execute(t.insert(), wiersze)
+    draft.zmieniono = datetime.utcnow()
+
+# Pozycje szkicu razem z blachami w jednym zapytaniu: lista {'sheet': Blacha, 'qty': ilość}
+def pozycje_szkicu():
+    draft = szkic_zamowienia()
+    if draft is None:
+        return []
+    rows = db.session.execute(
+        db.select(Blacha, DraftOrderLine.ilosc)
+        .join(DraftOrderLine, DraftOrderLine.blacha_id == Blacha.id)
+        .where(DraftOrderLine.draft_id == draft.id)
+        .order_by(DraftOrderLine.id)
+    ).all()
+    return [{'sheet': sheet, 'qty': qty} for sheet, qty in rows]
+
+def usun_szkic(draft):
+    t = DraftOrderLine.__table__
+    db.session.execute(t.delete().where(t.c.draft_id == draft.id))
+    db.session.delete(draft)
+    session.pop('draft_order', None)
+
+def usun_przeterminowane_szkice():
+    granica = datetime.utcnow() - timedelta(seconds=current_app.config['DRAFT_ORDER_MAX_AGE'])
+    stare = db.select(DraftOrder.id).where(DraftOrder.zmieniono < granica)
+    db.session.execute(DraftOrderLine.__table__.delete().where(DraftOrderLine.draft_id.in_(stare)))
+    return db.session.execute(DraftOrder.__table__.delete().where(DraftOrder.zmieniono < granica)).rowcount
+
+@bp.cli.command('purge-drafts')
+def purge_drafts_command():
+    """Usuwa porzucone szkice zamówień."""
+    usuniete = usun_przeterminowane_szkice()
+    db.session.commit()
+    click.echo(f"Usunięte szkice: {usuniete}")
+
+# Treść oferty TXT dla listy pozycji (blacha, ilość)
+def tresc_oferty(pozycje):
+    header = "Oferta Na Braki:\n"
+    separator = "----------------------------------------------------------\n"
+    col_headers = "{:<4}{:<8}{:<12}{:<10}{:<15}\n".format("lp.", "KOD", "Materiał", "Grubość", "Brak (szt.)")
+    content = header + separator + col_headers + separator
+    for i, (sheet, qty) in enumerate(pozycje, start=1):
+        qty_str = f"{qty} szt."
+        content += "{:<4}{:<8}{:<12}{:<10}{:<15}\n".format(i, sheet.kod, sheet.material or '-', sheet.grubosc or '-', qty_str)
+    return content
+
+# ZADANIA W TLE
+
+# Kolejka bez zewnętrznego brokera: zlecenia są wierszami tabeli job, a wątki robocze każdego procesu
+# (jobs.py, JOB_WORKERS) pobierają je atomowym UPDATE ... RETURNING – dwa procesy nie wezmą tego
+# samego zadania. Nieudana próba wraca do kolejki z rosnącym odstępem, po JOB_MAX_ATTEMPTS kończy się
+# stanem 'blad'. Każde zadanie zapisuje wynik we własnym katalogu, więc zlecenia nie nadpisują się.
+job_workers = LocalProxy(lambda: current_app.extensions['job_workers'])
+
+# rodzaj -> funkcja(job_id, parametry) zapisująca wynik w job_artifacts; zwraca (nazwa pliku, rozmiar)
+ZADANIA = {}
+
+# Zadania wykonywane teraz w tym procesie: id -> numer próby (do oddania przy zamykaniu procesu)
+_zadania_procesu = {}
+NAZWY_ZADAN = {'oferta': 'Oferta TXT', 'eksport_zamowienia': 'Eksport zamówienia'}
+STANY_ZADAN = {'oczekuje': 'Oczekuje', 'w_toku': 'W toku', 'gotowe': 'Gotowe', 'blad': 'Błąd'}
+
+def zadanie(rodzaj):
+    def rejestruj(funkcja):
+        ZADANIA[rodzaj] = funkcja
+        return funkcja
+    return rejestruj
+
+# Błąd, którego ponowienie nie naprawi (np. usunięte zamówienie) – zadanie od razu kończy się błędem
+class BladZadania(Exception):
+    pass
+
+# Nowe zadanie; identyczne zlecenie, które jeszcze czeka lub trwa, jest używane ponownie.
+# Zatwierdzenie transakcji i uruchom_zadania() po stronie wywołującego.
+def zlec_zadanie(rodzaj, parametry):
+    tekst = json.dumps(parametry, sort_keys=True, separators=(',', ':'))
+    job = Job.query.filter(Job.rodzaj == rodzaj, Job.parametry == tekst,
+                           Job.stan.in_(('oczekuje', 'w_toku'))).first()
+    if job is None:
+        usun_stare_zadania()
+        job = Job(rodzaj=rodzaj, parametry=tekst)
+        db.session.add(job)
+        db.session.flush()
+    return job
+
+# Wątki robocze startują leniwie w każdym procesie (także po fork()); wake() skraca czekanie na zadanie
+def uruchom_zadania():
+    job_workers.start()
+    job_workers.wake()
+
+@bp.before_app_request
+def _start_zadan():
+    # Zadania zlecone przed restartem podejmie pierwszy proces, który obsłuży żądanie
+    job_workers.start()
+
+def _pobierz_zadanie():
+    teraz = datetime.utcnow()
+    t = Job.__table__
+    porzucone = teraz - timedelta(seconds=current_app.config['JOB_TIMEOUT_SECONDS'])
+    max_prob = current_app.config['JOB_MAX_ATTEMPTS']
+    # Zadanie porzucone po ostatniej próbie (proces zginął w trakcie) kończy się błędem,
+    # inaczej zadanie zabijające proces byłoby podejmowane bez końca
+    db.session.execute(
+        t.update().where(t.c.stan == 'w_toku', t.c.rozpoczeto < porzucone, t.c.proby >= max_prob)
+        .values(stan='blad', blad="Przerwane – przekroczony czas wykonania", zakonczono=teraz)
+    )
+    kolejne = (db.select(t.c.id)
+               .where(db.or_(db.and_(t.c.stan == 'oczekuje', t.c.nastepna_proba <= teraz),
+                             db.and_(t.c.stan == 'w_toku', t.c.rozpoczeto < porzucone)))
+               .order_by(t.c.id).limit(1).scalar_subquery())
+    row = db.session.execute(
+        t.update().where(t.c.id == kolejne)
+        .values(stan='w_toku', proby=t.c.proby + 1, rozpoczeto=teraz)
+        .returning(t.c.id, t.c.rodzaj, t.c.parametry, t.c.proby)
+    ).first()
+    db.session.commit()
+    return row
+
+# Wykonuje jedno zadanie z kolejki; zwraca False, gdy kolejka jest pusta
+def wykonaj_nastepne_zadanie(app):
+    with app.app_context():
+        row = _pobierz_zadanie()
+        if row is None:
+            return False
+        start = time.perf_counter()
+        t = Job.__table__
+        teraz = datetime.utcnow()
+        _zadania_procesu[row.id] = row.proby
+        try:
+            if row.rodzaj not in ZADANIA:
+                raise BladZadania(f"Nieznany rodzaj zadania: {row.rodzaj}")
+            nazwa, rozmiar = ZADANIA[row.rodzaj](row.id, json.loads(row.parametry))
+        except Exception as e:
+            db.session.rollback()
+            app.logger.exception("Zadanie %s (%s), próba %d nie powiodła się", row.id, row.rodzaj, row.proby)
+            koniec = isinstance(e, BladZadania) or row.proby >= app.config['JOB_MAX_ATTEMPTS']
+            opoznienie = app.config['JOB_RETRY_SECONDS'] * 2 ** (row.proby - 1)
+            wynik = 'blad' if koniec else 'ponowienie'
+            zmiany = dict(stan='blad' if koniec else 'oczekuje', blad=str(e) or type(e).__name__,
+                          nastepna_proba=teraz + timedelta(seconds=opoznienie),
+                          zakonczono=teraz if koniec else None)
+        else:
+            wynik = 'gotowe'
+            zmiany = dict(stan=wynik, blad=None, plik=nazwa, rozmiar=rozmiar, zakonczono=datetime.utcnow())
+        # Zadanie przejęte w międzyczasie przez inny proces (przekroczony JOB_TIMEOUT_SECONDS) nie jest nadpisywane
+        db.session.execute(t.update().where(t.c.id == row.id, t.c.proby == row.proby).values(**zmiany))
+        db.session.commit()
+        _zadania_procesu.pop(row.id, None)
+        m = app.extensions['metrics']
+        m.inc('blachy_jobs_total', rodzaj=row.rodzaj, wynik=wynik)
+        m.observe('blachy_job_duration_seconds', time.perf_counter() - start, rodzaj=row.rodzaj)
+        m.flush()
+        return True
+
+# Zamykanie procesu (gunicorn: worker_exit, także przy wymianie po max_requests): wątki kończą
+# bieżące zadania w JOB_STOP_SECONDS, a niedokończone od razu wracają do kolejki, zamiast czekać
+# JOB_TIMEOUT_SECONDS. Przerwana próba się liczy – po JOB_MAX_ATTEMPTS zadanie kończy się błędem.
+def zatrzymaj_zadania(app):
+    if app.extensions['job_workers'].stop(app.config['JOB_STOP_SECONDS']) or not _zadania_procesu:
+        return
+    with app.app_context():
+        t = Job.__table__
+        teraz = datetime.utcnow()
+        for job_id, proby in list(_zadania_procesu.items()):
+            koniec = proby >= app.config['JOB_MAX_ATTEMPTS']
+            db.session.execute(
+                t.update().where(t.c.id == job_id, t.c.stan == 'w_toku', t.c.proby == proby)
+                .values(stan='blad' if koniec else 'oczekuje', blad="Przerwane przy zamykaniu procesu",
+                        nastepna_proba=teraz, rozpoczeto=None, zakonczono=teraz if koniec else None)
+            )
+        db.session.commit()
+        app.logger.warning("Zadania %s przerwane przy zamykaniu procesu", sorted(_zadania_procesu))
+
+# Usuwa zakończone zadania starsze niż JOB_RETENTION_SECONDS razem z ich plikami
+def usun_stare_zadania():
+    granica = datetime.utcnow() - timedelta(seconds=current_app.config['JOB_RETENTION_SECONDS'])
+    t = Job.__table__
+    stare = db.session.execute(t.delete().where(t.c.zakonczono < granica).returning(t.c.id)).scalars().all()
+    for job_id in stare:
+        job_artifacts.remove(job_id)
+    return len(stare)
+
+# Oferta TXT: {"pozycje": [[blacha_id, ilość], ...]}
+@zadanie('oferta')
+def _zadanie_oferta(job_id, parametry):
+    ilosci = dict(parametry['pozycje'])
+    sheets = {b.id: b for b in Blacha.query.filter(Blacha.id.in_([int(i) for i in ilosci])).all()}
+    pozycje = [(sheets[int(sid)], qty) for sid, qty in parametry['pozycje'] if int(sid) in sheets]
+    nazwa = 'oferta_braki.txt'
+    return nazwa, job_artifacts.write(job_id, nazwa, [tresc_oferty(pozycje).encode('utf-8')])
+
+# Archiwum ZIP zamówienia: {"order_id": id}. Wynik zadania i pamięć podręczna eksportów dzielą
+# jeden plik na dysku (dowiązanie twarde) – niezmienione zamówienie nie jest pakowane ponownie.
+@zadanie('eksport_zamowienia')
+def _zadanie_eksport_zamowienia(job_id, parametry):
+    order = Order.query.options(
+        db.joinedload(Order.items).joinedload(OrderItem.blacha)
+    ).filter_by(id=parametry['order_id']).first()
+    if order is None:
+        raise BladZadania(f"Zamówienie {parametry['order_id']} nie istnieje")
+    entries = pliki_eksportu(order)
+    key = export_cache_key(order.id, entries)
+    nazwa = f"order_{order.id}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.zip"
+    cached = export_cache.get(key)
+    if cached:
+        return nazwa, job_artifacts.link(job_id, nazwa, cached)
+    rozmiar = job_artifacts.write(job_id, nazwa, stream_zip(entries))
+    export_cache.add(key, job_artifacts.path(job_id, nazwa))
+    return nazwa, rozmiar
+
+def opis_zadania(job):
+    dane = {'id': job.id, 'rodzaj': job.rodzaj, 'stan': job.stan, 'proby': job.proby,
+            'utworzono': job.utworzono, 'zakonczono': job.zakonczono, 'blad': job.blad}
+    if job.stan == 'gotowe':
+        dane.update(plik=job.plik, rozmiar=job.rozmiar,
+                    pobierz=url_for('main.plik_zadania', job_id=job.id))
+    return dane
+
+@bp.cli.command('jobs-worker')
+@click.option('--raz', is_flag=True, help='Wykonaj oczekujące zadania i zakończ.')
+def jobs_worker_command(raz):
+    """Wykonuje zadania w tle w tym procesie (np. przy JOB_WORKERS=0 w serwerze)."""
+    workers = current_app.extensions['job_workers']
+    if raz:
+        click.echo(f"Wykonane zadania: {workers.run_until_empty()}")
+        return
+    while True:
+        if not workers.run_until_empty():
+            time.sleep(current_app.config['JOB_POLL_SECONDS'])
+
+@bp.cli.command('jobs-purge')
+def jobs_purge_command():
+    """Usuwa zakończone zadania starsze niż JOB_RETENTION_SECONDS wraz z plikami."""
+    usuniete = usun_stare_zadania()
+    db.session.commit()
+    click.echo(f"Usunięte zadania: {usuniete}")
+
 # ROUTES DLA OFERTY / ZAMÓWIEŃ
 
 # Route: Generowanie oferty - tutaj możemy pozostawić prosty widok oferty (alternatywnie używamy offer_override)
-@app.route('/orders', methods=['GET', 'POST'])
+@bp.route('/orders', methods=['GET', 'POST'])
 def orders():
     if request.method == 'POST':
-        # Przetwarzamy dane z formularza override, zapisujemy je w sesji, itd.
-        sheet_ids = session.get('override_ids', [])
+        # Aktualizacja ilości pozycji szkicu; puste pole – ilość domyślna (niedobór), 0 usuwa pozycję
         order_items = []
-        for sid in sheet_ids:
-            sheet = Blacha.query.get(int(sid))
-            override_qty = request.form.get(f"order_qty_{sid}")
+        pozycje = pozycje_szkicu()
+        domyslne = ilosci_do_zamowienia([item['sheet'] for item in pozycje])
+        for item in pozycje:
+            sheet = item['sheet']
+            override_qty = request.form.get(f"order_qty_{sheet.id}")
             try:
-                qty = int(override_qty) if override_qty and override_qty.strip() else (sheet.stan_potrzebny - sheet.stan_obecny)
+                qty = int(override_qty) if override_qty and override_qty.strip() else domyslne[sheet.id]
             except ValueError:
-                qty = (sheet.stan_potrzebny - sheet.stan_obecny)
+                qty = domyslne[sheet.id]
             if qty > 0:
                 order_items.append({'sheet': sheet, 'qty': qty})
-        session['order_items'] = [(item['sheet'].id, item['qty']) for item in order_items]
-        return render_template('orders.html', order_items=order_items)
+        zapisz_pozycje_szkicu([(item['sheet'].id, item['qty']) for item in order_items])
+        odpowiedz = render_template('orders.html', order_items=order_items)
+        db.session.commit()
+        return odpowiedz
     else:
-        order_data = session.get('order_items', [])
-        if not order_data:
+        order_items = pozycje_szkicu()
+        if not order_items:
             # Zamiast przekierowywać, wyświetlamy pustą stronę z komunikatem:
             flash("Brak danych zamówienia. Wygeneruj ofertę najpierw.")
-            return render_template('orders.html', order_items=[])
-        order_items = []
-        for sid, qty in order_data:
-            sheet = Blacha.query.get(sid)
-            if sheet and qty > 0:
-                order_items.append({'sheet': sheet, 'qty': qty})
         return render_template('orders.html', order_items=order_items)
 
-@app.route('/order_form', methods=['POST'])
+@bp.route('/orders/usun/<int:sheet_id>', methods=['POST'])
+def delete_draft_item(sheet_id):
+    draft = szkic_zamowienia()
+    if draft is not None:
+        t = DraftOrderLine.__table__
+        db.session.execute(t.delete().where(t.c.draft_id == draft.id, t.c.blacha_id == sheet_id))
+        draft.zmieniono = datetime.utcnow()
+        db.session.commit()
+    return redirect(url_for('main.orders'))
+
+@bp.route('/order_form', methods=['POST'])
 def order_form():
     # Pobierz zaznaczone ID z głównego formularza
     override_ids = request.form.getlist("override")
@@ -147,110 +2031,100 @@ def order_form():
     except ValueError:
         override_ids = []
 
-    # Pobierz wszystkie blachy
-    all_blachy = Blacha.query.all()
-
-    # Automatycznie do zamówienia trafiają blachy z niedoborem
-    shortage_blachy = [b for b in all_blachy if b.stan_obecny < b.stan_potrzebny]
-
-    # Łączymy te z niedoborem z dodatkowymi (override_ids)
-    combined_ids = set([b.id for b in shortage_blachy] + override_ids)
+    # Automatycznie do zamówienia trafiają blachy z niedoborem, razem z dodatkowymi (override_ids)
+    blachy = Blacha.query.filter(db.or_(
+        warunek_brakow(),
+        Blacha.id.in_(override_ids),
+    )).order_by(Blacha.id).all()
 
     # Ustal domyślną ilość dla każdej pozycji:
-    # Dla blach z niedoborem: (stan_potrzebny - stan_obecny)
+    # Dla blach z niedoborem: ilość z planowania (niedobór, zapas minimalny, partie)
     # Dla dodatkowych (checkbox): domyślnie 1 (lub możesz ustalić inną wartość)
-    order_items = {}
-    for b in Blacha.query.filter(Blacha.id.in_(list(combined_ids))).all():
-        if b.stan_obecny < b.stan_potrzebny:
-            default_qty = b.stan_potrzebny - b.stan_obecny
-        else:
-            default_qty = 1
-        order_items[b.id] = default_qty
+    domyslne = ilosci_do_zamowienia(blachy)
+    orders = [{'sheet': b, 'qty': domyslne[b.id] or 1} for b in blachy]
 
-    orders = []
-    for b_id, qty in order_items.items():
-        sheet = Blacha.query.get(b_id)
-        orders.append({'sheet': sheet, 'qty': qty})
-
-    session['order_items'] = [(item['sheet'].id, item['qty']) for item in orders]
-    return render_template('order_form.html', order_items=orders)
+    zapisz_pozycje_szkicu([(item['sheet'].id, item['qty']) for item in orders])
+    odpowiedz = render_template('order_form.html', order_items=orders)
+    db.session.commit()
+    return odpowiedz
 
-@app.route('/export_order/<int:order_id>', methods=['GET'])
+@bp.route('/export_order/<int:order_id>', methods=['GET'])
 def export_order(order_id):
-    order = Order.query.get_or_404(order_id)
-
-    # Katalog bazowy eksportu – np. "exports" w folderze uploadów
-    export_base = os.path.join(app.config['UPLOAD_FOLDER'], "exports")
-    if not os.path.exists(export_base):
-        os.makedirs(export_base)
-
-    # Tworzymy unikalną nazwę folderu eksportu, np. "order_3_20250310_153045"
-    folder_name = f"order_{order.id}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}"
-    export_folder = os.path.join(export_base, folder_name)
-    os.makedirs(export_folder)
-
-    # Generujemy plik TXT z ofertą
-    header = "Oferta Na Braki:\n"
-    separator = "----------------------------------------------------------\n"
-    col_headers = "{:<4}{:<8}{:<12}{:<10}{:<15}\n".format("lp.", "KOD", "Materiał", "Grubość", "Brak (szt.)")
-    content = header + separator + col_headers + separator
-    for i, item in enumerate(order.items, start=1):
-        sheet = item.blacha
-        missing_str = f"{item.quantity} szt."
-        content += "{:<4}{:<8}{:<12}{:<10}{:<15}\n".format(i, sheet.kod, sheet.material or '-', sheet.grubosc or '-',
-                                                           missing_str)
-
-    txt_path = os.path.join(export_folder, "oferta_braki.txt")
-    with open(txt_path, "w", encoding="utf-8") as f:
-        f.write(content)
-
-    # Kopiujemy pliki DXF i PDF dla każdej pozycji, o ile istnieją
+    order = Order.query.options(
+        db.joinedload(Order.items).joinedload(OrderItem.blacha)
+    ).filter_by(id=order_id).first_or_404()
+
+    # Niezmienione zamówienie wysyłamy od razu z pamięci podręcznej eksportów
+    entries = pliki_eksportu(order)
+    cached = export_cache.get(export_cache_key(order.id, entries))
+    if cached:
+        download_name = f"order_{order.id}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.zip"
+        dodaj_bajty('eksport_zip_cache', os.path.getsize(cached))
+        return send_file(cached, as_attachment=True, download_name=download_name)
+
+    # Kopiowanie i kompresja plików odbywa się w tle; strona zadania poda link do pobrania
+    job_id = zlec_zadanie('eksport_zamowienia', {'order_id': order.id}).id
+    db.session.commit()
+    uruchom_zadania()
+    return redirect(url_for('main.zadanie_szczegoly', job_id=job_id))
+
+# Plik TXT z ofertą oraz pliki DXF i PDF dla każdej pozycji zamówienia, o ile istnieją:
+# lista (nazwa w archiwum, treść lub ścieżka) dla stream_zip
+def pliki_eksportu(order):
+    content = tresc_oferty([(item.blacha, item.quantity) for item in order.items])
+    entries = [("oferta_braki.txt", content.encode("utf-8"))]
+    keys = {f for item in order.items for f in (item.blacha.dxf_filename, item.blacha.pdf_filename) if f}
+    # W archiwum pliki z magazynu dostają swoje oryginalne nazwy
+    original_names = dict(db.session.execute(
+        db.select(Blob.key, Blob.nazwa_oryginalna).where(Blob.key.in_(keys))
+    ).all())
+    arcnames = {"oferta_braki.txt"}
+    added = set()
     for item in order.items:
         sheet = item.blacha
-        if sheet.dxf_filename:
-            src_dxf = os.path.join(app.config['UPLOAD_FOLDER'], sheet.dxf_filename)
-            if os.path.exists(src_dxf):
-                shutil.copy(src_dxf, export_folder)
-        if sheet.pdf_filename:
-            src_pdf = os.path.join(app.config['UPLOAD_FOLDER'], sheet.pdf_filename)
-            if os.path.exists(src_pdf):
-                shutil.copy(src_pdf, export_folder)
-
-    # Tworzymy plik ZIP z zawartością folderu eksportu
-    zip_filename = folder_name + ".zip"
-    zip_path = os.path.join(export_base, zip_filename)
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(export_folder):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, export_folder)
-                zipf.write(file_path, arcname)
-
-    # Usuwamy tymczasowy folder eksportu
-    shutil.rmtree(export_folder)
-
-    # Wysyłamy plik ZIP do pobrania (przeglądarka otworzy okno pobierania)
-    return send_file(zip_path, as_attachment=True)
+        for key in (sheet.dxf_filename, sheet.pdf_filename):
+            if not key or key in added:
+                continue
+            src = blob_store.path(key)
+            if not os.path.exists(src):
+                continue
+            arcname = original_names.get(key) or key
+            if arcname in arcnames:
+                arcname = f"{sheet.kod}_{arcname}"
+            entries.append((arcname, src))
+            arcnames.add(arcname)
+            added.add(key)
+    return entries
+
+# Klucz eksportu zmienia się razem z treścią oferty lub którymkolwiek z plików
+def export_cache_key(order_id, entries):
+    h = hashlib.sha256(f"order:{order_id}".encode())
+    for arcname, source in entries:
+        h.update(arcname.encode())
+        if isinstance(source, bytes):
+            h.update(hashlib.sha256(source).digest())
+        else:
+            st = os.stat(source)
+            h.update(f"{st.st_size}:{st.st_mtime_ns}".encode())
+    return h.hexdigest()
 
 # Route: Offer Override - user enters override quantities for selected sheets.
-@app.route('/offer_override', methods=['POST'])
+@bp.route('/offer_override', methods=['POST'])
 def offer_override():
     override_ids = request.form.getlist("override")
     if not override_ids:
         flash("Nie wybrano żadnych blach do zamówienia!")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     try:
         override_ids = [int(x) for x in override_ids]
     except ValueError:
         override_ids = []
-    # Zapisujemy wybrane ID do sesji
-    session['override_ids'] = override_ids
     # Pobieramy tylko wybrane blachy
     sheets = Blacha.query.filter(Blacha.id.in_(override_ids)).all()
     return render_template('offer_override.html', sheets=sheets)
 
 # Route: Generate TXT Offer based on override quantities entered by user.
-@app.route('/generate_txt', methods=['POST'])
+@bp.route('/generate_txt', methods=['POST'])
 def generate_txt():
     sheet_ids = request.form.getlist("sheet_ids")
     override_data = {}
@@ -263,46 +2137,41 @@ def generate_txt():
 
     # Pobieramy wybrane blachy
     sheets = Blacha.query.filter(Blacha.id.in_(override_data.keys())).all()
+    domyslne = ilosci_do_zamowienia(sheets)
     offer_items = []
     for b in sheets:
-        default_qty = b.stan_potrzebny - b.stan_obecny
-        qty = override_data.get(b.id) if override_data.get(b.id) is not None else default_qty
+        qty = override_data.get(b.id) if override_data.get(b.id) is not None else domyslne[b.id]
         # Dodajemy tylko, gdy ilość > 0
         if qty > 0:
             offer_items.append({'sheet': b, 'qty': qty})
 
     if not offer_items:
         flash("Brak blach do oferty!")
-        return redirect(url_for('index'))
-
-    # Generujemy treść oferty TXT
-    header = "Oferta Na Braki:\n"
-    separator = "----------------------------------------------------------\n"
-    col_headers = "{:<4}{:<8}{:<12}{:<10}{:<15}\n".format("lp.", "KOD", "Materiał", "Grubość", "Brak (szt.)")
-    content = header + separator + col_headers + separator
-    for i, item in enumerate(offer_items, start=1):
-        qty_str = f"{item['qty']} szt."
-        content += "{:<4}{:<8}{:<12}{:<10}{:<15}\n".format(i, item['sheet'].kod, item['sheet'].material or '-', item['sheet'].grubosc or '-', qty_str)
+        return redirect(url_for('main.index'))
 
-    txt_path = os.path.join(app.config['UPLOAD_FOLDER'], 'oferta_braki.txt')
-    with open(txt_path, 'w', encoding='utf-8') as f:
-        f.write(content)
+    # Plik TXT powstaje w tle, każda oferta we własnym katalogu zadania (wcześniej wspólny
+    # oferta_braki.txt, nadpisywany przez równoległe oferty)
+    pozycje = [(item['sheet'].id, item['qty']) for item in offer_items]
+    session['zadanie_oferty'] = zlec_zadanie('oferta', {'pozycje': pozycje}).id
 
-    # Możesz przekierować do podsumowania zamówienia lub wysłać plik
-    # Na przykład, zapisz dane zamówienia w sesji i przekieruj do /orders:
-    session['order_items'] = [(item['sheet'].id, item['qty']) for item in offer_items]
-    return redirect(url_for('orders'))
+    # Pozycje oferty trafiają do szkicu zamówienia, przekierowanie do /orders:
+    zapisz_pozycje_szkicu(pozycje)
+    db.session.commit()
+    uruchom_zadania()
+    return redirect(url_for('main.orders'))
 
-@app.route('/delete_order_item/<int:order_item_id>', methods=['POST'])
+@bp.route('/delete_order_item/<int:order_item_id>', methods=['POST'])
 def delete_order_item(order_item_id):
     order_item = OrderItem.query.get_or_404(order_item_id)
     order_id = order_item.order_id
     db.session.delete(order_item)
+    db.session.flush()
+    przelicz_podsumowanie_zamowien([order_id])
     db.session.commit()
     flash("Pozycja zamówienia została usunięta.")
-    return redirect(url_for('order_details', order_id=order_id))
+    return redirect(url_for('main.order_details', order_id=order_id))
 
-@app.route('/delete_order/<int:order_id>', methods=['POST'])
+@bp.route('/delete_order/<int:order_id>', methods=['POST'])
 def delete_order(order_id):
     order = Order.query.get_or_404(order_id)
     # Usuń wszystkie powiązane OrderItem
@@ -311,60 +2180,224 @@ def delete_order(order_id):
     db.session.delete(order)
     db.session.commit()
     flash("Zamówienie zostało usunięte.")
-    return redirect(url_for('orders_list'))
+    return redirect(url_for('main.orders_list'))
 
 # Confirm Order Route - update stock based on confirmed order.
-@app.route('/confirm_order', methods=['POST'])
+@bp.route('/confirm_order', methods=['POST'])
 def confirm_order():
     # Pobierz przesłane ID blach
     order_sheet_ids = request.form.getlist("order_sheet_id")
     if not order_sheet_ids:
         flash("Brak pozycji w zamówieniu.")
-        return redirect(url_for('order_form'))
-
-    # Utwórz nowe zamówienie
-    new_order = Order()
-    db.session.add(new_order)
+        return redirect(url_for('main.order_form'))
 
-    # Dla każdej blachy pobierz zamówioną ilość
-    for sid in order_sheet_ids:
-        sheet = Blacha.query.get(int(sid))
+    # Zamówione ilości; każda blacha liczona raz, pozycje z ilością <= 0 pomijamy
+    ilosci = {}
+    for sid in dict.fromkeys(order_sheet_ids):
         override_qty = request.form.get(f"order_qty_{sid}")
         try:
-            qty = int(override_qty)
+            sheet_id, qty = int(sid), int(override_qty)
         except (ValueError, TypeError):
-            qty = 0
+            continue
         if qty > 0:
-            # Dodajemy pozycję do zamówienia
-            order_item = OrderItem(order=new_order, blacha_id=sheet.id, quantity=qty)
-            db.session.add(order_item)
-            # Aktualizacja stanu magazynowego – dodajemy zamówioną ilość
-            sheet.stan_obecny += qty
+            ilosci[sheet_id] = qty
+    # Jedno zapytanie o wszystkie blachy zamówienia, jeszcze przed rozpoczęciem zapisu
+    istniejace = set(db.session.execute(db.select(Blacha.id).where(Blacha.id.in_(ilosci))).scalars())
+    pozycje = [(sheet_id, qty) for sheet_id, qty in ilosci.items() if sheet_id in istniejace]
 
+    # Utwórz nowe zamówienie
+    new_order = Order()
+    db.session.add(new_order)
+    db.session.flush()
+
+    if pozycje:
+        # Pozycje zamówienia zbiorczo
+        db.session.execute(OrderItem.__table__.insert(), [
+            {'order_id': new_order.id, 'blacha_id': sheet_id, 'quantity': qty} for sheet_id, qty in pozycje
+        ])
+        # Aktualizacja stanu magazynowego w bazie (stan_obecny + ilość), bez odczytu i zapisu
+        # wartości w Pythonie – równoległe potwierdzenia nie nadpisują sobie stanów
+        t = Blacha.__table__
+        db.session.execute(
+            t.update().where(t.c.id == db.bindparam('b_id'))
+            .values(stan_obecny=t.c.stan_obecny + db.bindparam('qty')),
+            [{'b_id': sheet_id, 'qty': qty} for sheet_id, qty in pozycje],
+        )
+        zapisz_ruchy(db.session.connection(), [
+            {'blacha_id': sheet_id, 'delta': qty, 'rodzaj': 'zamowienie', 'order_id': new_order.id}
+            for sheet_id, qty in pozycje
+        ])
+    przelicz_podsumowanie_zamowien([new_order.id])
+
+    # Szkic zamówienia nie jest już potrzebny
+    draft = szkic_zamowienia()
+    if draft is not None:
+        usun_szkic(draft)
     db.session.commit()
-    # Czyścimy dane zamówienia z sesji
-    session.pop('order_items', None)
-    session.pop('override_ids', None)
     flash("Zamówienie potwierdzone, stany zaktualizowane!")
-    return redirect(url_for('orders_list'))
+    return redirect(url_for('main.orders_list'))
 
-@app.route('/orders_list')
+@bp.route('/orders_list')
+@strona_wersjonowana
 def orders_list():
-    orders = Order.query.order_by(Order.order_date.desc()).all()
-    return render_template('orders_list.html', orders=orders)
-
-@app.route('/order_details/<int:order_id>')
+    limit = current_app.config['ORDERS_PAGE_SIZE']
+    before_id = request.args.get('po', type=int)
+    lp_start = request.args.get('lp', 1, type=int)
+    # Filtr dat (RRRR-MM-DD), oba końce włącznie
+    date_from = request.args.get('od', '').strip()
+    date_to = request.args.get('do', '').strip()
+    query = Order.query
+    try:
+        if date_from:
+            query = query.filter(Order.order_date >= datetime.strptime(date_from, '%Y-%m-%d'))
+        if date_to:
+            query = query.filter(Order.order_date < datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1))
+    except ValueError:
+        flash("Niepoprawna data, oczekiwany format RRRR-MM-DD.")
+        return redirect(url_for('main.orders_list'))
+    # Najnowsze pierwsze; stronicowanie po id (kolejne zamówienia mają rosnące id i datę)
+    if before_id is not None:
+        query = query.filter(Order.id < before_id)
+    orders = query.order_by(Order.id.desc()).limit(limit + 1).all()
+    next_before = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        next_before = orders[-1].id
+    return render_template('orders_list.html', orders=orders, next_before=next_before, lp_start=lp_start,
+                           date_from=date_from, date_to=date_to)
+
+@bp.route('/order_details/<int:order_id>')
 def order_details(order_id):
-    order = Order.query.get_or_404(order_id)
-    return render_template('order_details.html', order=order)
+    # Pozycje, blachy i ich geometria w jednym zapytaniu
+    order = Order.query.options(
+        db.joinedload(Order.items).joinedload(OrderItem.blacha).joinedload(Blacha.geometria)
+    ).filter(Order.id == order_id).first_or_404()
+    geometria = podsumowanie_geometrii([(item.blacha, item.quantity) for item in order.items])
+    return render_template('order_details.html', order=order, geometria=geometria)
+
+# Planowanie: stan bieżący i do trzech scenariuszy "co jeśli" liczonych obok siebie.
+# Parametry w adresie (GET), więc porównanie można zapisać lub przesłać dalej.
+SCENARIUSZE_PLANOWANIA = ('s1', 's2', 's3')
+
+def _liczba_z_formularza(pole, domyslna):
+    wartosc = request.args.get(pole, '').strip()
+    if not wartosc:
+        return domyslna
+    liczba = int(wartosc)
+    if liczba < 0:
+        raise ValueError(pole)
+    return liczba
+
+def _lista_id(tekst):
+    return [czesc.strip() for czesc in tekst.replace(';', ',').split(',') if czesc.strip()]
+
+# Powtórzenia projektów w formacie "12, 15x2" (id projektu, opcjonalnie krotność)
+def _powtorzenia(tekst):
+    powtorz = {}
+    for czesc in _lista_id(tekst.lower()):
+        project_id, _, razy = czesc.partition('x')
+        powtorz[int(project_id)] = powtorz.get(int(project_id), 0) + (int(razy) if razy else 1)
+    return powtorz
+
+def scenariusz_z_formularza(prefix, numer):
+    pola = ('nazwa', 'archiwizuj', 'powtorz', 'zapas', 'partia', 'minimum')
+    if not any(request.args.get(f"{prefix}_{p}", '').strip() for p in pola):
+        return None
+    bazowe = parametry_planowania()
+    return Scenario(
+        name=request.args.get(f"{prefix}_nazwa", '').strip() or f"Scenariusz {numer}",
+        archive=tuple(int(x) for x in _lista_id(request.args.get(f"{prefix}_archiwizuj", ''))),
+        repeat=_powtorzenia(request.args.get(f"{prefix}_powtorz", '')),
+        safety_stock=_liczba_z_formularza(f"{prefix}_zapas", bazowe['safety_stock']),
+        lot_size=max(_liczba_z_formularza(f"{prefix}_partia", bazowe['lot_size']), 1),
+        min_order=_liczba_z_formularza(f"{prefix}_minimum", bazowe['min_order']),
+    )
+
+@bp.route('/planowanie')
+def planowanie():
+    scenariusze = [Scenario(**parametry_planowania())]
+    for numer, prefix in enumerate(SCENARIUSZE_PLANOWANIA, start=1):
+        try:
+            scenariusz = scenariusz_z_formularza(prefix, numer)
+        except ValueError:
+            flash(f"Scenariusz {numer}: niepoprawne parametry (liczby całkowite >= 0, powtórzenia jako \"12, 15x2\").")
+            continue
+        if scenariusz is not None:
+            scenariusze.append(scenariusz)
+    dane = dane_planowania()
+    wyniki = [plan(dane, s) for s in scenariusze]
+    limit = current_app.config['MRP_TOP_ITEMS']
+    # Nazwy projektów wskazanych w scenariuszach
+    ids = {p for s in scenariusze for p in (*s.archive, *s.repeat)}
+    projekty = dict(db.session.execute(db.select(Project.id, Project.nazwa).where(Project.id.in_(ids))).all()) \
+        if ids else {}
+    return render_template('planowanie.html', wyniki=wyniki, bazowy=wyniki[0],
+                           pozycje=[largest_orders(dane, w, limit) for w in wyniki],
+                           projekty=projekty, liczba_blach=len(dane), prefiksy=SCENARIUSZE_PLANOWANIA)
+
+# Stan magazynu na koniec wybranego dnia (RRRR-MM-DD) obok stanu obecnego; zmiany=1 – tylko różniące się
+@bp.route('/magazyn/stany')
+def stany_na_dzien():
+    limit = current_app.config['INDEX_PAGE_SIZE']
+    after_id = request.args.get('po', type=int)
+    lp_start = request.args.get('lp', 1, type=int)
+    tylko_zmiany = request.args.get('zmiany') == '1'
+    data = request.args.get('data', '').strip() or datetime.utcnow().strftime('%Y-%m-%d')
+    try:
+        chwila = datetime.strptime(data, '%Y-%m-%d') + timedelta(days=1)
+    except ValueError:
+        flash("Niepoprawna data, oczekiwany format RRRR-MM-DD.")
+        return redirect(url_for('main.stany_na_dzien'))
+    blachy = db.session.execute(
+        zapytanie_stanow_na_chwile(chwila, after_id=after_id, limit=limit + 1, tylko_zmiany=tylko_zmiany)
+    ).all()
+    next_after = None
+    if len(blachy) > limit:
+        blachy = blachy[:limit]
+        next_after = blachy[-1].id
+    return render_template('stany_na_dzien.html', blachy=blachy, data=data, tylko_zmiany=tylko_zmiany,
+                           next_after=next_after, lp_start=lp_start)
+
+# Zadania w tle: lista ostatnich, stan pojedynczego (strona odświeża się, dopóki zadanie trwa) i wynik
+@bp.route('/zadania')
+def zadania():
+    jobs = Job.query.order_by(Job.id.desc()).limit(current_app.config['ORDERS_PAGE_SIZE']).all()
+    return render_template('zadania.html', jobs=jobs, nazwy_zadan=NAZWY_ZADAN, stany_zadan=STANY_ZADAN)
+
+@bp.route('/zadania/<int:job_id>')
+def zadanie_szczegoly(job_id):
+    return render_template('zadanie.html', job=Job.query.get_or_404(job_id),
+                           nazwy_zadan=NAZWY_ZADAN, stany_zadan=STANY_ZADAN)
+
+@bp.route('/zadania/<int:job_id>/plik')
+def plik_zadania(job_id):
+    job = Job.query.get_or_404(job_id)
+    if job.stan != 'gotowe':
+        abort(404)
+    path = job_artifacts.path(job.id, job.plik)
+    if not os.path.isfile(path):
+        abort(404)
+    dodaj_bajty('pobranie_zadania', job.rozmiar or 0)
+    return send_file(path, as_attachment=True, download_name=job.plik, conditional=True)
 
 # GŁÓWNE TRASY DLA BLACH
-@app.route('/')
+@bp.route('/')
+@strona_wersjonowana
 def index():
-    blachy = Blacha.query.all()
-    return render_template('index.html', blachy=blachy)
-
-@app.route('/dodaj', methods=['GET', 'POST'])
+    limit = current_app.config['INDEX_PAGE_SIZE']
+    after_id = request.args.get('po', type=int)
+    lp_start = request.args.get('lp', 1, type=int)
+    only_shortages = request.args.get('braki') == '1'
+    # Pobieramy o jeden wiersz więcej, żeby wiedzieć, czy istnieje następna strona
+    blachy = inventory_snapshot(after_id=after_id, limit=limit + 1, only_shortages=only_shortages)
+    next_after = None
+    if len(blachy) > limit:
+        blachy = blachy[:limit]
+        next_after = blachy[-1].id
+    return render_template('index.html', blachy=blachy, next_after=next_after,
+                           lp_start=lp_start, only_shortages=only_shortages)
+
+@bp.route('/dodaj', methods=['GET', 'POST'])
 def dodaj():
     if request.method == 'POST':
         nowa_blacha = Blacha(
@@ -378,18 +2411,19 @@ def dodaj():
         )
         db.session.add(nowa_blacha)
         db.session.commit()
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     materials = MaterialOption.query.all()
     thicknesses = ThicknessOption.query.all()
     return render_template('dodaj.html', materials=materials, thicknesses=thicknesses)
 
-@app.route('/materialy')
+@bp.route('/materialy')
+@strona_wersjonowana
 def materialy():
     materials = MaterialOption.query.all()
     thicknesses = ThicknessOption.query.all()
     return render_template('materialy.html', materials=materials, thicknesses=thicknesses)
 
-@app.route('/materialy/dodaj_material', methods=['GET', 'POST'])
+@bp.route('/materialy/dodaj_material', methods=['GET', 'POST'])
 def dodaj_material():
     if request.method == 'POST':
         nazwa = request.form['nazwa']
@@ -400,10 +2434,10 @@ def dodaj_material():
         except Exception as e:
             db.session.rollback()
             flash("Błąd przy dodawaniu materiału: " + str(e))
-        return redirect(url_for('materialy'))
+        return redirect(url_for('main.materialy'))
     return render_template('dodaj_material.html')
 
-@app.route('/materialy/dodaj_thickness', methods=['GET', 'POST'])
+@bp.route('/materialy/dodaj_thickness', methods=['GET', 'POST'])
 def dodaj_thickness():
     if request.method == 'POST':
         wartosc = request.form['wartosc']
@@ -414,10 +2448,12 @@ def dodaj_thickness():
         except Exception as e:
             db.session.rollback()
             flash("Błąd przy dodawaniu grubości: " + str(e))
-        return redirect(url_for('materialy'))
+        return redirect(url_for('main.materialy'))
     return render_template('dodaj_thickness.html')
 
-@app.route('/edytuj/<int:blacha_id>', methods=['GET', 'POST'])
+RUCHY_NA_STRONIE_BLACHY = 20
+
+@bp.route('/edytuj/<int:blacha_id>', methods=['GET', 'POST'])
 def edytuj_blacha(blacha_id):
     blacha = Blacha.query.get_or_404(blacha_id)
     if request.method == 'POST':
@@ -429,133 +2465,551 @@ def edytuj_blacha(blacha_id):
         blacha.thickness_id = int(request.form['thickness_id'])
         blacha.rodzaj_obrobki = request.form['rodzaj_obrobki']
         db.session.commit()
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     materials = MaterialOption.query.all()
     thicknesses = ThicknessOption.query.all()
-    return render_template('edytuj.html', blacha=blacha, materials=materials, thicknesses=thicknesses)
-
-@app.route('/projekty')
+    # Ostatnie ruchy magazynowe blachy
+    ruchy = db.session.execute(
+        db.select(StockMovement).where(StockMovement.blacha_id == blacha_id)
+        .order_by(StockMovement.id.desc()).limit(RUCHY_NA_STRONIE_BLACHY)
+    ).scalars().all()
+    return render_template('edytuj.html', blacha=blacha, materials=materials, thicknesses=thicknesses, ruchy=ruchy)
+
+@bp.route('/projekty')
+@strona_wersjonowana
 def projekty():
-    projekty = Project.query.all()
-    return render_template('projekty.html', projekty=projekty)
+    # Domyślnie tylko projekty aktywne; archiwum=1 – zarchiwizowane
+    archiwum = request.args.get('archiwum') == '1'
+    projekty = Project.query.filter(Project.archived.is_(archiwum)).order_by(Project.id).all()
+    return render_template('projekty.html', projekty=projekty, archiwum=archiwum)
 
-@app.route('/projekty/dodaj', methods=['GET', 'POST'], endpoint='dodaj_projekt')
+@bp.route('/projekty/dodaj', methods=['GET', 'POST'], endpoint='dodaj_projekt')
 def dodaj_projekt():
     if request.method == 'POST':
         nowy_projekt = Project(nazwa=request.form['nazwa'])
         db.session.add(nowy_projekt)
         db.session.commit()
-        return redirect(url_for('projekty'))
+        return redirect(url_for('main.projekty'))
     return render_template('dodaj_projekt.html')
 
-@app.route('/projekty/<int:projekt_id>', methods=['GET', 'POST'])
+@bp.route('/projekty/<int:projekt_id>', methods=['GET', 'POST'])
 def projekt_szczegoly(projekt_id):
-    projekt = Project.query.get_or_404(projekt_id)
+    projekt = Project.query.options(
+        db.selectinload(Project.items).joinedload(ProjectItem.blacha)
+    ).filter_by(id=projekt_id).first_or_404()
     if request.method == 'POST':
+        if projekt.archived:
+            flash("Projekt jest zarchiwizowany – przywróć go, aby dodać wpis.")
+            return redirect(url_for('main.projekt_szczegoly', projekt_id=projekt_id))
         # Odczytanie wybranej blachy oraz ilości
         try:
             blacha_id = int(request.form['blacha_id'])
             ilosc = int(request.form['ilosc'])
         except (KeyError, ValueError):
             flash("Niepoprawne dane formularza!")
-            return redirect(url_for('projekt_szczegoly', projekt_id=projekt_id))
+            return redirect(url_for('main.projekt_szczegoly', projekt_id=projekt_id))
+        if db.session.get(Blacha, blacha_id) is None:
+            flash("Wybierz blachę z listy podpowiedzi.")
+            return redirect(url_for('main.projekt_szczegoly', projekt_id=projekt_id))
 
         # Dodajemy nowy wpis do projektu
         nowy_element = ProjectItem(project_id=projekt.id, blacha_id=blacha_id, ilosc=ilosc)
         db.session.add(nowy_element)
         db.session.commit()
         flash("Wpis został dodany do projektu!")
-        return redirect(url_for('projekt_szczegoly', projekt_id=projekt.id))
+        return redirect(url_for('main.projekt_szczegoly', projekt_id=projekt.id))
 
-    # Pobieramy wszystkie blachy, aby umożliwić wybór przy dodawaniu wpisu
-    wszystkie_blachy = Blacha.query.all()
-    return render_template('projekt_szczegoly.html', projekt=projekt, blachy=wszystkie_blachy)
+    # Pozycje projektu zarchiwizowanego (tylko do odczytu)
+    archiwalne = db.session.execute(
+        db.select(ProjectItemArchive).options(db.joinedload(ProjectItemArchive.blacha))
+        .where(ProjectItemArchive.project_id == projekt.id).order_by(ProjectItemArchive.id)
+    ).scalars().all() if projekt.archived else []
+    # Blachę do nowego wpisu wybiera się przez wyszukiwarkę (/api/v1/blachy/szukaj)
+    return render_template('projekt_szczegoly.html', projekt=projekt, archiwalne=archiwalne)
 
-@app.route('/projekty/item/edit/<int:item_id>', methods=['GET', 'POST'], endpoint='edit_project_item')
+@bp.route('/projekty/item/edit/<int:item_id>', methods=['GET', 'POST'], endpoint='edit_project_item')
 def edit_project_item(item_id):
     item = ProjectItem.query.get_or_404(item_id)
     if request.method == 'POST':
-        item.blacha_id = int(request.form['blacha_id'])
-        item.ilosc = int(request.form['ilosc'])
+        try:
+            blacha_id = int(request.form['blacha_id'])
+            ilosc = int(request.form['ilosc'])
+        except (KeyError, ValueError):
+            flash("Niepoprawne dane formularza!")
+            return redirect(url_for('main.edit_project_item', item_id=item_id))
+        if db.session.get(Blacha, blacha_id) is None:
+            flash("Wybierz blachę z listy podpowiedzi.")
+            return redirect(url_for('main.edit_project_item', item_id=item_id))
+        item.blacha_id = blacha_id
+        item.ilosc = ilosc
         db.session.commit()
-        return redirect(url_for('projekt_szczegoly', projekt_id=item.project_id))
-    all_blachy = Blacha.query.all()
-    return render_template('edit_project_item.html', item=item, blachy=all_blachy)
+        return redirect(url_for('main.projekt_szczegoly', projekt_id=item.project_id))
+    return render_template('edit_project_item.html', item=item)
 
-@app.route('/projekty/item/delete/<int:item_id>', methods=['POST'], endpoint='delete_project_item')
+@bp.route('/projekty/item/delete/<int:item_id>', methods=['POST'], endpoint='delete_project_item')
 def delete_project_item(item_id):
     item = ProjectItem.query.get_or_404(item_id)
     projekt_id = item.project_id
     db.session.delete(item)
     db.session.commit()
     flash("Wpis projektu został usunięty.")
-    return redirect(url_for('projekt_szczegoly', projekt_id=projekt_id))
+    return redirect(url_for('main.projekt_szczegoly', projekt_id=projekt_id))
 
-@app.route('/project/archive/<int:project_id>', methods=['POST'])
+@bp.route('/project/archive/<int:project_id>', methods=['POST'])
 def archive_project(project_id):
-    project = Project.query.get_or_404(project_id)
-    for item in project.items:
-        item.fulfilled = True
-    # Optionally set an archive flag on project if needed
-    # project.archived = True
+    Project.query.get_or_404(project_id)
+    archiwizuj_projekty([project_id])
     db.session.commit()
     flash("Projekt zarchiwizowany, zapotrzebowanie usunięte.")
-    return redirect(url_for('projekty'))
+    return redirect(url_for('main.projekty'))
+
+@bp.route('/project/unarchive/<int:project_id>', methods=['POST'])
+def unarchive_project(project_id):
+    Project.query.get_or_404(project_id)
+    przywroc_projekty([project_id])
+    db.session.commit()
+    flash("Projekt przywrócony, zapotrzebowanie ponownie uwzględnione.")
+    return redirect(url_for('main.projekt_szczegoly', projekt_id=project_id))
 
-@app.route('/usun/<int:blacha_id>', methods=['POST'])
+@bp.route('/usun/<int:blacha_id>', methods=['POST'])
 def usun_blacha(blacha_id):
     blacha = Blacha.query.get_or_404(blacha_id)
+    # Blacha z pozycjami projektów (także zarchiwizowanych) zostaje – usunięcie zgubiłoby ich historię
+    projekty = db.session.execute(
+        db.select(Project.nazwa).where(db.or_(
+            Project.id.in_(db.select(ProjectItem.project_id).where(ProjectItem.blacha_id == blacha.id)),
+            Project.id.in_(db.select(ProjectItemArchive.project_id).where(ProjectItemArchive.blacha_id == blacha.id)),
+        )).order_by(Project.nazwa)
+    ).scalars().all()
+    if projekty:
+        flash(f"Blacha {blacha.kod} jest używana w projektach: {', '.join(projekty)} – nie można jej usunąć.")
+        return redirect(url_for('main.index'))
+    # Pliki, do których nie odwołuje się już żadna blacha, zostaną usunięte z magazynu
+    for column in BLOB_COLUMNS:
+        zwolnij_blob(getattr(blacha, column))
     db.session.delete(blacha)
     db.session.commit()
     flash("Blacha została usunięta")
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
-@app.route('/upload/<int:blacha_id>', methods=['GET', 'POST'])
+@bp.route('/upload/<int:blacha_id>', methods=['GET', 'POST'])
 def upload_file(blacha_id):
     blacha = Blacha.query.get_or_404(blacha_id)
     if request.method == 'POST':
+        new_dxf = new_image = False
         # Upload PDF
         if 'pdf' in request.files:
             file_pdf = request.files['pdf']
             if file_pdf and allowed_file(file_pdf.filename) and file_pdf.filename.lower().endswith('.pdf'):
-                filename = secure_filename(file_pdf.filename)
-                pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file_pdf.save(pdf_path)
-                blacha.pdf_filename = filename
+                podmien_plik(blacha, 'pdf_filename', file_pdf)
 
         # Upload DXF
         if 'dxf' in request.files:
             file_dxf = request.files['dxf']
             if file_dxf and allowed_file(file_dxf.filename) and file_dxf.filename.lower().endswith('.dxf'):
-                filename = secure_filename(file_dxf.filename)
-                dxf_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file_dxf.save(dxf_path)
-                blacha.dxf_filename = filename
+                podmien_plik(blacha, 'dxf_filename', file_dxf)
+                new_dxf = True
 
         # Upload obrazu
         if 'image' in request.files:
             file_image = request.files['image']
             if file_image and allowed_image_file(file_image.filename):
-                filename = secure_filename(file_image.filename)
-                image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file_image.save(image_path)
-                blacha.image_filename = filename
+                podmien_plik(blacha, 'image_filename', file_image)
+                new_image = True
 
         db.session.commit()
+        if new_image:
+            # Miniatury generowane są w tle, lista blach nie musi na nie czekać
+            thumbnail_cache.submit(blob_store.path(blacha.image_filename))
+        if new_dxf:
+            analizuj_dxf_w_tle(blacha.dxf_filename)
         flash('Pliki zostały załadowane')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
 
     return render_template('upload.html', blacha=blacha)
 
-@app.route('/files/<filename>')
+@bp.route('/files/<filename>')
 def uploaded_file(filename):
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    return send_file(file_path, mimetype='application/pdf', as_attachment=False)
+    file_path = blob_store.path(filename)
+    if not os.path.isfile(file_path):
+        abort(404)
+    # Plik z magazynu ma nazwę ze skrótu treści – skrót służy jako silny ETag
+    immutable = is_blob_key(filename)
+    max_age = current_app.config['FILES_MAX_AGE'] if immutable else None
+    prefix = current_app.config['X_ACCEL_REDIRECT_PREFIX']
+    if prefix:
+        # nginx sam obsłuży Range i warunkowe żądania dla wskazanej lokalizacji
+        response = Response(mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+        rel_path = os.path.relpath(file_path, current_app.config['UPLOAD_FOLDER']).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{rel_path}"
+        if max_age:
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+    else:
+        # send_file obsługuje ETag, Last-Modified, If-None-Match (304), Range oraz USE_X_SENDFILE
+        response = send_file(
+            file_path,
+            as_attachment=False,
+            conditional=True,
+            etag=filename.split('.', 1)[0] if immutable else True,
+            max_age=max_age,
+        )
+    if immutable:
+        response.cache_control.immutable = True
+    if response.status_code == 200:
+        dodaj_bajty('pobranie', os.path.getsize(file_path))
+    return response
+
+# Miniatura obrazu blachy; dla starszych obrazów generowana przy pierwszym żądaniu
+@bp.route('/files/<rozmiar>/<filename>')
+def thumbnail(rozmiar, filename):
+    src_path = blob_store.path(filename)
+    if rozmiar not in THUMBNAIL_SIZES or not os.path.isfile(src_path):
+        abort(404)
+    thumb_path = thumbnail_cache.get(src_path, rozmiar)
+    if thumb_path is None:
+        # Brak Pillow albo plik nie jest obrazem – wysyłamy oryginał
+        return redirect(url_for('main.uploaded_file', filename=filename))
+    return send_file(thumb_path, mimetype='image/jpeg', conditional=True,
+                     max_age=current_app.config['FILES_MAX_AGE'] if is_blob_key(filename) else None)
+
+@bp.route('/dane', methods=['GET', 'POST'])
+def import_danych():
+    raport = None
+    if request.method == 'POST':
+        rodzaj = request.form.get('rodzaj')
+        plik = request.files.get('plik')
+        if rodzaj not in KOLUMNY_DANYCH or not plik or not plik.filename:
+            flash("Wybierz rodzaj danych i plik do importu.")
+            return redirect(url_for('main.import_danych'))
+        fmt = 'jsonl' if plik.filename.lower().endswith(('.jsonl', '.json')) else 'csv'
+        raport = importuj_dane(rodzaj, plik.stream, fmt)
+        dodaj_bajty('import_danych', request.content_length or 0)
+        if request.accept_mimetypes.best == 'application/json':
+            return raport
+    return render_template('import.html', raport=raport, kolumny=KOLUMNY_DANYCH, formaty=FORMATY_DANYCH)
+
+@bp.route('/dane/<rodzaj>.<fmt>')
+def eksport_danych(rodzaj, fmt):
+    if rodzaj not in KOLUMNY_DANYCH or fmt not in FORMATY_DANYCH:
+        abort(404)
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    return Response(
+        licz_bajty('eksport_danych', stream_with_context(eksportuj_dane(rodzaj, fmt))),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{rodzaj}.{fmt}"'},
+    )
+
+# API JSON
+
+# Zwarta odpowiedź JSON; dla GET z ETagiem, więc klient może odpytywać warunkowo (304)
+def api_odpowiedz(data, status=200):
+    response = current_app.response_class(
+        json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str),
+        status=status,
+        mimetype='application/json',
+    )
+    if request.method == 'GET' and status == 200:
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+def api_blad(status, komunikat, **extra):
+    return api_odpowiedz(dict(blad=komunikat, **extra), status=status)
+
+def api_limit():
+    limit = request.args.get('limit', current_app.config['API_PAGE_SIZE'], type=int)
+    return max(1, min(limit, current_app.config['API_PAGE_SIZE_MAX']))
+
+def api_stan(row):
+    return {'id': row.id, 'kod': row.kod, 'stan_obecny': row.stan_obecny, 'stan_potrzebny': row.stan_potrzebny}
+
+@bp.route('/api/v1/blachy')
+def api_blachy():
+    limit = api_limit()
+    rows = inventory_snapshot(after_id=request.args.get('po', type=int), limit=limit + 1,
+                              only_shortages=request.args.get('braki') == '1')
+    nastepna = rows[limit - 1].id if len(rows) > limit else None
+    return api_odpowiedz({
+        'blachy': [{
+            'id': r.id, 'kod': r.kod, 'nazwa': r.nazwa, 'nazwa_prosta': r.nazwa_prosta,
+            'material': r.material, 'grubosc': r.grubosc, 'rodzaj_obrobki': r.rodzaj_obrobki,
+            'stan_obecny': r.stan_obecny, 'stan_potrzebny': r.stan_potrzebny,
+        } for r in rows[:limit]],
+        'nastepna': nastepna,
+    })
+
+# Podpowiedzi dla formularzy: blachy pasujące do początków słów w q, najlepsze trafienia pierwsze
+@bp.route('/api/v1/blachy/szukaj')
+def api_szukaj():
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    rows = szukaj_blach(request.args.get('q', ''), limit)
+    return api_odpowiedz({'blachy': [{
+        'id': r.id, 'kod': r.kod, 'nazwa': r.nazwa, 'nazwa_prosta': r.nazwa_prosta,
+        'material': slowniki().materialy.get(r.material_id), 'grubosc': slowniki().grubosci.get(r.thickness_id),
+        'stan_obecny': r.stan_obecny,
+    } for r in rows]})
+
+# Stany wielu blach jednym zapytaniem: GET ?kod=A&kod=B lub POST {"kody": [...]}
+@bp.route('/api/v1/blachy/stany', methods=['GET', 'POST'])
+def api_stany():
+    if request.method == 'POST':
+        kody = (request.get_json(silent=True) or {}).get('kody')
+    else:
+        kody = request.args.getlist('kod')
+    if not isinstance(kody, list) or not all(isinstance(k, str) for k in kody):
+        return api_blad(400, "Oczekiwano listy kodów 'kody'.")
+    if len(kody) > current_app.config['API_BATCH_MAX']:
+        return api_blad(400, f"Maksymalnie {current_app.config['API_BATCH_MAX']} kodów w jednym żądaniu.")
+    rows = db.session.execute(
+        db.select(Blacha.id, Blacha.kod, Blacha.stan_obecny, Blacha.zapotrzebowanie.label('stan_potrzebny'))
+        .where(Blacha.kod.in_(kody))
+    ).all()
+    stany = {r.kod: api_stan(r) for r in rows}
+    return api_odpowiedz({'stany': stany, 'nieznane': [k for k in kody if k not in stany]})
+
+# Rodzaje ruchów dozwolone w korektach API (zuzycie – pobranie blach do produkcji)
+RODZAJE_KOREKT = ('korekta', 'zuzycie')
+
+# Zbiorcza korekta stanów: {"korekty": [{"kod": "A001", "delta": -3, "rodzaj": "zuzycie"}, ...]}
+# Wszystkie korekty wykonywane są w jednej transakcji – błąd w dowolnej pozycji odrzuca całość.
+@bp.route('/api/v1/blachy/stany/korekty', methods=['POST'])
+def api_korekty_stanow():
+    korekty = (request.get_json(silent=True) or {}).get('korekty')
+    if not isinstance(korekty, list) or not korekty:
+        return api_blad(400, "Oczekiwano niepustej listy 'korekty'.")
+    if len(korekty) > current_app.config['API_BATCH_MAX']:
+        return api_blad(400, f"Maksymalnie {current_app.config['API_BATCH_MAX']} korekt w jednym żądaniu.")
+    bledy = []
+    delty = {}
+    ruchy = {}
+    for i, k in enumerate(korekty):
+        kod = k.get('kod') if isinstance(k, dict) else None
+        delta = k.get('delta') if isinstance(k, dict) else None
+        rodzaj = k.get('rodzaj', 'korekta') if isinstance(k, dict) else None
+        if not isinstance(kod, str) or not isinstance(delta, int) or isinstance(delta, bool):
+            bledy.append({'pozycja': i, 'blad': "wymagane pola 'kod' (tekst) i 'delta' (liczba całkowita)"})
+            continue
+        if rodzaj not in RODZAJE_KOREKT:
+            bledy.append({'pozycja': i, 'blad': f"'rodzaj' musi być jednym z: {', '.join(RODZAJE_KOREKT)}"})
+            continue
+        # Kilka korekt tej samej blachy sumujemy (w księdze osobno dla każdego rodzaju)
+        delty[kod] = delty.get(kod, 0) + delta
+        ruchy[(kod, rodzaj)] = ruchy.get((kod, rodzaj), 0) + delta
+    znane = set(db.session.execute(db.select(Blacha.kod).where(Blacha.kod.in_(delty))).scalars())
+    bledy += [{'kod': kod, 'blad': 'nieznany kod'} for kod in delty if kod not in znane]
+    if bledy:
+        return api_blad(422, "Korekty odrzucone, stany bez zmian.", bledy=bledy)
+    t = Blacha.__table__
+    db.session.execute(
+        t.update().where(t.c.kod == db.bindparam('b_kod'))
+        .values(stan_obecny=t.c.stan_obecny + db.bindparam('delta')),
+        [{'b_kod': kod, 'delta': delta} for kod, delta in delty.items()],
+    )
+    rows = db.session.execute(
+        db.select(Blacha.id, Blacha.kod, Blacha.stan_obecny, Blacha.zapotrzebowanie.label('stan_potrzebny'))
+        .where(Blacha.kod.in_(delty))
+    ).all()
+    ids = {r.kod: r.id for r in rows}
+    zapisz_ruchy(db.session.connection(), [
+        {'blacha_id': ids[kod], 'delta': delta, 'rodzaj': rodzaj, 'opis': 'API'} for (kod, rodzaj), delta in ruchy.items()
+    ])
+    db.session.commit()
+    return api_odpowiedz({'stany': {r.kod: api_stan(r) for r in rows}})
+
+# Stany wszystkich blach na chwilę: ?data=RRRR-MM-DD (koniec dnia) lub ?chwila=RRRR-MM-DDTGG:MM:SS (UTC)
+@bp.route('/api/v1/blachy/stany/historia')
+def api_stany_historia():
+    try:
+        if request.args.get('chwila'):
+            chwila = datetime.fromisoformat(request.args['chwila'])
+        else:
+            chwila = datetime.strptime(request.args.get('data', ''), '%Y-%m-%d') + timedelta(days=1)
+    except ValueError:
+        return api_blad(400, "Oczekiwano parametru 'data' (RRRR-MM-DD) lub 'chwila' (ISO 8601).")
+    limit = api_limit()
+    rows = db.session.execute(zapytanie_stanow_na_chwile(
+        chwila, after_id=request.args.get('po', type=int), limit=limit + 1,
+        tylko_zmiany=request.args.get('zmiany') == '1',
+    )).all()
+    return api_odpowiedz({
+        'chwila': chwila.isoformat(),
+        'stany': [{'id': r.id, 'kod': r.kod, 'stan': r.stan_na_dzien, 'stan_obecny': r.stan_obecny}
+                  for r in rows[:limit]],
+        'nastepna': rows[limit - 1].id if len(rows) > limit else None,
+    })
+
+@bp.route('/api/v1/projekty')
+def api_projekty():
+    limit = api_limit()
+    liczba = (
+        db.select(db.func.count(ProjectItem.id))
+        .where(ProjectItem.project_id == Project.id)
+        .scalar_subquery()
+    )
+    # Projekty aktywne albo (archiwum=1) zarchiwizowane; pozycje liczone z właściwej tabeli
+    archiwum = request.args.get('archiwum') == '1'
+    if archiwum:
+        liczba = (
+            db.select(db.func.count(ProjectItemArchive.id))
+            .where(ProjectItemArchive.project_id == Project.id)
+            .scalar_subquery()
+        )
+    stmt = (db.select(Project.id, Project.nazwa, liczba.label('liczba_pozycji'))
+            .where(Project.archived.is_(archiwum)).order_by(Project.id).limit(limit + 1))
+    po = request.args.get('po', type=int)
+    if po is not None:
+        stmt = stmt.where(Project.id > po)
+    rows = db.session.execute(stmt).all()
+    return api_odpowiedz({
+        'projekty': [{'id': r.id, 'nazwa': r.nazwa, 'liczba_pozycji': r.liczba_pozycji, 'zarchiwizowany': archiwum}
+                     for r in rows[:limit]],
+        'nastepna': rows[limit - 1].id if len(rows) > limit else None,
+    })
+
+@bp.route('/api/v1/projekty/<int:projekt_id>')
+def api_projekt(projekt_id):
+    projekt = db.session.get(Project, projekt_id)
+    if projekt is None:
+        return api_blad(404, "Nie ma takiego projektu.")
+    pozycje = ProjectItemArchive if projekt.archived else ProjectItem
+    rows = db.session.execute(
+        db.select(pozycje.id, Blacha.kod, pozycje.ilosc, pozycje.fulfilled)
+        .join(Blacha, Blacha.id == pozycje.blacha_id)
+        .where(pozycje.project_id == projekt_id)
+        .order_by(pozycje.id)
+    ).all()
+    return api_odpowiedz({
+        'id': projekt.id,
+        'nazwa': projekt.nazwa,
+        'zarchiwizowany': projekt.archived,
+        'pozycje': [{'id': r.id, 'kod': r.kod, 'ilosc': r.ilosc, 'zrealizowane': bool(r.fulfilled)} for r in rows],
+    })
+
+@bp.route('/api/v1/zamowienia')
+def api_zamowienia():
+    limit = api_limit()
+    liczba = (
+        db.select(db.func.count(OrderItem.id))
+        .where(OrderItem.order_id == Order.id)
+        .scalar_subquery()
+    )
+    # Najnowsze zamówienia najpierw; kursor 'po' to id ostatniego zamówienia z poprzedniej strony
+    stmt = db.select(Order.id, Order.order_date, liczba.label('liczba_pozycji')).order_by(Order.id.desc()).limit(limit + 1)
+    po = request.args.get('po', type=int)
+    if po is not None:
+        stmt = stmt.where(Order.id < po)
+    rows = db.session.execute(stmt).all()
+    return api_odpowiedz({
+        'zamowienia': [{'id': r.id, 'data': r.order_date.isoformat(), 'liczba_pozycji': r.liczba_pozycji}
+                       for r in rows[:limit]],
+        'nastepna': rows[limit - 1].id if len(rows) > limit else None,
+    })
+
+@bp.route('/api/v1/zamowienia/<int:order_id>')
+def api_zamowienie(order_id):
+    order = db.session.get(Order, order_id)
+    if order is None:
+        return api_blad(404, "Nie ma takiego zamówienia.")
+    rows = db.session.execute(
+        db.select(OrderItem.id, Blacha.kod, OrderItem.quantity)
+        .join(Blacha, Blacha.id == OrderItem.blacha_id)
+        .where(OrderItem.order_id == order_id)
+        .order_by(OrderItem.id)
+    ).all()
+    return api_odpowiedz({
+        'id': order.id,
+        'data': order.order_date.isoformat(),
+        'pozycje': [{'id': r.id, 'kod': r.kod, 'ilosc': r.quantity} for r in rows],
+    })
+
+# Eksport zamówienia w tle: 202 z opisem zadania, którego stan klient odpytuje pod "adres"
+@bp.route('/api/v1/zamowienia/<int:order_id>/eksport', methods=['POST'])
+def api_eksport_zamowienia(order_id):
+    if db.session.get(Order, order_id) is None:
+        return api_blad(404, "Nie ma takiego zamówienia.")
+    job = zlec_zadanie('eksport_zamowienia', {'order_id': order_id})
+    # Opis przed zatwierdzeniem – commit unieważnia obiekt i wymusiłby ponowny odczyt
+    dane = dict(opis_zadania(job), adres=url_for('main.api_zadanie', job_id=job.id))
+    db.session.commit()
+    uruchom_zadania()
+    return api_odpowiedz(dane, status=202)
+
+@bp.route('/api/v1/zadania/<int:job_id>')
+def api_zadanie(job_id):
+    job = db.session.get(Job, job_id)
+    if job is None:
+        return api_blad(404, "Nie ma takiego zadania.")
+    return api_odpowiedz(opis_zadania(job))
+
+# Scenariusze planowania: {"scenariusze": [{"nazwa": "...", "archiwizuj": [3], "powtorz": {"5": 2},
+#   "dodatkowe": {"A001": 10}, "przyjecia": {"A002": 5}, "zapas": 2, "partia": 10, "minimum": 0}]}
+# Zwraca podsumowanie stanu bieżącego i każdego scenariusza oraz pozycje do zamówienia.
+def _scenariusz_z_json(dane, kody, numer):
+    if not isinstance(dane, dict):
+        raise ValueError("scenariusz musi być obiektem")
+    bazowe = parametry_planowania()
+    def ilosci(pole):
+        wartosci = dane.get(pole) or {}
+        if not isinstance(wartosci, dict) or not all(isinstance(v, int) for v in wartosci.values()):
+            raise ValueError(f"'{pole}' musi być obiektem kod -> liczba całkowita")
+        nieznane = [k for k in wartosci if k not in kody]
+        if nieznane:
+            raise ValueError(f"nieznane kody w '{pole}': {', '.join(nieznane[:10])}")
+        return {kody[k]: v for k, v in wartosci.items()}
+    liczby = {}
+    for pole, klucz in (('zapas', 'safety_stock'), ('partia', 'lot_size'), ('minimum', 'min_order')):
+        wartosc = dane.get(pole, bazowe[klucz])
+        if not isinstance(wartosc, int) or isinstance(wartosc, bool) or wartosc < 0:
+            raise ValueError(f"'{pole}' musi być liczbą całkowitą >= 0")
+        liczby[klucz] = wartosc
+    try:
+        archive = tuple(int(x) for x in dane.get('archiwizuj') or ())
+        repeat = {int(k): int(v) for k, v in (dane.get('powtorz') or {}).items()}
+    except (TypeError, ValueError, AttributeError):
+        raise ValueError("'archiwizuj' to lista id projektów, 'powtorz' obiekt id -> krotność")
+    return Scenario(name=str(dane.get('nazwa') or f"Scenariusz {numer}"), archive=archive, repeat=repeat,
+                    extra_demand=ilosci('dodatkowe'), receipts=ilosci('przyjecia'), **liczby)
+
+@bp.route('/api/v1/planowanie', methods=['POST'])
+def api_planowanie():
+    body = request.get_json(silent=True) or {}
+    scenariusze = body.get('scenariusze', [])
+    if not isinstance(scenariusze, list) or len(scenariusze) > 10:
+        return api_blad(400, "Oczekiwano listy 'scenariusze' (najwyżej 10).")
+    limit = body.get('limit', current_app.config['MRP_TOP_ITEMS'])
+    if not isinstance(limit, int) or isinstance(limit, bool) or limit < 0:
+        return api_blad(400, "'limit' musi być liczbą całkowitą >= 0.")
+    limit = min(limit, current_app.config['API_PAGE_SIZE_MAX'])
+    dane = dane_planowania()
+    kody = dict(zip(dane.code, dane.sheet_id.tolist()))
+    bledy = []
+    lista = [Scenario(**parametry_planowania())]
+    for i, s in enumerate(scenariusze):
+        try:
+            lista.append(_scenariusz_z_json(s, kody, i + 1))
+        except ValueError as e:
+            bledy.append({'pozycja': i, 'blad': str(e)})
+    if bledy:
+        return api_blad(422, "Niepoprawne scenariusze.", bledy=bledy)
+    wyniki = []
+    for scenariusz in lista:
+        wynik = plan(dane, scenariusz)
+        wyniki.append({
+            'nazwa': scenariusz.name,
+            'braki': wynik.shortages,
+            'netto': wynik.total_net,
+            'do_zamowienia': wynik.total_order,
+            'pozycje': [{'id': p[0], 'kod': p[1], 'stan_obecny': p[2], 'zapotrzebowanie': p[3],
+                         'netto': p[4], 'do_zamowienia': p[5]} for p in largest_orders(dane, wynik, limit)],
+        })
+    return api_odpowiedz({'blachy': len(dane), 'scenariusze': wyniki})
 
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
         # Create the database if it doesn't exist
-        db.create_all()
+        init_db()
 
         # # Add material options if they don't exist
         # if not MaterialOption.query.filter_by(nazwa="Stal").first():
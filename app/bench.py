@@ -0,0 +1,360 @@
+# Benchmark aplikacji na syntetycznych danych: czasy odpowiedzi (percentyle) i liczba zapytań SQL
+# dla każdej trasy, z limitami zapytań wykrywającymi regresje N+1.
+#
+#   python bench.py                          # domyślny rozmiar danych
+#   python bench.py --blachy 50000 -n 50 -o ../bench_output.txt
+#
+# Dane tworzone są w katalogu tymczasowym (baza + uploads), produkcyjna baza nie jest używana.
+# Kod wyjścia 1, gdy któraś trasa przekroczy swój limit zapytań.
+import io
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+
+from app import (Blacha, Blob, MaterialOption, Order, OrderItem, Project, ProjectItem,
+                 StockMovement, ThicknessOption, archiwizuj_projekty, blob_store, create_app, db, init_db,
+                 przelicz_podsumowanie_zamowien, przelicz_zapotrzebowanie, utworz_migawke, zapisz_geometrie)
+from dxf_geometry import analyze_file
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Maksymalna liczba zapytań SQL na jedno żądanie – nie może rosnąć z liczbą wierszy
+QUERY_BUDGETS = {
+    'index': 2,
+    'index_braki': 2,
+    'index_strona_2': 2,
+    'order_form': 6,
+    'orders': 3,
+    'offer_override': 2,
+    'generate_txt': 8,
+    'export_order': 6,
+    'api_eksport_zamowienia': 5,
+    'api_zadanie': 1,
+    'zadania': 1,
+    'orders_list': 2,
+    'orders_list_daty': 2,
+    'order_details': 2,
+    'projekty': 2,
+    'projekty_archiwum': 2,
+    'projekt_szczegoly': 3,
+    'edit_project_item': 3,
+    'materialy': 3,
+    'planowanie': 2,
+    'planowanie_scenariusze': 3,
+    'edytuj': 4,
+    'plik': 2,
+    'miniatura': 2,
+    'eksport_blachy_csv': 2,
+    'api_blachy': 1,
+    'api_stany': 1,
+    'api_szukaj': 2,
+    'api_projekty': 1,
+    'api_projekt': 2,
+    'api_zamowienia': 1,
+    'api_zamowienie': 2,
+    'api_planowanie': 2,
+    'stany_na_dzien': 3,
+    'stany_na_dzien_zmiany': 3,
+    'api_stany_historia': 3,
+    'confirm_order': 8,
+}
+
+CHUNK = 5000
+
+
+def _wstaw(model, wiersze):
+    for i in range(0, len(wiersze), CHUNK):
+        db.session.execute(model.__table__.insert(), wiersze[i:i + CHUNK])
+
+
+def _dxf(szerokosc, wysokosc, promien):
+    linie = ['0', 'SECTION', '2', 'ENTITIES',
+             '0', 'LWPOLYLINE', '90', '4', '70', '1']
+    for x, y in ((0, 0), (szerokosc, 0), (szerokosc, wysokosc), (0, wysokosc)):
+        linie += ['10', str(x), '20', str(y)]
+    linie += ['0', 'CIRCLE', '10', str(szerokosc / 2), '20', str(wysokosc / 2), '40', str(promien),
+              '0', 'ENDSEC', '0', 'EOF']
+    return '\n'.join(linie).encode()
+
+
+def _png(rnd):
+    buf = io.BytesIO()
+    Image.new('RGB', (800, 600), tuple(rnd.randrange(256) for _ in range(3))).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def _pdf(nr):
+    return (b"%PDF-1.4\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n"
+            b"2 0 obj<</Type/Pages/Kids[]/Count 0>>endobj\n% rysunek " + str(nr).encode() + b"\n%%EOF\n")
+
+
+def _pliki(rnd, liczba):
+    # Zwraca listy kluczy magazynu dla PDF, DXF i obrazów; geometria DXF liczona od razu
+    klucze = {'pdf': [], 'dxf': [], 'png': []}
+    for nr in range(liczba):
+        zrodla = [('pdf', _pdf(nr)),
+                  ('dxf', _dxf(rnd.randint(100, 2000), rnd.randint(100, 1500), rnd.randint(5, 40)))]
+        if Image is not None:
+            zrodla.append(('png', _png(rnd)))
+        for ext, dane in zrodla:
+            key, size = blob_store.put(io.BytesIO(dane), ext)
+            db.session.merge(Blob(key=key, rozmiar=size, liczba_odwolan=0, nazwa_oryginalna=f"plik_{nr}.{ext}"))
+            klucze[ext].append(key)
+            if ext == 'dxf':
+                sha, geometria, blad = analyze_file(blob_store.path(key))
+                zapisz_geometrie(key, sha, geometria, blad)
+    db.session.commit()
+    return klucze
+
+
+def _historia_stanow(start):
+    # Księga ruchów: bilans otwarcia sprzed pierwszego zamówienia, potem przyjęcia z zamówień
+    # w kolejności dat, tak żeby suma ruchów dawała stan_obecny; migawki jak w działającej aplikacji
+    m = StockMovement.__table__
+    przyjete = (db.select(OrderItem.blacha_id, db.func.sum(OrderItem.quantity).label('ilosc'))
+                .group_by(OrderItem.blacha_id).subquery())
+    db.session.execute(m.insert().from_select(
+        ['blacha_id', 'czas', 'delta', 'rodzaj'],
+        db.select(Blacha.id, db.literal(start - timedelta(days=1), db.DateTime),
+                  Blacha.stan_obecny - db.func.coalesce(przyjete.c.ilosc, 0), db.literal('bilans_otwarcia'))
+        .outerjoin(przyjete, przyjete.c.blacha_id == Blacha.id).order_by(Blacha.id),
+    ))
+    db.session.execute(m.insert().from_select(
+        ['blacha_id', 'czas', 'delta', 'rodzaj', 'order_id'],
+        db.select(OrderItem.blacha_id, Order.order_date, OrderItem.quantity, db.literal('zamowienie'), Order.id)
+        .join(Order, Order.id == OrderItem.order_id).order_by(Order.id, OrderItem.id),
+    ))
+    co_ile = current_app.config['STOCK_SNAPSHOT_EVERY']
+    ostatni = db.session.execute(db.select(db.func.max(StockMovement.id))).scalar() or 0
+    conn = db.session.connection()
+    for do_ruchu in range(co_ile, ostatni + co_ile, co_ile):
+        utworz_migawke(conn, do_ruchu)
+
+
+def generuj_dane(rnd, blachy, projekty, zamowienia, pliki):
+    _wstaw(MaterialOption, [{'nazwa': n} for n in ('Stal', 'Stal nierdzewna', 'Aluminium', 'Ocynk', 'Mosiądz',
+                                                     'Miedź', 'Hardox', 'Corten', 'Stal S355', 'Tytan')])
+    _wstaw(ThicknessOption, [{'wartosc': f"{g}mm"} for g in (0.8, 1, 1.5, 2, 2.5, 3, 4, 5, 6, 8, 10, 12, 15, 20)])
+    db.session.commit()
+    material_ids = db.session.execute(db.select(MaterialOption.id)).scalars().all()
+    thickness_ids = db.session.execute(db.select(ThicknessOption.id)).scalars().all()
+
+    klucze = _pliki(rnd, pliki) if pliki else {'pdf': [], 'dxf': [], 'png': []}
+    odwolania = {}
+
+    def plik(rodzaj):
+        # Część blach bez pliku, część współdzieli ten sam rysunek
+        if not klucze[rodzaj] or rnd.random() < 0.3:
+            return None
+        key = rnd.choice(klucze[rodzaj])
+        odwolania[key] = odwolania.get(key, 0) + 1
+        return key
+
+    _wstaw(Blacha, [{
+        'nazwa': f"Blacha {i}", 'nazwa_prosta': rnd.choice(('płyta', 'kątownik', 'wspornik', 'osłona', 'pokrywa')),
+        'kod': f"B{i:06d}", 'stan_obecny': rnd.randint(0, 40),
+        'material_id': rnd.choice(material_ids), 'thickness_id': rnd.choice(thickness_ids),
+        'rodzaj_obrobki': rnd.choice(('CNC', 'Palenie', 'Gięcie + Palenie', None)),
+        'pdf_filename': plik('pdf'), 'dxf_filename': plik('dxf'), 'image_filename': plik('png'),
+    } for i in range(1, blachy + 1)])
+    t = Blob.__table__
+    db.session.execute(t.update().where(t.c.key == db.bindparam('b_key')).values(liczba_odwolan=db.bindparam('n')),
+                       [{'b_key': k, 'n': n} for k, n in odwolania.items()])
+
+    _wstaw(Project, [{'nazwa': f"Projekt {i}"} for i in range(1, projekty + 1)])
+    _wstaw(ProjectItem, [{
+        'project_id': p, 'blacha_id': rnd.randint(1, blachy), 'ilosc': rnd.randint(1, 20),
+        'fulfilled': rnd.random() < 0.4,
+    } for p in range(1, projekty + 1) for _ in range(rnd.randint(3, 25))])
+    przelicz_zapotrzebowanie()
+    # Jak po kilku latach pracy: większość projektów w archiwum, aktywne pierwsze 20%
+    archiwizuj_projekty(range(projekty // 5 + 1, projekty + 1))
+
+    start = datetime.utcnow() - timedelta(days=3 * 365)
+    _wstaw(Order, [{'order_date': start + timedelta(minutes=i * 3 * 365 * 24 * 60 // max(zamowienia, 1))}
+                   for i in range(zamowienia)])
+    _wstaw(OrderItem, [{
+        'order_id': o, 'blacha_id': rnd.randint(1, blachy), 'quantity': rnd.randint(1, 50),
+    } for o in range(1, zamowienia + 1) for _ in range(rnd.randint(1, 40))])
+    przelicz_podsumowanie_zamowien()
+    _historia_stanow(start)
+    db.session.commit()
+    db.session.execute(db.text("ANALYZE"))
+    db.session.commit()
+
+
+def trasy(rnd, blachy, projekty, zamowienia, image_key):
+    # (nazwa, metoda, adres lub funkcja zwracająca adres, dane formularza / JSON)
+    losowa_blacha = lambda: rnd.randint(1, blachy)
+    zaznaczone = lambda: {'override': [str(losowa_blacha()) for _ in range(20)]}
+    wynik = [
+        ('index', 'GET', '/', None),
+        ('index_braki', 'GET', '/?braki=1', None),
+        ('index_strona_2', 'GET', lambda: f"/?po={min(500, blachy)}&lp=501", None),
+        ('order_form', 'POST', '/order_form', zaznaczone),
+        ('orders', 'GET', '/orders', None),
+        ('offer_override', 'POST', '/offer_override', zaznaczone),
+        ('generate_txt', 'POST', '/generate_txt',
+         lambda: {'sheet_ids': [str(losowa_blacha()) for _ in range(50)]}),
+        ('export_order', 'GET', lambda: f"/export_order/{rnd.randint(1, zamowienia)}", None),
+        ('api_eksport_zamowienia', 'POST', lambda: f"/api/v1/zamowienia/{rnd.randint(1, zamowienia)}/eksport", None),
+        ('api_zadanie', 'GET', '/api/v1/zadania/1', None),
+        ('zadania', 'GET', '/zadania', None),
+        ('orders_list', 'GET', '/orders_list', None),
+        ('orders_list_daty', 'GET', lambda: "/orders_list?od={:%Y-%m-%d}&do={:%Y-%m-%d}".format(
+            datetime.utcnow() - timedelta(days=400), datetime.utcnow() - timedelta(days=300)), None),
+        ('order_details', 'GET', lambda: f"/order_details/{rnd.randint(1, zamowienia)}", None),
+        ('projekty', 'GET', '/projekty', None),
+        ('projekty_archiwum', 'GET', '/projekty?archiwum=1', None),
+        ('projekt_szczegoly', 'GET', lambda: f"/projekty/{rnd.randint(1, projekty)}", None),
+        ('materialy', 'GET', '/materialy', None),
+        ('planowanie', 'GET', '/planowanie', None),
+        ('planowanie_scenariusze', 'GET', lambda: f"/planowanie?s1_archiwizuj={rnd.randint(1, projekty)}"
+         f"&s2_zapas=5&s2_partia=10&s3_powtorz={rnd.randint(1, projekty)}x2", None),
+        ('edit_project_item', 'GET', lambda: f"/projekty/item/edit/{rnd.randint(1, projekty * 3)}", None),
+        ('edytuj', 'GET', lambda: f"/edytuj/{losowa_blacha()}", None),
+        ('eksport_blachy_csv', 'GET', '/dane/blachy.csv', None),
+        ('api_blachy', 'GET', '/api/v1/blachy?limit=500', None),
+        ('api_stany', 'POST', '/api/v1/blachy/stany',
+         lambda: {'json': {'kody': [f"B{losowa_blacha():06d}" for _ in range(200)]}}),
+        ('api_szukaj', 'GET', lambda: f"/api/v1/blachy/szukaj?q=B{losowa_blacha():06d}"[:-rnd.randint(1, 3)], None),
+        ('api_projekty', 'GET', '/api/v1/projekty', None),
+        ('api_projekt', 'GET', lambda: f"/api/v1/projekty/{rnd.randint(1, projekty)}", None),
+        ('api_zamowienia', 'GET', '/api/v1/zamowienia', None),
+        ('api_zamowienie', 'GET', lambda: f"/api/v1/zamowienia/{rnd.randint(1, zamowienia)}", None),
+        ('stany_na_dzien', 'GET', lambda: "/magazyn/stany?data={:%Y-%m-%d}".format(
+            datetime.utcnow() - timedelta(days=rnd.randint(1, 3 * 365))), None),
+        ('stany_na_dzien_zmiany', 'GET', lambda: "/magazyn/stany?zmiany=1&data={:%Y-%m-%d}".format(
+            datetime.utcnow() - timedelta(days=rnd.randint(1, 3 * 365))), None),
+        ('api_stany_historia', 'GET', lambda: "/api/v1/blachy/stany/historia?limit=500&data={:%Y-%m-%d}".format(
+            datetime.utcnow() - timedelta(days=rnd.randint(1, 3 * 365))), None),
+        ('api_planowanie', 'POST', '/api/v1/planowanie',
+         lambda: {'json': {'scenariusze': [{'archiwizuj': [rnd.randint(1, projekty)]}, {'zapas': 5, 'partia': 10}]}}),
+    ]
+    if image_key:
+        wynik += [
+            ('plik', 'GET', f"/files/{image_key}", None),
+            ('miniatura', 'GET', f"/files/mini/{image_key}", None),
+        ]
+    # Zapis na końcu, żeby nie zmieniać danych pozostałych pomiarów
+    def zamowienie():
+        ids = {losowa_blacha() for _ in range(30)}
+        return {'order_sheet_id': [str(s) for s in ids], **{f"order_qty_{s}": '3' for s in ids}}
+    wynik.append(('confirm_order', 'POST', '/confirm_order', zamowienie))
+    return wynik
+
+
+def percentyl(wartosci, p):
+    wartosci = sorted(wartosci)
+    k = (len(wartosci) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(wartosci) - 1)
+    return wartosci[f] + (wartosci[c] - wartosci[f]) * (k - f)
+
+
+def zmierz(app, lista, powtorzenia):
+    licznik = [0]
+
+    def policz(*args):
+        licznik[0] += 1
+
+    with app.app_context():
+        db.event.listen(db.engine, 'before_cursor_execute', policz)
+    client = app.test_client()
+    wyniki = []
+    for nazwa, metoda, adres, dane in lista:
+        czasy, zapytania, status = [], [], None
+        # Pierwsze wywołanie rozgrzewa pamięci podręczne (słowniki, szablony), nie jest liczone
+        for i in range(powtorzenia + 1):
+            url = adres() if callable(adres) else adres
+            kwargs = dane() if callable(dane) else {}
+            if metoda == 'POST' and 'json' not in kwargs:
+                kwargs = {'data': kwargs}
+            licznik[0] = 0
+            t0 = time.perf_counter()
+            r = client.open(url, method=metoda, **kwargs)
+            r.get_data()
+            dt = time.perf_counter() - t0
+            r.close()
+            status = r.status_code
+            if i:
+                czasy.append(dt * 1000)
+                zapytania.append(licznik[0])
+        budzet = QUERY_BUDGETS.get(nazwa)
+        wyniki.append({
+            'trasa': nazwa, 'status': status,
+            'p50': percentyl(czasy, 50), 'p90': percentyl(czasy, 90), 'p99': percentyl(czasy, 99),
+            'max': max(czasy), 'sql': max(zapytania), 'budzet': budzet,
+            'przekroczony': budzet is not None and max(zapytania) > budzet,
+        })
+    return wyniki
+
+
+def raport(wyniki, parametry):
+    linie = [f"Benchmark {datetime.now():%Y-%m-%d %H:%M} – {parametry}", '',
+             f"{'trasa':<22}{'status':>7}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'SQL':>6}{'limit':>7}"]
+    for w in wyniki:
+        linie.append(f"{w['trasa']:<22}{w['status']:>7}{w['p50']:>10.1f}{w['p90']:>10.1f}{w['p99']:>10.1f}"
+                     f"{w['max']:>10.1f}{w['sql']:>6}{w['budzet'] if w['budzet'] is not None else '-':>7}"
+                     + ('  PRZEKROCZONY' if w['przekroczony'] else ''))
+    return '\n'.join(linie) + '\n'
+
+
+@click.command()
+@click.option('--blachy', default=20000, show_default=True, help='Liczba blach.')
+@click.option('--projekty', default=2000, show_default=True, help='Liczba projektów.')
+@click.option('--zamowienia', default=2000, show_default=True, help='Liczba zamówień.')
+@click.option('--pliki', default=100, show_default=True, help='Liczba różnych plików każdego rodzaju.')
+@click.option('-n', '--powtorzenia', default=20, show_default=True, help='Liczba pomiarów na trasę.')
+@click.option('--seed', default=1, show_default=True)
+@click.option('-o', '--output', type=click.Path(dir_okay=False), help='Zapis raportu do pliku.')
+@click.option('--zostaw-dane', is_flag=True, help='Nie usuwaj katalogu z wygenerowanymi danymi.')
+def main(blachy, projekty, zamowienia, pliki, powtorzenia, seed, output, zostaw_dane):
+    rnd = random.Random(seed)
+    katalog = tempfile.mkdtemp(prefix='blachy-bench-')
+    try:
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(katalog, 'blachy.db')}",
+            'UPLOAD_FOLDER': os.path.join(katalog, 'uploads'),
+            'TESTING': True,
+            # Zadania w tle wykonywałyby zapytania w trakcie pomiarów innych tras
+            'JOB_WORKERS': 0,
+            # Pomiar pełnego renderowania stron list; z pamięci stron kosztują jedno zapytanie (wersja danych)
+            'PAGE_CACHE_MAX_BYTES': 0,
+        })
+        with app.app_context():
+            init_db()
+            t0 = time.perf_counter()
+            generuj_dane(rnd, blachy, projekty, zamowienia, pliki)
+            click.echo(f"Dane wygenerowane w {time.perf_counter() - t0:.1f} s ({katalog})", err=True)
+            image_key = db.session.execute(
+                db.select(Blacha.image_filename).where(Blacha.image_filename.is_not(None)).limit(1)
+            ).scalar()
+        wyniki = zmierz(app, trasy(rnd, blachy, projekty, zamowienia, image_key), powtorzenia)
+        tekst = raport(wyniki, f"blachy={blachy} projekty={projekty} zamowienia={zamowienia} "
+                               f"pliki={pliki} powtorzenia={powtorzenia}")
+        click.echo(tekst)
+        if output:
+            with open(output, 'w', encoding='utf-8') as f:
+                f.write(tekst)
+        if any(w['przekroczony'] for w in wyniki):
+            sys.exit(1)
+    finally:
+        if zostaw_dane:
+            click.echo(f"Dane pozostawione w {katalog}", err=True)
+        else:
+            shutil.rmtree(katalog, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
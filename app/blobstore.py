@@ -0,0 +1,104 @@
+import hashlib
+import os
+import re
+import time
+import uuid
+
+CHUNK_SIZE = 64 * 1024
+
+# Klucz bloba: skrót SHA-256 zawartości + rozszerzenie, np. "3f5a...e1.pdf"
+BLOB_KEY_RE = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]{1,10}$')
+
+
+def is_blob_key(key):
+    return bool(key) and BLOB_KEY_RE.match(key) is not None
+
+
+class BlobStore:
+    # Magazyn plików adresowanych treścią. Pliki leżą w podkatalogach ab/cd/ wg skrótu,
+    # identyczne pliki zapisywane są tylko raz. Nazwy spoza magazynu (stare uploady)
+    # wskazują bezpośrednio na plik w katalogu głównym.
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        if is_blob_key(key):
+            return os.path.join(self.root, key[:2], key[2:4], key)
+        return os.path.join(self.root, key)
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def put(self, stream, ext, chunk_size=CHUNK_SIZE):
+        # Zapisuje strumień do pliku tymczasowego, licząc skrót w locie. Zwraca (klucz, rozmiar).
+        tmp_dir = os.path.join(self.root, '.tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+        h = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as tmp:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    tmp.write(chunk)
+                    size += len(chunk)
+            key = f"{h.hexdigest()}.{ext.lower()}"
+            dest = self.path(key)
+            try:
+                # Ten sam plik jest już w magazynie. Odświeżony czas modyfikacji chroni go przed
+                # delete(min_age=...) do zatwierdzenia odwołania w bazie.
+                os.utime(dest)
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                for attempt in range(2):
+                    os.makedirs(os.path.dirname(dest), exist_ok=True)
+                    try:
+                        os.replace(tmp_path, dest)
+                        break
+                    except FileNotFoundError:
+                        # Katalog shardu usunięty równolegle przez delete()
+                        if attempt:
+                            raise
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return key, size
+
+    def put_file(self, path, ext):
+        with open(path, 'rb') as f:
+            return self.put(f, ext)
+
+    def delete(self, key, min_age=0):
+        # Plik zapisany lub ponownie użyty przez put() w ciągu min_age sekund zostaje – jego nowe
+        # odwołanie mogło jeszcze nie trafić do bazy. Plik najpierw odsuwamy pod nazwę tymczasową,
+        # więc równoległy put() albo odświeży go przed sprawdzeniem, albo zapisze od nowa.
+        # Zwraca True, jeśli plik usunięto.
+        path = self.path(key)
+        trash_path = f"{path}.{uuid.uuid4().hex}.del"
+        try:
+            os.replace(path, trash_path)
+        except FileNotFoundError:
+            return False
+        if min_age and time.time() - os.stat(trash_path).st_mtime < min_age:
+            os.replace(trash_path, path)
+            return False
+        os.remove(trash_path)
+        if is_blob_key(key):
+            # Usuwamy puste katalogi shardów
+            for d in (os.path.dirname(path), os.path.dirname(os.path.dirname(path))):
+                try:
+                    os.rmdir(d)
+                except OSError:
+                    break
+        return True
+
+    def keys(self):
+        # Klucze wszystkich plików w podkatalogach magazynu
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if is_blob_key(name) and dirpath == os.path.dirname(self.path(name)):
+                    yield name
@@ -0,0 +1,312 @@
+import hashlib
+import math
+from collections import Counter
+
+# Odczyt geometrii z plików DXF (ASCII): obrys, długość cięcia, pole netto i otwory.
+# Jednostki takie jak w rysunku (zwykle mm). Bloki (INSERT) są tylko liczone, nie rozwijane.
+
+# Dokładność aproksymacji łuków (maksymalny kąt segmentu w radianach)
+ARC_STEP = math.radians(5)
+# Tolerancja łączenia końców odcinków w kontury
+JOIN_TOLERANCE = 1e-3
+
+
+def file_sha256(path, chunk_size=64 * 1024):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _pairs(path):
+    with open(path, 'rb') as f:
+        head = f.read(22)
+        if head.startswith(b'AutoCAD Binary DXF'):
+            raise ValueError("Binarny DXF nie jest obsługiwany")
+        f.seek(0)
+        lines = f.read().decode('latin-1').splitlines()
+    for i in range(0, len(lines) - 1, 2):
+        try:
+            code = int(lines[i].strip())
+        except ValueError:
+            raise ValueError(f"Niepoprawny kod grupy w linii {i + 1}")
+        yield code, lines[i + 1].strip()
+
+
+def _entities(path):
+    # Zwraca encje sekcji ENTITIES jako (typ, lista par (kod, wartość))
+    in_entities = False
+    section_name_expected = False
+    current = None
+    for code, value in _pairs(path):
+        if code == 0:
+            if current is not None:
+                yield current
+                current = None
+            if value == 'SECTION':
+                section_name_expected = True
+                continue
+            if value == 'ENDSEC':
+                in_entities = False
+                continue
+            if in_entities:
+                current = (value, [])
+            continue
+        if section_name_expected and code == 2:
+            in_entities = value == 'ENTITIES'
+            section_name_expected = False
+            continue
+        if current is not None:
+            current[1].append((code, value))
+    if current is not None:
+        yield current
+
+
+def _first(data, code, default=0.0):
+    for c, v in data:
+        if c == code:
+            return float(v)
+    return default
+
+
+def _arc_points(cx, cy, r, start, end):
+    # Punkty łuku od kąta start do end (radiany, przeciwnie do ruchu wskazówek zegara)
+    sweep = (end - start) % (2 * math.pi)
+    if sweep == 0:
+        sweep = 2 * math.pi
+    n = max(2, int(math.ceil(sweep / ARC_STEP)) + 1)
+    return [(cx + r * math.cos(start + sweep * i / (n - 1)),
+             cy + r * math.sin(start + sweep * i / (n - 1))) for i in range(n)]
+
+
+def _bulge_points(p1, p2, bulge):
+    # Segment polilinii z wybrzuszeniem (bulge = tan(kąt/4))
+    if not bulge:
+        return [p1, p2]
+    (x1, y1), (x2, y2) = p1, p2
+    chord = math.hypot(x2 - x1, y2 - y1)
+    if chord == 0:
+        return [p1, p2]
+    theta = 4 * math.atan(bulge)
+    r = chord / (2 * math.sin(theta / 2))
+    mx, my = (x1 + x2) / 2, (y1 + y2) / 2
+    d = r * math.cos(theta / 2)
+    # Środek leży po lewej stronie cięciwy dla bulge > 0
+    cx = mx - d * (y2 - y1) / chord
+    cy = my + d * (x2 - x1) / chord
+    a1 = math.atan2(y1 - cy, x1 - cx)
+    n = max(2, int(math.ceil(abs(theta) / ARC_STEP)) + 1)
+    r = abs(r)
+    return [(cx + r * math.cos(a1 + theta * i / (n - 1)),
+             cy + r * math.sin(a1 + theta * i / (n - 1))) for i in range(n)]
+
+
+def _polyline_points(vertices, closed):
+    # vertices: lista (x, y, bulge)
+    if len(vertices) < 2:
+        return []
+    points = []
+    pairs = list(zip(vertices, vertices[1:]))
+    if closed:
+        pairs.append((vertices[-1], vertices[0]))
+    for (x1, y1, b), (x2, y2, _) in pairs:
+        seg = _bulge_points((x1, y1), (x2, y2), b)
+        points.extend(seg if not points else seg[1:])
+    return points
+
+
+def _lwpolyline(data):
+    closed = bool(int(_first(data, 70)) & 1)
+    vertices = []
+    for code, value in data:
+        if code == 10:
+            vertices.append([float(value), 0.0, 0.0])
+        elif code == 20 and vertices:
+            vertices[-1][1] = float(value)
+        elif code == 42 and vertices:
+            vertices[-1][2] = float(value)
+    return _polyline_points([tuple(v) for v in vertices], closed), closed
+
+
+def _ellipse_points(data):
+    cx, cy = _first(data, 10), _first(data, 20)
+    mx, my = _first(data, 11), _first(data, 21)
+    ratio = _first(data, 40, 1.0)
+    start, end = _first(data, 41, 0.0), _first(data, 42, 2 * math.pi)
+    a = math.hypot(mx, my)
+    rot = math.atan2(my, mx)
+    sweep = (end - start) % (2 * math.pi) or 2 * math.pi
+    n = max(2, int(math.ceil(sweep / ARC_STEP)) + 1)
+    points = []
+    for i in range(n):
+        t = start + sweep * i / (n - 1)
+        x, y = a * math.cos(t), a * ratio * math.sin(t)
+        points.append((cx + x * math.cos(rot) - y * math.sin(rot),
+                       cy + x * math.sin(rot) + y * math.cos(rot)))
+    return points, math.isclose(sweep, 2 * math.pi)
+
+
+def _spline_points(data):
+    # Przybliżenie splajnu łamaną przez punkty dopasowania (lub kontrolne)
+    fit = [float(v) for c, v in data if c == 11], [float(v) for c, v in data if c == 21]
+    ctrl = [float(v) for c, v in data if c == 10], [float(v) for c, v in data if c == 20]
+    xs, ys = fit if fit[0] else ctrl
+    points = list(zip(xs, ys))
+    closed = bool(int(_first(data, 70)) & 1)
+    if closed and points and points[0] != points[-1]:
+        points.append(points[0])
+    return points, closed
+
+
+def _length(points):
+    return sum(math.hypot(x2 - x1, y2 - y1) for (x1, y1), (x2, y2) in zip(points, points[1:]))
+
+
+def _area(points):
+    s = 0.0
+    for (x1, y1), (x2, y2) in zip(points, points[1:] + points[:1]):
+        s += x1 * y2 - x2 * y1
+    return abs(s) / 2
+
+
+def _inside(point, polygon):
+    x, y = point
+    inside = False
+    for (x1, y1), (x2, y2) in zip(polygon, polygon[1:] + polygon[:1]):
+        if (y1 > y) != (y2 > y) and x < (x2 - x1) * (y - y1) / (y2 - y1) + x1:
+            inside = not inside
+    return inside
+
+
+def _key(p):
+    return (round(p[0] / JOIN_TOLERANCE), round(p[1] / JOIN_TOLERANCE))
+
+
+def _chain(paths):
+    # Łączy otwarte ścieżki (linie, łuki, otwarte polilinie) w zamknięte kontury
+    by_end = {}
+    for i, pts in enumerate(paths):
+        by_end.setdefault(_key(pts[0]), []).append(i)
+        by_end.setdefault(_key(pts[-1]), []).append(i)
+    used = [False] * len(paths)
+    loops = []
+    for i, pts in enumerate(paths):
+        if used[i]:
+            continue
+        used[i] = True
+        loop = list(pts)
+        while _key(loop[-1]) != _key(loop[0]):
+            nxt = None
+            for j in by_end.get(_key(loop[-1]), ()):
+                if not used[j]:
+                    nxt = j
+                    break
+            if nxt is None:
+                break
+            used[nxt] = True
+            seg = paths[nxt]
+            if _key(seg[0]) != _key(loop[-1]):
+                seg = seg[::-1]
+            loop.extend(seg[1:])
+        if len(loop) > 2 and _key(loop[-1]) == _key(loop[0]):
+            loops.append(loop[:-1])
+    return loops
+
+
+def analyze_dxf(path):
+    # Zwraca słownik z geometrią rysunku; ValueError dla plików, których nie da się odczytać
+    counts = Counter()
+    closed_loops = []
+    open_paths = []
+    cut_length = 0.0
+    all_points = []
+    pending_polyline = None
+
+    for etype, data in _entities(path):
+        counts[etype] += 1
+        points, closed = [], False
+        if pending_polyline is not None and etype in ('VERTEX', 'SEQEND'):
+            if etype == 'VERTEX':
+                pending_polyline['vertices'].append((_first(data, 10), _first(data, 20), _first(data, 42)))
+                continue
+            points = _polyline_points(pending_polyline['vertices'], pending_polyline['closed'])
+            closed = pending_polyline['closed']
+            pending_polyline = None
+        elif etype == 'POLYLINE':
+            pending_polyline = {'closed': bool(int(_first(data, 70)) & 1), 'vertices': []}
+            continue
+        elif etype == 'LINE':
+            points = [(_first(data, 10), _first(data, 20)), (_first(data, 11), _first(data, 21))]
+        elif etype == 'CIRCLE':
+            points = _arc_points(_first(data, 10), _first(data, 20), _first(data, 40), 0.0, 2 * math.pi)[:-1]
+            closed = True
+        elif etype == 'ARC':
+            points = _arc_points(_first(data, 10), _first(data, 20), _first(data, 40),
+                                 math.radians(_first(data, 50)), math.radians(_first(data, 51)))
+        elif etype == 'LWPOLYLINE':
+            points, closed = _lwpolyline(data)
+        elif etype == 'ELLIPSE':
+            points, closed = _ellipse_points(data)
+            if closed:
+                points = points[:-1]
+        elif etype == 'SPLINE':
+            points, closed = _spline_points(data)
+            if closed:
+                points = points[:-1]
+        if len(points) < 2:
+            continue
+        all_points.extend(points)
+        if closed:
+            closed_loops.append(points)
+            cut_length += _length(points + points[:1])
+        else:
+            open_paths.append(points)
+            cut_length += _length(points)
+
+    loops = closed_loops + _chain(open_paths)
+    # Zagnieżdżenie konturów: parzysta głębokość to materiał, nieparzysta to otwór
+    loops = sorted(((_area(lp), lp) for lp in loops), key=lambda x: -x[0])
+    net_area = 0.0
+    holes = 0
+    for i, (area, loop) in enumerate(loops):
+        depth = sum(1 for _, outer in loops[:i] if _inside(loop[0], outer))
+        if depth % 2:
+            holes += 1
+            net_area -= area
+        else:
+            net_area += area
+
+    if all_points:
+        xs = [p[0] for p in all_points]
+        ys = [p[1] for p in all_points]
+        min_x, min_y, max_x, max_y = min(xs), min(ys), max(xs), max(ys)
+    else:
+        min_x = min_y = max_x = max_y = 0.0
+
+    return {
+        'min_x': min_x,
+        'min_y': min_y,
+        'max_x': max_x,
+        'max_y': max_y,
+        'szerokosc': max_x - min_x,
+        'wysokosc': max_y - min_y,
+        'dlugosc_ciecia': cut_length,
+        'pole_netto': net_area,
+        'liczba_konturow': len(loops),
+        'liczba_otworow': holes,
+        'liczba_elementow': sum(counts.values()),
+        'elementy': dict(counts),
+    }
+
+
+def analyze_file(path):
+    # Punkt wejścia dla puli procesów: skrót pliku + geometria albo komunikat błędu
+    sha = file_sha256(path)
+    try:
+        return sha, analyze_dxf(path), None
+    except (OSError, ValueError, ZeroDivisionError) as e:
+        return sha, None, str(e)
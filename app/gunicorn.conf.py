@@ -0,0 +1,54 @@
+import glob
+import multiprocessing
+import os
+import tempfile
+
+# Konfiguracja gunicorn: kilka procesów (pre-fork), każdy z pulą wątków.
+# Długi eksport ZIP zajmuje jeden wątek, pozostałe żądania obsługują kolejne wątki i workery.
+# Przeładowanie bez przerwy w obsłudze: kill -HUP <pid mastera> (nowe workery, stare kończą żądania);
+# nowa wersja kodu: kill -USR2 <pid mastera>, a po starcie nowego mastera kill -TERM starego.
+
+# Katalog, przez który workery składają wspólne metryki dla /metrics
+os.environ.setdefault('BLACHY_METRICS_DIR', os.path.join(tempfile.gettempdir(), 'blachy-metrics'))
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+worker_class = 'gthread'
+
+# Aplikacja (i skompilowane szablony) ładowana raz w masterze, workery dziedziczą ją po fork()
+preload_app = True
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+
+# Okresowa wymiana workerów ogranicza skutki wycieków pamięci
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+accesslog = '-'
+errorlog = '-'
+
+
+def on_starting(server):
+    # Metryki z poprzedniego uruchomienia
+    for path in glob.glob(os.path.join(os.environ['BLACHY_METRICS_DIR'], '*.json')):
+        os.remove(path)
+
+
+def child_exit(server, worker):
+    server.app.wsgi().extensions['metrics'].archive_process(worker.pid)
+
+
+def worker_exit(server, worker):
+    # Wymieniany lub zatrzymywany worker kończy bieżące zadania w tle albo oddaje je do kolejki
+    from app import zatrzymaj_zadania
+    zatrzymaj_zadania(worker.app.wsgi())
+
+
+def post_fork(server, worker):
+    # Każdy worker zakłada własne połączenia do bazy; close=False nie dotyka połączeń rodzica
+    from app import db
+    with worker.app.wsgi().app_context():
+        db.engine.dispose(close=False)
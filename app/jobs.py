@@ -0,0 +1,118 @@
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+
+# Kolejka zadań w tle bez zewnętrznego brokera: stan zadań trzyma baza aplikacji,
+# tu są tylko wątki robocze oraz katalog z wynikami (każde zadanie ma własny podkatalog).
+
+logger = logging.getLogger(__name__)
+
+
+class JobWorkers:
+    # Wątki wywołujące run_next(), dopóki zwraca True (wykonano zadanie); przy pustej kolejce
+    # czekają poll_interval sekund albo do wake(). Tworzone leniwie w każdym procesie (po fork()).
+    def __init__(self, run_next, workers=2, poll_interval=5.0):
+        self.run_next = run_next
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._pid = None
+
+    def start(self):
+        if self._pid == os.getpid() or not self.workers:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._wakeup = threading.Event()
+            self._stopping = threading.Event()
+            self._threads = [threading.Thread(target=self._loop, name=f'zadania-{i}', daemon=True)
+                             for i in range(self.workers)]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def wake(self):
+        self._wakeup.set()
+
+    def stop(self, timeout):
+        # Wątki nie biorą już nowych zadań; czekamy do timeout sekund, aż skończą bieżące.
+        # Zwraca False, jeśli któryś wątek wciąż pracuje (zginie razem z procesem).
+        if self._pid != os.getpid():
+            return True
+        self._stopping.set()
+        self._wakeup.set()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        return not any(thread.is_alive() for thread in self._threads)
+
+    def run_until_empty(self):
+        # Wykonuje zadania w bieżącym wątku, aż kolejka będzie pusta; zwraca ich liczbę
+        done = 0
+        while self.run_next():
+            done += 1
+        return done
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            try:
+                if self.run_next():
+                    continue
+            except Exception:
+                logger.exception("Błąd pętli zadań")
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+
+class ArtifactStore:
+    # Pliki wynikowe zadań: root/<id zadania>/<nazwa>
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, job_id, name):
+        return os.path.join(self.root, str(job_id), name)
+
+    def write(self, job_id, name, chunks):
+        # Zapis przez plik tymczasowy – przerwane zadanie nie zostawia niepełnego wyniku.
+        # Zwraca rozmiar pliku w bajtach.
+        path = self.path(job_id, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = f"{path}.{uuid.uuid4().hex}.part"
+        size = 0
+        try:
+            with open(part_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            os.replace(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        return size
+
+    def link(self, job_id, name, source):
+        # Gotowy plik (np. z pamięci podręcznej eksportów) jako wynik zadania – dowiązanie twarde
+        # zamiast kopii; kopiujemy tylko, gdy katalogi leżą na różnych systemach plików
+        path = self.path(job_id, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            try:
+                os.link(source, part_path)
+            except OSError:
+                shutil.copyfile(source, part_path)
+            os.replace(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        return os.path.getsize(path)
+
+    def remove(self, job_id):
+        shutil.rmtree(os.path.join(self.root, str(job_id)), ignore_errors=True)
@@ -0,0 +1,165 @@
+import json
+import math
+import os
+import threading
+import time
+import uuid
+
+# Metryki aplikacji w formacie tekstowym Prometheusa. Każdy proces trzyma liczniki w pamięci;
+# przy kilku workerach (gunicorn) procesy okresowo zapisują stan do katalogu wspólnego,
+# a /metrics sumuje pliki wszystkich procesów.
+
+# Progi histogramów: czas w sekundach i liczba zapytań SQL na żądanie
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _merge(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot:
+            key = (name, tuple(tuple(p) for p in labels))
+            if isinstance(value, list):
+                current = merged.setdefault(key, [0] * len(value))
+                for i, v in enumerate(value):
+                    current[i] += v
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+class Metrics:
+    def __init__(self, directory=None, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        # nazwa -> (typ, opis, progi)
+        self._definitions = {}
+        # (nazwa, etykiety) -> wartość albo [liczniki progów..., suma, liczba]
+        self._values = {}
+        self._last_flush = 0.0
+        self._pid = os.getpid()
+
+    def counter(self, name, description):
+        self._definitions[name] = ('counter', description, None)
+
+    def histogram(self, name, description, buckets=LATENCY_BUCKETS):
+        self._definitions[name] = ('histogram', description, tuple(buckets))
+
+    def _reset_after_fork(self):
+        # Proces potomny zaczyna od zera – wartości rodzica są już w jego pliku
+        if self._pid != os.getpid():
+            self._values = {}
+            self._last_flush = 0.0
+            self._pid = os.getpid()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._reset_after_fork()
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self._definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._reset_after_fork()
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * (len(buckets) + 2)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    data[i] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def _snapshot(self):
+        with self._lock:
+            self._reset_after_fork()
+            return [[name, [list(p) for p in labels], value if not isinstance(value, list) else list(value)]
+                    for (name, labels), value in self._values.items()]
+
+    def _path(self, pid=None):
+        return os.path.join(self.directory, f"{pid or os.getpid()}.json")
+
+    def flush(self, force=False):
+        # Zapis stanu procesu do katalogu wspólnego, nie częściej niż co flush_interval sekund
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        self._last_flush = now
+        os.makedirs(self.directory, exist_ok=True)
+        self._write(self._path(), self._snapshot())
+
+    def _read(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def _write(self, path, snapshot):
+        tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+
+    def archive_process(self, pid):
+        # Wywoływane w procesie głównym po zakończeniu workera (gunicorn child_exit): wartości
+        # workera dopisujemy do wspólnego archiwum, żeby liczniki nie malały po wymianie workerów
+        if not self.directory:
+            return
+        path = self._path(pid)
+        if not os.path.exists(path):
+            return
+        archive = os.path.join(self.directory, 'archiwum.json')
+        merged = _merge([self._read(archive), self._read(path)])
+        self._write(archive, [[name, [list(p) for p in labels], value] for (name, labels), value in merged.items()])
+        os.remove(path)
+
+    def collect(self):
+        # Suma wartości wszystkich procesów
+        if not self.directory:
+            return _merge([self._snapshot()])
+        self.flush(force=True)
+        return _merge([self._read(os.path.join(self.directory, name))
+                       for name in os.listdir(self.directory) if name.endswith('.json')])
+
+    def render(self):
+        merged = self.collect()
+        lines = []
+        for name, (kind, description, buckets) in sorted(self._definitions.items()):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(merged.items()):
+                if metric != name:
+                    continue
+                if kind == 'counter':
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                    continue
+                for bound, count in zip(buckets + (math.inf,), value[:-2] + [value[-1]]):
+                    lines.append(f"{name}_bucket{_labels(labels, [('le', _number(float(bound)))])} {count}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(value[-2])}")
+                lines.append(f"{name}_count{_labels(labels)} {value[-1]}")
+        return '\n'.join(lines) + '\n'
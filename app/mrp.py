@@ -0,0 +1,127 @@
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+# Planowanie potrzeb materiałowych (MRP) na kolumnach numpy: stany, zapotrzebowanie projektów
+# i przyjęcia dla całego katalogu liczone jednym przebiegiem, bez pętli po blachach.
+# Scenariusze "co jeśli" działają na kopiach tablic – baza danych nie jest zmieniana.
+
+
+def net_requirements(stock, gross, receipts=0, safety_stock=0, lot_size=1, min_order=0):
+    # Dla tablic (lub liczb) zwraca (netto, do zamówienia):
+    #   netto        = max(brutto + zapas minimalny - stan - przyjęcia, 0)
+    #   do zamówienia = netto zaokrąglone w górę do wielokrotności partii, nie mniej niż minimum
+    net = np.maximum(np.asarray(gross) + safety_stock - np.asarray(stock) - receipts, 0)
+    lot_size = np.maximum(np.asarray(lot_size), 1)
+    order = -(-net // lot_size) * lot_size
+    order = np.where(net > 0, np.maximum(order, min_order), 0)
+    return net, order
+
+
+def _columns(rows, width):
+    return tuple(zip(*rows)) if rows else ((),) * width
+
+
+@dataclass
+class PlanningData:
+    # Katalog blach posortowany po id oraz niezrealizowane pozycje projektów
+    sheet_id: np.ndarray
+    code: np.ndarray
+    stock: np.ndarray
+    item_project: np.ndarray
+    item_sheet: np.ndarray  # indeks w sheet_id, nie id blachy
+    item_qty: np.ndarray
+
+    @classmethod
+    def from_rows(cls, sheets, items):
+        # sheets: (id, kod, stan) rosnąco po id; items: (project_id, blacha_id, ilość).
+        # Tablice budowane kolumnami – np.array na liście wierszy bazy jest wielokrotnie wolniejsze.
+        sheet_id, code, stock = _columns(sheets, 3)
+        item_project, item_sheet, item_qty = (np.array(c, dtype=np.int64) for c in _columns(items, 3))
+        data = cls(np.array(sheet_id, dtype=np.int64), np.array(code, dtype=object),
+                   np.array(stock, dtype=np.int64), item_project, item_sheet, item_qty)
+        index, known = data.lookup(item_sheet)
+        data.item_project, data.item_sheet, data.item_qty = item_project[known], index[known], item_qty[known]
+        return data
+
+    def __len__(self):
+        return len(self.sheet_id)
+
+    def lookup(self, sheet_ids):
+        # Indeksy blach w katalogu i maska tych, które w nim są
+        sheet_ids = np.asarray(sheet_ids, dtype=np.int64)
+        if not len(self):
+            return np.zeros(len(sheet_ids), dtype=np.int64), np.zeros(len(sheet_ids), dtype=bool)
+        index = np.minimum(np.searchsorted(self.sheet_id, sheet_ids), len(self) - 1)
+        return index, self.sheet_id[index] == sheet_ids
+
+    def vector(self, quantities):
+        # {blacha_id: ilość} -> tablica w kolejności katalogu (nieznane blachy są pomijane)
+        result = np.zeros(len(self), dtype=np.int64)
+        if quantities:
+            index, known = self.lookup(list(quantities))
+            qty = np.fromiter(quantities.values(), dtype=np.int64, count=len(quantities))
+            np.add.at(result, index[known], qty[known])
+        return result
+
+
+@dataclass
+class Scenario:
+    name: str = 'Stan bieżący'
+    # Projekty pominięte w zapotrzebowaniu (jak po archiwizacji)
+    archive: tuple = ()
+    # Projekty liczone dodatkowo: {project_id: ile razy}, np. powtórzenie zlecenia
+    repeat: dict = field(default_factory=dict)
+    # Zapotrzebowanie i przyjęcia spoza bazy: {blacha_id: ilość}
+    extra_demand: dict = field(default_factory=dict)
+    receipts: dict = field(default_factory=dict)
+    # Zapas minimalny, wielkość partii i minimalne zamówienie (dla wszystkich blach)
+    safety_stock: int = 0
+    lot_size: int = 1
+    min_order: int = 0
+
+
+@dataclass
+class PlanResult:
+    scenario: Scenario
+    gross: np.ndarray
+    net: np.ndarray
+    order: np.ndarray
+    elapsed_ms: float
+
+    @property
+    def shortages(self):
+        return int(np.count_nonzero(self.net))
+
+    @property
+    def total_net(self):
+        return int(self.net.sum())
+
+    @property
+    def total_order(self):
+        return int(self.order.sum())
+
+
+def plan(data, scenario=None):
+    scenario = scenario or Scenario()
+    start = time.perf_counter()
+    # Krotność pozycji: 0 dla projektów archiwizowanych, 1 + powtórzenia dla pozostałych
+    multiplier = np.ones(len(data.item_project), dtype=np.int64)
+    for project_id, times in scenario.repeat.items():
+        multiplier[data.item_project == project_id] += times
+    if scenario.archive:
+        multiplier[np.isin(data.item_project, list(scenario.archive))] = 0
+    gross = np.bincount(data.item_sheet, weights=data.item_qty * multiplier, minlength=len(data))
+    gross = gross.astype(np.int64) + data.vector(scenario.extra_demand)
+    net, order = net_requirements(data.stock, gross, data.vector(scenario.receipts),
+                                  scenario.safety_stock, scenario.lot_size, scenario.min_order)
+    return PlanResult(scenario, gross, net, order, (time.perf_counter() - start) * 1000)
+
+
+def largest_orders(data, result, limit=50):
+    # Blachy z największą ilością do zamówienia: (id, kod, stan, brutto, netto, do zamówienia)
+    index = np.flatnonzero(result.order)
+    index = index[np.argsort(-result.order[index], kind='stable')][:limit]
+    return [(int(data.sheet_id[i]), data.code[i], int(data.stock[i]), int(result.gross[i]),
+             int(result.net[i]), int(result.order[i])) for i in index]
@@ -0,0 +1,50 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+# Wyrenderowane strony w pamięci procesu, ważne dla jednej wersji danych. Wersja tylko rośnie,
+# więc nowsza wersja unieważnia od razu całą zawartość, a zapis ze starszej jest pomijany.
+
+
+class PageCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # Znacznik instancji do ETagów – po restarcie (nowe szablony) stare ETagi przestają pasować
+        self.token = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._version = None
+        self._pages = OrderedDict()
+        self._size = 0
+
+    def _switch(self, version):
+        # Wywoływane pod blokadą; zwraca False dla wersji starszej niż bieżąca
+        if self._version is None or version > self._version:
+            self._version = version
+            self._pages.clear()
+            self._size = 0
+        return version == self._version
+
+    def get(self, key, version):
+        with self._lock:
+            if not self._switch(version):
+                return None
+            body = self._pages.get(key)
+            if body is not None:
+                self._pages.move_to_end(key)
+            return body
+
+    def put(self, key, version, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if not self._switch(version):
+                return
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._pages[key] = body
+            self._size += len(body)
+            # Najdawniej używane strony usuwane są pierwsze
+            while self._size > self.max_bytes:
+                _, removed = self._pages.popitem(last=False)
+                self._size -= len(removed)
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # bez Pillow miniatury są wyłączone, serwowany jest oryginał
+    Image = None
+
+# Rozmiary pochodnych: dłuższy bok w pikselach
+THUMBNAIL_SIZES = {
+    'mini': 100,
+    'podglad': 600,
+}
+
+# Co ile nowych miniatur sprawdzamy limit rozmiaru katalogu
+EVICT_EVERY = 50
+
+
+class ThumbnailCache:
+    # Miniatury obrazów blach trzymane na dysku. Nazwa pliku zależy od źródła, rozmiaru
+    # oraz rozmiaru i czasu modyfikacji oryginału, więc podmiana oryginału daje nową miniaturę.
+    def __init__(self, root, max_bytes, workers=2):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._executor = None
+        self._executor_pid = None
+        self._generated = 0
+
+    @property
+    def available(self):
+        return Image is not None
+
+    def path(self, src_path, size):
+        st = os.stat(src_path)
+        h = hashlib.sha256(f"{src_path}:{size}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()
+        return os.path.join(self.root, size, h[:2], h + '.jpg')
+
+    def get(self, src_path, size):
+        # Zwraca ścieżkę miniatury, generując ją przy pierwszym żądaniu; None gdy się nie da
+        if not self.available or size not in THUMBNAIL_SIZES:
+            return None
+        try:
+            dest = self.path(src_path, size)
+        except FileNotFoundError:
+            return None
+        try:
+            # Czas modyfikacji służy jako znacznik ostatniego użycia
+            os.utime(dest)
+            return dest
+        except FileNotFoundError:
+            pass
+        try:
+            self._generate(src_path, size, dest)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return None
+        return dest
+
+    def submit(self, src_path):
+        # Generuje wszystkie rozmiary w tle, np. zaraz po uploadzie
+        if not self.available:
+            return
+        for size in THUMBNAIL_SIZES:
+            self._pool().submit(self.get, src_path, size)
+
+    def _pool(self):
+        # Pula wątków tworzona leniwie w każdym procesie (bezpieczne po fork())
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='miniatury')
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _generate(self, src_path, size, dest):
+        edge = THUMBNAIL_SIZES[size]
+        with Image.open(src_path) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((edge, edge))
+            if img.mode in ('RGBA', 'LA', 'P'):
+                # Przezroczystość na białym tle
+                img = img.convert('RGBA')
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel('A'))
+                img = background
+            elif img.mode != 'RGB':
+                img = img.convert('RGB')
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            tmp_path = f"{dest}.{uuid.uuid4().hex}.part"
+            try:
+                img.save(tmp_path, 'JPEG', quality=85, optimize=True)
+                os.replace(tmp_path, dest)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        with self._lock:
+            self._generated += 1
+            evict = self._generated % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        files = []
+        for dirpath, _, names in os.walk(self.root):
+            for name in names:
+                if not name.endswith('.jpg'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
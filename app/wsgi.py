@@ -0,0 +1,9 @@
+# Punkt wejścia dla serwera WSGI (gunicorn -c gunicorn.conf.py wsgi:app)
+from app import create_app, db, init_db
+
+app = create_app()
+
+with app.app_context():
+    init_db()
+    # Połączenia otwarte w procesie głównym nie mogą trafić do workerów po fork()
+    db.engine.dispose()
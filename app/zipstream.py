@@ -0,0 +1,126 @@
+import os
+import time
+import uuid
+import zipfile
+
+# Pliki już skompresowane zapisujemy bez ponownej kompresji
+STORED_EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg', '.gif', '.zip')
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _StreamBuffer:
+    # Nieprzewijalny strumień dla ZipFile – zbiera zapisane bajty do odebrania przez generator.
+    # Brak seek() sprawia, że ZipFile zapisuje rozmiary w deskryptorach danych po każdym pliku.
+    def __init__(self):
+        self._chunks = []
+        self._pos = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def compress_type_for(arcname):
+    if arcname.lower().endswith(STORED_EXTENSIONS):
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def stream_zip(entries, chunk_size=CHUNK_SIZE):
+    # entries: (nazwa w archiwum, ścieżka do pliku albo bajty)
+    # Zwraca kolejne fragmenty archiwum w trakcie jego budowania; każdy plik czytany jest raz.
+    buf = _StreamBuffer()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for arcname, source in entries:
+            if isinstance(source, bytes):
+                zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime()[:6])
+                zinfo.compress_type = compress_type_for(arcname)
+                zf.writestr(zinfo, source)
+            else:
+                zinfo = zipfile.ZipInfo.from_file(source, arcname)
+                zinfo.compress_type = compress_type_for(arcname)
+                with open(source, 'rb') as src, zf.open(zinfo, 'w') as dst:
+                    while True:
+                        chunk = src.read(chunk_size)
+                        if not chunk:
+                            break
+                        dst.write(chunk)
+                        data = buf.pop()
+                        if data:
+                            yield data
+            data = buf.pop()
+            if data:
+                yield data
+    # Katalog centralny archiwum
+    data = buf.pop()
+    if data:
+        yield data
+
+
+class ExportCache:
+    # Pamięć podręczna gotowych archiwów ZIP z limitem rozmiaru; najdawniej używane usuwane są pierwsze
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+
+    def path(self, key):
+        return os.path.join(self.root, key + '.zip')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            # Odświeżamy czas modyfikacji – służy jako znacznik ostatniego użycia
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def add(self, key, path):
+        # Gotowe archiwum (wynik zadania) trafia do pamięci przez dowiązanie twarde – dane leżą na dysku
+        # raz, a usunięcie jednej nazwy nie kasuje drugiej. Bez dowiązań (inny system plików) nie zapisujemy.
+        os.makedirs(self.root, exist_ok=True)
+        part_path = self.path(key) + f'.{uuid.uuid4().hex}.part'
+        try:
+            os.link(path, part_path)
+        except OSError:
+            return
+        os.replace(part_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        files = []
+        for name in names:
+            if not name.endswith('.zip'):
+                continue
+            path = os.path.join(self.root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size